@@ -0,0 +1,307 @@
+"""
+Generates synthetic mDC Designer scenes to benchmark render-scene-import.py
+
+    python benchmark-generate-scene.py --output benchmark --assets 10,100,1000,10000 --prepare
+
+Each asset count gets its own directory (benchmark/assets-100...) laid out like the render package:
+
+    myDecoCloud_scene/myDecoCloud_scene.gltf   the scene, with the same custom properties as the real exports
+    assets/{hash}/{hash}.gltf                  fake object and material bundles
+    benchmark.json                             the generation parameters and the camera to render the scene with
+
+The scene has a grid of asset nulls (assetBundleHash) with materialsMap/palettesMap entries, materials replaced
+by material bundles, openings, rotated floor surfaces, grass patches with paving slabs cutting them, and windows.
+--prepare turns the bundles into .blend files with prepare-batch.py and the existing prepare-*-lq-file.py scripts.
+
+Counts other than --assets are ratios of the number of assets, so that the scenes keep the same mix when they grow.
+"""
+
+import hashlib
+import json
+import math
+import os
+import random
+import struct
+import subprocess
+import sys
+from os import path
+
+rootPath = path.dirname(path.abspath(__file__))
+
+def getArg(argv, name, default=None):
+    return argv[argv.index(name) + 1] if name in argv else default
+
+## GLTF writing
+
+# Appends data to the binary buffer and returns the index of its accessor
+def addAccessor(gltf, binary, data, componentType, count, accessorType, target=None, bounds=None):
+    ## Accessors are aligned on 4 bytes
+    binary.extend(b'\0' * (-len(binary) % 4))
+
+    bufferView = {'buffer': 0, 'byteOffset': len(binary), 'byteLength': len(data)}
+    if target is not None:
+        bufferView['target'] = target
+
+    binary.extend(data)
+    gltf['bufferViews'].append(bufferView)
+
+    accessor = {'bufferView': len(gltf['bufferViews']) - 1, 'componentType': componentType, 'count': count, 'type': accessorType}
+    if bounds is not None:
+        (accessor['min'], accessor['max']) = bounds
+
+    gltf['accessors'].append(accessor)
+    return len(gltf['accessors']) - 1
+
+def packFloats(values):
+    return struct.pack(f'<{len(values)}f', *values)
+
+# Box of the given half size centered on the origin, or a quad in the XZ plane (facing +Y) when flat
+def buildBox(halfSize, flat=False):
+    (sizeX, sizeY, sizeZ) = halfSize
+    faces = [((0, 1, 0), (1, 0, 0), (0, 0, -1))]
+
+    if not flat:
+        faces += [((0, -1, 0), (1, 0, 0), (0, 0, 1)), ((1, 0, 0), (0, 0, -1), (0, 1, 0)),
+                  ((-1, 0, 0), (0, 0, 1), (0, 1, 0)), ((0, 0, 1), (1, 0, 0), (0, 1, 0)),
+                  ((0, 0, -1), (-1, 0, 0), (0, 1, 0))]
+
+    positions = []
+    normals = []
+    uvs = []
+    indices = []
+
+    for (normal, tangent, bitangent) in faces:
+        firstIndex = len(positions) // 3
+
+        for (u, v) in ((0, 0), (1, 0), (1, 1), (0, 1)):
+            corner = [normal[axis] * (0 if flat else 1) + tangent[axis] * (2 * u - 1) + bitangent[axis] * (2 * v - 1)
+                      for axis in range(3)]
+            positions += [corner[0] * sizeX, corner[1] * sizeY, corner[2] * sizeZ]
+            normals += normal
+            uvs += [u * 2 * sizeX, v * 2 * max(sizeY, sizeZ)]
+
+        indices += [firstIndex, firstIndex + 1, firstIndex + 2, firstIndex, firstIndex + 2, firstIndex + 3]
+
+    return positions, normals, uvs, indices
+
+def addMesh(gltf, binary, name, box, materialIndex):
+    (positions, normals, uvs, indices) = box
+    vertexCount = len(positions) // 3
+    bounds = ([min(positions[axis::3]) for axis in range(3)], [max(positions[axis::3]) for axis in range(3)])
+
+    primitive = {
+        'attributes': {
+            'POSITION': addAccessor(gltf, binary, packFloats(positions), 5126, vertexCount, 'VEC3', 34962, bounds),
+            'NORMAL': addAccessor(gltf, binary, packFloats(normals), 5126, vertexCount, 'VEC3', 34962),
+            'TEXCOORD_0': addAccessor(gltf, binary, packFloats(uvs), 5126, vertexCount, 'VEC2', 34962),
+        },
+        'indices': addAccessor(gltf, binary, struct.pack(f'<{len(indices)}H', *indices), 5123, len(indices), 'SCALAR', 34963),
+        'material': materialIndex,
+    }
+
+    gltf['meshes'].append({'name': name, 'primitives': [primitive]})
+    return len(gltf['meshes']) - 1
+
+def addMaterial(gltf, name, color, extras=None):
+    material = {'name': name, 'pbrMetallicRoughness': {'baseColorFactor': [*color, 1], 'metallicFactor': 0, 'roughnessFactor': 0.6}}
+    if extras is not None:
+        material['extras'] = extras
+
+    gltf['materials'].append(material)
+    return len(gltf['materials']) - 1
+
+def addNode(gltf, name, translation, mesh=None, rotation=None, extras=None):
+    node = {'name': name, 'translation': translation}
+
+    if mesh is not None:
+        node['mesh'] = mesh
+    if rotation is not None:
+        node['rotation'] = rotation
+    if extras is not None:
+        node['extras'] = extras
+
+    gltf['nodes'].append(node)
+    gltf['scenes'][0]['nodes'].append(len(gltf['nodes']) - 1)
+
+def newGltf():
+    return {
+        'asset': {'version': '2.0', 'generator': 'mdc-render-package benchmark-generate-scene.py'},
+        'scene': 0,
+        'scenes': [{'nodes': []}],
+        'nodes': [], 'meshes': [], 'materials': [], 'accessors': [], 'bufferViews': [],
+    }
+
+def writeGltf(gltfPath, gltf, binary):
+    os.makedirs(path.dirname(gltfPath), exist_ok=True)
+    binaryName = path.basename(gltfPath).replace('.gltf', '.bin')
+
+    gltf['buffers'] = [{'uri': binaryName, 'byteLength': len(binary)}]
+
+    with open(path.join(path.dirname(gltfPath), binaryName), 'wb') as binaryFile:
+        binaryFile.write(binary)
+
+    with open(gltfPath, 'w') as gltfFile:
+        json.dump(gltf, gltfFile)
+
+## Bundles
+
+def getBundleHash(kind, index):
+    return hashlib.sha1(f'benchmark-{kind}-{index}'.encode()).hexdigest()
+
+# Object bundle: a box with one material, named like the materialsMap/palettesMap entries of the scene
+def writeObjectBundle(assetsPath, bundleHash, rng):
+    gltf = newGltf()
+    binary = bytearray()
+
+    material = addMaterial(gltf, 'MAT_Bench_Asset', (rng.random(), rng.random(), rng.random()))
+    halfSize = (0.2 + rng.random() * 0.6, 0.2 + rng.random() * 0.6, 0.2 + rng.random() * 0.6)
+    mesh = addMesh(gltf, binary, 'Bench_Asset', buildBox(halfSize), material)
+    addNode(gltf, 'Bench_Asset', [0, halfSize[1], 0], mesh=mesh)
+
+    gltfPath = path.join(assetsPath, bundleHash, f'{bundleHash}.gltf')
+    writeGltf(gltfPath, gltf, binary)
+    return {'type': 'object-lq', 'path': gltfPath}
+
+# Material bundle: a quad whose material already has the name the import looks for
+def writeMaterialBundle(assetsPath, bundleHash, rng):
+    gltf = newGltf()
+    binary = bytearray()
+
+    material = addMaterial(gltf, '__render_importMaterial', (rng.random(), rng.random(), rng.random()))
+    mesh = addMesh(gltf, binary, 'Bench_Material', buildBox((0.5, 0, 0.5), flat=True), material)
+    addNode(gltf, 'Bench_Material', [0, 0, 0], mesh=mesh)
+
+    gltfPath = path.join(assetsPath, bundleHash, f'{bundleHash}.gltf')
+    writeGltf(gltfPath, gltf, binary)
+    return {'type': 'material-lq', 'path': gltfPath}
+
+## Scene
+
+def randomColor(rng):
+    return {'r': round(rng.random(), 3), 'g': round(rng.random(), 3), 'b': round(rng.random(), 3), 'a': 1}
+
+def generateScene(outputPath, options):
+    rng = random.Random(options['seed'])
+    assetCount = options['assets']
+    assetsPath = path.join(outputPath, 'assets')
+
+    gltf = newGltf()
+    binary = bytearray()
+
+    ## Bundles
+    objectBundles = [getBundleHash('object', index) for index in range(max(1, min(assetCount, options['uniqueAssets'])))]
+    materialBundles = [getBundleHash('material', index) for index in range(options['uniqueMaterials'])]
+
+    manifest = [writeObjectBundle(assetsPath, bundleHash, rng) for bundleHash in objectBundles]
+    manifest += [writeMaterialBundle(assetsPath, bundleHash, rng) for bundleHash in materialBundles]
+
+    ## Materials of the scene, some of them replaced by a material bundle
+    sceneMaterials = []
+    materialAssetCount = 0
+
+    for index in range(8):
+        extras = None
+        if materialBundles and index < options['materialAssets']:
+            extras = {'assetBundleHash': materialBundles[index % len(materialBundles)]}
+            materialAssetCount += 1
+
+        sceneMaterials.append(addMaterial(gltf, f'MAT_Bench_{index:02d}', (rng.random(), rng.random(), rng.random()), extras))
+
+    glassMaterial = addMaterial(gltf, 'MAT_Vitre_01_Bench', (0.8, 0.9, 1))
+    grassMaterial = addMaterial(gltf, 'MAT_Bench_Grass', (0.2, 0.5, 0.1))
+
+    ## Assets are laid out on a grid, on a floor made of rotated tiles
+    gridSize = math.ceil(math.sqrt(assetCount))
+    spacing = 2
+    extent = gridSize * spacing
+
+    tileMesh = addMesh(gltf, binary, 'Bench_Tile', buildBox((spacing / 2, 0, spacing / 2), flat=True), sceneMaterials[0])
+    slabMesh = addMesh(gltf, binary, 'Bench_Slab', buildBox((0.4, 0.03, 0.4)), sceneMaterials[1])
+    windowMesh = addMesh(gltf, binary, 'Bench_Window', buildBox((0.6, 0.7, 0.02)), glassMaterial)
+    grassMesh = addMesh(gltf, binary, 'Bench_Grass', buildBox((spacing, 0, spacing), flat=True), grassMaterial)
+
+    counts = {name: round(assetCount * options[name]) for name in ('materialsMaps', 'palettes', 'openings', 'rotations', 'grass')}
+    counts['grassCutters'] = counts['grass'] * options['cuttersPerGrass']
+
+    for index in range(assetCount):
+        (x, z) = ((index % gridSize) * spacing, (index // gridSize) * spacing)
+        extras = {'assetBundleHash': objectBundles[index % len(objectBundles)]}
+
+        if index < counts['materialsMaps'] and materialBundles:
+            extras['materialsMap'] = {'MAT_Bench_Asset': {'assetBundleHash': materialBundles[index % len(materialBundles)]}}
+
+            if index < counts['palettes']:
+                extras['palettesMap'] = {'MAT_Bench_Asset': randomColor(rng)}
+
+        angle = rng.random() * math.pi
+        addNode(gltf, f'Bench_Asset_{index}', [x, 0, z], rotation=[0, math.sin(angle / 2), 0, math.cos(angle / 2)], extras=extras)
+
+    for index in range(counts['rotations']):
+        (x, z) = ((index % gridSize) * spacing, (index // gridSize) * spacing)
+        addNode(gltf, f'Bench_Tile_{index}', [x, 0, z], mesh=tileMesh, extras={'rotation': rng.choice((0, 45, 90, 30))})
+
+    for index in range(counts['openings']):
+        ## Openings go along the wall at z = -1, with a window pane
+        (x, width, height) = (index * 1.5 % extent, 1.2, 1.4)
+        addNode(gltf, f'Bench_Opening_{index}', [x, 0.9, -1], extras={'opening': [width, height, 0.2]})
+        addNode(gltf, f'Bench_Window_{index}', [x + width / 2, 0.9 + height / 2, -1.1], mesh=windowMesh)
+
+    for index in range(counts['grass']):
+        ## Grass patches are beyond the grid, with slabs laid on them
+        (x, z) = (index * 2 * spacing, extent + 2 * spacing)
+        addNode(gltf, f'Bench_Grass_{index}', [x, 0, z], mesh=grassMesh, extras={'grassGeneration': 1})
+
+        for cutterIndex in range(options['cuttersPerGrass']):
+            slabPosition = [x + (rng.random() - 0.5) * 2 * spacing, 0.02, z + (rng.random() - 0.5) * 2 * spacing]
+            addNode(gltf, f'Bench_Slab_{index}_{cutterIndex}', slabPosition, mesh=slabMesh, extras={'grassDestruction': 1})
+
+    writeGltf(path.join(outputPath, 'myDecoCloud_scene', 'myDecoCloud_scene.gltf'), gltf, binary)
+
+    with open(path.join(outputPath, 'manifest.json'), 'w') as manifestFile:
+        json.dump(manifest, manifestFile)
+
+    ## Camera in the Blender space, at a corner of the grid looking at its center
+    benchmark = {
+        'options': options,
+        'counts': {'assets': assetCount, 'objectBundles': len(objectBundles), 'materialBundles': len(materialBundles),
+                   'materialAssets': materialAssetCount, **counts},
+        'position': f'{-spacing},{spacing},1.6',
+        'orientation': f'1.37,0,{-math.pi / 4 - math.pi / 2}',
+        'camera': 'perspective,1.7777,1.09955,0.1,1000',
+    }
+
+    with open(path.join(outputPath, 'benchmark.json'), 'w') as benchmarkFile:
+        json.dump(benchmark, benchmarkFile, indent=2)
+
+    print(f'Generated {outputPath}: {benchmark["counts"]}')
+
+def main(argv):
+    outputPath = getArg(argv, '--output', 'benchmark')
+    assetCounts = [int(count) for count in getArg(argv, '--assets', '10,100,1000').split(',')]
+
+    baseOptions = {
+        'seed': int(getArg(argv, '--seed', 1)),
+        'uniqueAssets': int(getArg(argv, '--unique-assets', 50)),
+        'uniqueMaterials': int(getArg(argv, '--unique-materials', 10)),
+        'materialAssets': int(getArg(argv, '--material-assets', 2)),
+        'materialsMaps': float(getArg(argv, '--materials-maps', 0.5)),
+        'palettes': float(getArg(argv, '--palettes', 0.2)),
+        'openings': float(getArg(argv, '--openings', 0.05)),
+        'rotations': float(getArg(argv, '--rotations', 0.5)),
+        'grass': float(getArg(argv, '--grass', 0.01)),
+        'cuttersPerGrass': int(getArg(argv, '--cutters-per-grass', 5)),
+    }
+
+    for assetCount in assetCounts:
+        scenePath = path.join(outputPath, f'assets-{assetCount}')
+        generateScene(scenePath, {**baseOptions, 'assets': assetCount})
+
+        if '--prepare' in argv:
+            command = [sys.executable, path.join(rootPath, 'prepare-batch.py'), '--blender', getArg(argv, '--blender', 'blender')]
+            if '--jobs' in argv:
+                command += ['--jobs', getArg(argv, '--jobs')]
+
+            subprocess.run(command + [path.join(scenePath, 'manifest.json')], check=True)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
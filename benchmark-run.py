@@ -0,0 +1,171 @@
+"""
+Runs render-scene-import.py headless on CPU against scenes made by benchmark-generate-scene.py, with each
+environment template, and records the timings of its stages
+
+    python benchmark-run.py --repeat 3 benchmark/assets-10 benchmark/assets-100 benchmark/assets-1000
+
+The environment template is copied into each scene directory (render-scene-import.py looks for the GLTF and
+the assets next to it), with a link to the textures of the package. Every run starts with an empty prepared
+scenes cache, texture tiers and asset mirror, unless --warm is given to measure the cache hits.
+
+Each run appends a JSON line to --output (benchmark/results.jsonl by default) with the commit of the package,
+the counts of the scene and the profile report written by render-scene-import.py, so that scaling curves and
+regressions can be followed over time. A summary of the stage times is printed at the end.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from os import path
+
+rootPath = path.dirname(path.abspath(__file__))
+
+environments = ('interior', 'exterior', 'nightly')
+
+def getArg(argv, name, default=None):
+    return argv[argv.index(name) + 1] if name in argv else default
+
+def getCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=rootPath, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Copies the environment template into the scene directory, next to the GLTF and the assets
+def prepareTemplate(scenePath, sceneEnvironment):
+    templatePath = path.join(rootPath, f'render-scene-{sceneEnvironment}.blend')
+    sceneTemplatePath = path.join(scenePath, f'render-scene-{sceneEnvironment}.blend')
+
+    if not path.exists(sceneTemplatePath) or path.getmtime(sceneTemplatePath) < path.getmtime(templatePath):
+        shutil.copyfile(templatePath, sceneTemplatePath)
+
+    ## The templates reference their textures relatively
+    texturesPath = path.join(scenePath, 'textures')
+    if not path.exists(texturesPath):
+        try:
+            os.symlink(path.join(rootPath, 'textures'), texturesPath, target_is_directory=True)
+        except OSError:
+            shutil.copytree(path.join(rootPath, 'textures'), texturesPath)
+
+    return sceneTemplatePath
+
+# Removes everything the import reuses from a previous run: the prepared scenes and their manifests, the texture
+# tiers and the local asset mirror (--asset-mirror of the import arguments, relative to the scene directory)
+def clearPreparedScenes(scenePath, extraArgs):
+    cachePath = path.join(scenePath, 'cache')
+
+    if path.isdir(cachePath):
+        for entry in os.scandir(cachePath):
+            if entry.is_file() and entry.name.startswith(('prepared-', 'scene-')) and entry.name.endswith(('.blend', '.manifest.json')):
+                os.remove(entry.path)
+
+        shutil.rmtree(path.join(cachePath, 'textures'), ignore_errors=True)
+
+    assetMirrorPath = getArg(extraArgs, '--asset-mirror')
+    if assetMirrorPath is not None:
+        shutil.rmtree(path.join(scenePath, assetMirrorPath), ignore_errors=True)
+
+def runImport(blenderPath, scenePath, sceneEnvironment, session, benchmark, extraArgs):
+    command = [blenderPath, '-b', prepareTemplate(scenePath, sceneEnvironment), '--python', path.join(rootPath, 'render-scene-import.py'),
+               '--', '--cycles-device', 'CPU', '--scene-environment', sceneEnvironment, '--session', session,
+               '--position', benchmark['position'], '--orientation', benchmark['orientation'], '--camera', benchmark['camera'],
+               *extraArgs]
+
+    runStartTime = time.time()
+    ## The import resolves ./cache from the working directory
+    completed = subprocess.run(command, cwd=scenePath, capture_output=True, text=True)
+    wallTime = time.time() - runStartTime
+
+    profilePath = path.join(scenePath, 'cache', f'scene-{sceneEnvironment}-{session}.profile.json')
+    profile = None
+
+    if completed.returncode == 0 and path.exists(profilePath):
+        with open(profilePath) as profileFile:
+            profile = json.load(profileFile)
+    else:
+        print(completed.stdout[-4000:])
+        print(completed.stderr[-4000:], file=sys.stderr)
+
+    return {'returncode': completed.returncode, 'wallTime': wallTime, 'profile': profile}
+
+def printSummary(results):
+    ## Mean time of each stage per scene and environment
+    groups = {}
+    for result in results:
+        if result['profile'] is None:
+            continue
+
+        group = groups.setdefault((result['counts']['assets'], result['sceneEnvironment']), {'runs': 0, 'wallTime': 0, 'stages': {}})
+        group['runs'] += 1
+        group['wallTime'] += result['wallTime']
+
+        for (stageName, stage) in result['profile']['stages'].items():
+            group['stages'][stageName] = group['stages'].get(stageName, 0) + stage['time']
+
+    stageNames = list(dict.fromkeys(stageName for group in groups.values() for stageName in group['stages']))
+    print('\t'.join(['assets', 'environment', 'runs', 'wallTime', *stageNames]))
+
+    for ((assetCount, sceneEnvironment), group) in sorted(groups.items()):
+        ## To the microsecond, most stages of the small scenes take well under a millisecond
+        stageTimes = [f'{group["stages"].get(stageName, 0) / group["runs"]:.6f}' for stageName in stageNames]
+        print('\t'.join([str(assetCount), sceneEnvironment, str(group['runs']), f'{group["wallTime"] / group["runs"]:.3f}', *stageTimes]))
+
+def main(argv):
+    blenderPath = getArg(argv, '--blender', 'blender')
+    repeat = int(getArg(argv, '--repeat', 1))
+    outputPath = getArg(argv, '--output', path.join('benchmark', 'results.jsonl'))
+    selectedEnvironments = getArg(argv, '--environments', ','.join(environments)).split(',')
+    warm = '--warm' in argv
+
+    ## Arguments given to render-scene-import.py, after --import-args
+    extraArgs = argv[argv.index('--import-args') + 1:] if '--import-args' in argv else []
+    optionArgs = argv[:argv.index('--import-args')] if '--import-args' in argv else argv
+
+    ## The scene directories are the arguments that are not options or option values
+    scenePaths = [arg for (index, arg) in enumerate(optionArgs)
+                  if not arg.startswith('--') and (index == 0 or optionArgs[index - 1] not in
+                                                   ('--blender', '--repeat', '--output', '--environments'))]
+
+    commit = getCommit()
+    results = []
+    os.makedirs(path.dirname(path.abspath(outputPath)), exist_ok=True)
+
+    for scenePath in scenePaths:
+        with open(path.join(scenePath, 'benchmark.json')) as benchmarkFile:
+            benchmark = json.load(benchmarkFile)
+
+        for sceneEnvironment in selectedEnvironments:
+            for runIndex in range(repeat):
+                if not warm or runIndex == 0:
+                    clearPreparedScenes(scenePath, extraArgs)
+
+                session = f'benchmark-{runIndex}'
+                run = runImport(blenderPath, scenePath, sceneEnvironment, session, benchmark, extraArgs)
+
+                result = {
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'commit': commit,
+                    'scene': path.abspath(scenePath),
+                    'sceneEnvironment': sceneEnvironment,
+                    'run': runIndex,
+                    'warm': warm and runIndex > 0,
+                    'importArgs': extraArgs,
+                    'counts': benchmark['counts'],
+                    **run,
+                }
+                results.append(result)
+
+                with open(outputPath, 'a') as outputFile:
+                    outputFile.write(json.dumps(result) + '\n')
+
+                print(f'{scenePath} {sceneEnvironment} run {runIndex}: {run["wallTime"]:.3f} seconds (exit code {run["returncode"]})')
+
+    printSummary(results)
+
+    return 1 if any(result['returncode'] != 0 for result in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
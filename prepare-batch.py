@@ -0,0 +1,257 @@
+"""
+Prepares many asset files at once, with a pool of Blender processes that each handle a chunk of files
+
+    python prepare-batch.py --type object-lq --jobs 8 assets/
+    python prepare-batch.py --jobs 8 manifest.json
+
+The manifest is a JSON list of {"type": "object-lq", "path": "assets/xxx/xxx.gltf"} items, the types being
+the names of the prepare-*-file.py scripts (object-lq, object-hq, material-lq, material-hq).
+A directory is searched for *.gltf files for the lq types and *-hq.blend files for the hq types.
+
+Files whose output is newer than the input and whose recorded content hash still matches are skipped.
+The hash is recorded next to the output, in {output}.prepared.json.
+
+Inside Blender (--worker), the script runs the existing prepare scripts on its chunk of files one after the
+other, reopening empty.blend (or the file to prepare) between them instead of restarting Blender.
+"""
+
+import hashlib
+import json
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from urllib.parse import unquote
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+rootPath = path.dirname(path.abspath(__file__))
+emptyFilePath = path.join(rootPath, 'empty.blend')
+
+prepareTypes = ('object-lq', 'object-hq', 'material-lq', 'material-hq')
+
+def getScriptPath(prepareType):
+    return path.join(rootPath, f'prepare-{prepareType}-file.py')
+
+def isLowQuality(prepareType):
+    return prepareType.endswith('-lq')
+
+def getOutputPath(item):
+    ## The lq scripts save a .blend next to the GLTF, the hq scripts save the file in place
+    if isLowQuality(item['type']):
+        return item['path'].replace('.gltf', '.blend')
+
+    return item['path']
+
+## Worker, inside Blender
+
+def prepareItem(item):
+    itemPath = path.abspath(item['path'])
+
+    if isLowQuality(item['type']):
+        ## Start each item from the empty scene, like scripts.sh does
+        bpy.ops.wm.open_mainfile(filepath=emptyFilePath, load_ui=False)
+        scriptArgs = [itemPath]
+    else:
+        bpy.ops.wm.open_mainfile(filepath=itemPath, load_ui=False)
+        scriptArgs = []
+
+    workerArgv = sys.argv
+    sys.argv = [workerArgv[0], '--', *scriptArgs]
+
+    try:
+        runpy.run_path(getScriptPath(item['type']), run_name='__main__')
+    finally:
+        sys.argv = workerArgv
+
+def runWorker(itemsPath, resultsPath):
+    with open(itemsPath) as itemsFile:
+        items = json.load(itemsFile)
+
+    results = []
+
+    for item in items:
+        itemStartTime = time.time()
+
+        try:
+            prepareItem(item)
+            result = {'path': item['path'], 'status': 'ok'}
+        except Exception as error:
+            traceback.print_exc()
+            result = {'path': item['path'], 'status': 'error', 'error': str(error)}
+
+        result['time'] = time.time() - itemStartTime
+        results.append(result)
+
+        ## Written after every item so that a crash of Blender doesn't lose the results of the chunk
+        with open(resultsPath, 'w') as resultsFile:
+            json.dump(results, resultsFile)
+
+## Orchestrator, outside Blender
+
+def hashFile(filePath, digest):
+    with open(filePath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+# Hash of everything the output is built from: the prepare script, the input file and, for GLTF files,
+# the buffers and images they reference
+def computeInputHash(item, inputPath):
+    digest = hashlib.sha256()
+    digest.update(item['type'].encode())
+    hashFile(getScriptPath(item['type']), digest)
+    hashFile(inputPath, digest)
+
+    ## The object scripts also generate the levels of detail
+    if item['type'].startswith('object-'):
+        hashFile(path.join(rootPath, 'prepare-object-lods-file.py'), digest)
+
+    if inputPath.endswith('.gltf'):
+        with open(inputPath, encoding='utf-8') as gltfFile:
+            gltf = json.load(gltfFile)
+
+        for resource in gltf.get('buffers', []) + gltf.get('images', []):
+            uri = resource.get('uri')
+            if uri is not None and not uri.startswith('data:'):
+                hashFile(path.join(path.dirname(inputPath), unquote(uri)), digest)
+
+    return digest.hexdigest()
+
+def getRecordPath(item):
+    return getOutputPath(item) + '.prepared.json'
+
+def isUpToDate(item):
+    outputPath = getOutputPath(item)
+    recordPath = getRecordPath(item)
+
+    if not path.exists(outputPath) or not path.exists(recordPath):
+        return False
+
+    with open(recordPath) as recordFile:
+        record = json.load(recordFile)
+
+    if isLowQuality(item['type']):
+        if path.getmtime(outputPath) < path.getmtime(item['path']):
+            return False
+
+        return record.get('inputHash') == computeInputHash(item, item['path'])
+
+    ## The hq scripts modify the file in place, the hash recorded is the one of the prepared file
+    if path.getmtime(outputPath) > record.get('mtime', 0):
+        return False
+
+    return record.get('inputHash') == computeInputHash(item, outputPath)
+
+def writeRecord(item):
+    outputPath = getOutputPath(item)
+    inputPath = item['path'] if isLowQuality(item['type']) else outputPath
+
+    record = {
+        'type': item['type'],
+        'inputHash': computeInputHash(item, inputPath),
+        'mtime': path.getmtime(outputPath),
+    }
+
+    with open(getRecordPath(item), 'w') as recordFile:
+        json.dump(record, recordFile)
+
+def collectItems(source, prepareType):
+    if path.isdir(source):
+        if prepareType is None:
+            raise ValueError('--type is needed to prepare a directory')
+
+        suffix = '.gltf' if isLowQuality(prepareType) else '-hq.blend'
+        items = []
+
+        for (directoryPath, _, fileNames) in os.walk(source):
+            for fileName in sorted(fileNames):
+                if fileName.endswith(suffix):
+                    items.append({'type': prepareType, 'path': path.join(directoryPath, fileName)})
+
+        return items
+
+    with open(source) as manifestFile:
+        items = json.load(manifestFile)
+
+    for item in items:
+        item.setdefault('type', prepareType)
+        if item['type'] not in prepareTypes:
+            raise ValueError(f'Unknown prepare type {item["type"]} for {item["path"]}')
+
+    return items
+
+def runChunk(blenderPath, chunk, workPath, chunkIndex):
+    itemsPath = path.join(workPath, f'items-{chunkIndex}.json')
+    resultsPath = path.join(workPath, f'results-{chunkIndex}.json')
+
+    with open(itemsPath, 'w') as itemsFile:
+        json.dump(chunk, itemsFile)
+
+    subprocess.run([blenderPath, '-b', emptyFilePath, '--python', path.abspath(__file__), '--',
+                    '--worker', itemsPath, resultsPath])
+
+    results = []
+    if path.exists(resultsPath):
+        with open(resultsPath) as resultsFile:
+            results = json.load(resultsFile)
+
+    ## Items after a crash of Blender have no result
+    resultsByPath = {result['path']: result for result in results}
+    return [resultsByPath.get(item['path'], {'path': item['path'], 'status': 'error', 'error': 'Blender exited'})
+            for item in chunk]
+
+def runOrchestrator(argv):
+    def getArg(name, default=None):
+        return argv[argv.index(name) + 1] if name in argv else default
+
+    startTime = time.time()
+
+    prepareType = getArg('--type')
+    jobs = int(getArg('--jobs', os.cpu_count() or 1))
+    chunkSize = int(getArg('--chunk-size', 25))
+    blenderPath = getArg('--blender', 'blender')
+    force = '--force' in argv
+    source = argv[-1]
+
+    items = collectItems(source, prepareType)
+    pendingItems = [item for item in items if force or not isUpToDate(item)]
+    chunks = [pendingItems[index:index + chunkSize] for index in range(0, len(pendingItems), chunkSize)]
+
+    print(f'{len(items)} items, {len(items) - len(pendingItems)} up to date, {len(pendingItems)} to prepare '
+          f'in {len(chunks)} chunks with {jobs} Blender processes')
+
+    itemsByPath = {item['path']: item for item in pendingItems}
+    failures = []
+
+    with tempfile.TemporaryDirectory() as workPath, ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(runChunk, blenderPath, chunk, workPath, chunkIndex)
+                   for (chunkIndex, chunk) in enumerate(chunks)]
+
+        for future in futures:
+            for result in future.result():
+                if result['status'] == 'ok':
+                    writeRecord(itemsByPath[result['path']])
+                else:
+                    failures.append(result)
+                    print(f'Failed to prepare {result["path"]}: {result.get("error")}', file=sys.stderr)
+
+    print(f'--- prepare-batch.py execution time: {time.time() - startTime} seconds ---')
+    print(f'preparedCount: {len(pendingItems) - len(failures)}')
+    print(f'failedCount: {len(failures)}')
+
+    return 1 if failures else 0
+
+if bpy is not None:
+    workerArgs = sys.argv[sys.argv.index('--worker') + 1:]
+    runWorker(workerArgs[0], workerArgs[1])
+
+elif __name__ == '__main__':
+    sys.exit(runOrchestrator(sys.argv[1:]))
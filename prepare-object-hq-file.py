@@ -5,38 +5,216 @@ This allows us to find this object easily to append that blend file to the scene
 
 import bpy
 import bmesh
+import numpy as np
+import runpy
+from os import path
 
-# Join all meshes
-meshes = list(filter(lambda obj: obj.type == 'MESH', bpy.data.objects))
+## Mesh attributes the vectorized merge carries over, meshes with other attributes (or shape keys) go through the operators
+mergedAttributeNames = {'position', 'material_index', 'sharp_face'}
+
+def canMergeWithNumpy(meshes):
+    for obj in meshes:
+        mesh = obj.data
+
+        if mesh.shape_keys is not None:
+            return False
+
+        uvNames = {uvLayer.name for uvLayer in mesh.uv_layers}
+
+        for attribute in mesh.attributes:
+            if attribute.name.startswith('.') or attribute.name in mergedAttributeNames or attribute.name in uvNames:
+                continue
+
+            return False
+
+    return True
+
+def getCornerNormals(mesh):
+    normals = np.empty(len(mesh.loops) * 3, dtype=np.float32)
+
+    if hasattr(mesh, 'corner_normals'):
+        mesh.corner_normals.foreach_get('vector', normals)
+    else:
+        mesh.calc_normals_split()
+        mesh.loops.foreach_get('normal', normals)
+
+    return normals.reshape(-1, 3)
+
+# Merges the meshes with their world matrix applied, by concatenating their buffers with foreach_get/foreach_set
+def mergeMeshesWithNumpy(meshes):
+    uvNames = list(dict.fromkeys(uvLayer.name for obj in meshes for uvLayer in obj.data.uv_layers))
+    hasCustomNormals = any(obj.data.has_custom_normals for obj in meshes)
+
+    mergedMaterials = []
+    positions = []
+    cornerVertices = []
+    polygonSizes = []
+    materialIndices = []
+    smoothFaces = []
+    cornerUvs = {uvName: [] for uvName in uvNames}
+    cornerNormals = []
+    vertexOffset = 0
+
+    for obj in meshes:
+        mesh = obj.data
+        vertexCount = len(mesh.vertices)
+        loopCount = len(mesh.loops)
+        polygonCount = len(mesh.polygons)
+
+        matrix = np.array(obj.matrix_world, dtype=np.float64)
+        rotationScale = matrix[:3, :3]
+
+        ## Vertices, with the world matrix applied as one batched multiplication
+        co = np.empty(vertexCount * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', co)
+        positions.append(co.reshape(-1, 3) @ rotationScale.T + matrix[:3, 3])
+
+        ## Polygons
+        loopStarts = np.empty(polygonCount, dtype=np.int32)
+        loopTotals = np.empty(polygonCount, dtype=np.int32)
+        mesh.polygons.foreach_get('loop_start', loopStarts)
+        mesh.polygons.foreach_get('loop_total', loopTotals)
+
+        polygonMaterialIndices = np.empty(polygonCount, dtype=np.int32)
+        mesh.polygons.foreach_get('material_index', polygonMaterialIndices)
+
+        polygonSmooth = np.empty(polygonCount, dtype=bool)
+        mesh.polygons.foreach_get('use_smooth', polygonSmooth)
+
+        ## Order of the corners in the merged mesh: polygon after polygon, reversed when the world matrix has a
+        ## negative scale, so that the winding (and so the normals) stays outward without going through bmesh
+        polygonOffsets = np.cumsum(loopTotals) - loopTotals
+        cornerPositions = np.arange(loopCount) - np.repeat(polygonOffsets, loopTotals)
+
+        if np.linalg.det(rotationScale) < 0:
+            cornerPositions = np.repeat(loopTotals, loopTotals) - 1 - cornerPositions
+
+        cornerOrder = np.repeat(loopStarts, loopTotals) + cornerPositions
+
+        loopVertices = np.empty(loopCount, dtype=np.int32)
+        mesh.loops.foreach_get('vertex_index', loopVertices)
+        cornerVertices.append(loopVertices[cornerOrder] + vertexOffset)
+
+        for uvName in uvNames:
+            uvLayer = mesh.uv_layers.get(uvName)
+            uvs = np.zeros(loopCount * 2, dtype=np.float32)
+
+            if uvLayer is not None:
+                uvLayer.data.foreach_get('uv', uvs)
+
+            cornerUvs[uvName].append(uvs.reshape(-1, 2)[cornerOrder])
 
-if len(meshes) > 1:
-    with bpy.context.temp_override(active_object=meshes[0], selected_editable_objects=meshes):
-        bpy.ops.object.join()
+        if hasCustomNormals:
+            normalMatrix = np.linalg.inv(rotationScale).T
+            normals = getCornerNormals(mesh)[cornerOrder] @ normalMatrix.T
+            normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+            cornerNormals.append(normals)
 
-# Find the joined mesh, move it to root, and apply the transform
-joinedMesh = next(filter(lambda obj: obj.type == 'MESH', bpy.data.objects))
+        ## Materials, remapped from the slots of the object to the merged list of materials
+        slotMaterials = []
+        for slot in obj.material_slots:
+            if slot.material not in mergedMaterials:
+                mergedMaterials.append(slot.material)
+            slotMaterials.append(mergedMaterials.index(slot.material))
 
-with bpy.context.temp_override(active_object=joinedMesh, selected_objects=[joinedMesh]):
-    bpy.ops.object.parent_clear(type='CLEAR_KEEP_TRANSFORM')
-    bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
+        slotMap = np.array(slotMaterials or [0], dtype=np.int32)
+        materialIndices.append(slotMap[np.clip(polygonMaterialIndices, 0, len(slotMap) - 1)])
 
-# Recompute the normals to account for the negative scale
-bm = bmesh.new()
-bm.from_mesh(joinedMesh.data)
-bmesh.ops.recalc_face_normals(bm, faces=bm.faces)
-bm.to_mesh(joinedMesh.data)
-bm.clear()
-joinedMesh.data.update()
-bm.free()
+        polygonSizes.append(loopTotals)
+        smoothFaces.append(polygonSmooth)
+        vertexOffset += vertexCount
 
-# Delete all non-meshes objects
-nonMeshes = list(filter(lambda obj: obj.type != 'MESH', bpy.data.objects))
+    positions = np.concatenate(positions)
+    cornerVertices = np.concatenate(cornerVertices)
+    polygonSizes = np.concatenate(polygonSizes)
 
-with bpy.context.temp_override(active_object=None, selected_objects=nonMeshes):
-    bpy.ops.object.delete()
+    mergedMesh = bpy.data.meshes.new('__render_importObject')
+
+    mergedMesh.vertices.add(len(positions))
+    mergedMesh.vertices.foreach_set('co', positions.astype(np.float32).ravel())
+
+    mergedMesh.loops.add(len(cornerVertices))
+    mergedMesh.loops.foreach_set('vertex_index', cornerVertices)
+
+    mergedMesh.polygons.add(len(polygonSizes))
+    mergedMesh.polygons.foreach_set('loop_start', (np.cumsum(polygonSizes) - polygonSizes).astype(np.int32))
+
+    ## loop_total is read-only (and deduced from loop_start) since Blender 4.0
+    try:
+        mergedMesh.polygons.foreach_set('loop_total', polygonSizes)
+    except (AttributeError, TypeError, RuntimeError):
+        pass
+
+    mergedMesh.polygons.foreach_set('material_index', np.concatenate(materialIndices))
+    mergedMesh.polygons.foreach_set('use_smooth', np.concatenate(smoothFaces))
+
+    for uvName in uvNames:
+        uvLayer = mergedMesh.uv_layers.new(name=uvName)
+        uvLayer.data.foreach_set('uv', np.concatenate(cornerUvs[uvName]).ravel())
+
+    for material in mergedMaterials:
+        mergedMesh.materials.append(material)
+
+    mergedMesh.update(calc_edges=True)
+
+    if hasCustomNormals:
+        if hasattr(mergedMesh, 'use_auto_smooth'):
+            mergedMesh.use_auto_smooth = True
+
+        mergedMesh.normals_split_custom_set(np.concatenate(cornerNormals))
+
+    ## Replace all the objects of the file by the merged mesh
+    for obj in list(bpy.data.objects):
+        bpy.data.objects.remove(obj, do_unlink=True)
+
+    joinedMesh = bpy.data.objects.new('__render_importObject', mergedMesh)
+    bpy.context.scene.collection.objects.link(joinedMesh)
+
+    return joinedMesh
+
+def mergeMeshesWithOperators(meshes):
+    if len(meshes) > 1:
+        with bpy.context.temp_override(active_object=meshes[0], selected_editable_objects=meshes):
+            bpy.ops.object.join()
+
+    # Find the joined mesh, move it to root, and apply the transform
+    joinedMesh = next(filter(lambda obj: obj.type == 'MESH', bpy.data.objects))
+
+    with bpy.context.temp_override(active_object=joinedMesh, selected_objects=[joinedMesh]):
+        bpy.ops.object.parent_clear(type='CLEAR_KEEP_TRANSFORM')
+        bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
+
+    # Recompute the normals to account for the negative scale
+    bm = bmesh.new()
+    bm.from_mesh(joinedMesh.data)
+    bmesh.ops.recalc_face_normals(bm, faces=bm.faces)
+    bm.to_mesh(joinedMesh.data)
+    bm.clear()
+    joinedMesh.data.update()
+    bm.free()
+
+    # Delete all non-meshes objects
+    nonMeshes = list(filter(lambda obj: obj.type != 'MESH', bpy.data.objects))
+
+    with bpy.context.temp_override(active_object=None, selected_objects=nonMeshes):
+        bpy.ops.object.delete()
+
+    return joinedMesh
+
+# Join all meshes
+meshes = list(filter(lambda obj: obj.type == 'MESH', bpy.data.objects))
+
+if meshes and canMergeWithNumpy(meshes):
+    joinedMesh = mergeMeshesWithNumpy(meshes)
+else:
+    print('Meshes with shape keys or extra attributes, join them with the operators')
+    joinedMesh = mergeMeshesWithOperators(meshes)
 
 # Change the name of the joined mesh
 joinedMesh.name = "__render_importObject"
 
 # Save
-bpy.ops.wm.save_mainfile()
\ No newline at end of file
+bpy.ops.wm.save_mainfile()
+
+# Generate the levels of detail next to the saved file
+runpy.run_path(path.join(path.dirname(path.abspath(__file__)), 'prepare-object-lods-file.py'))
@@ -0,0 +1,68 @@
+"""
+Generates decimated levels of detail of the __render_importObject of the opened file, next to it:
+{file}-lod1.blend, {file}-lod2.blend... each with its own __render_importObject, and {file}-lods.json with
+the triangle count of each level and the bounds of the object, used by the import to pick a level from
+the size of the object on screen
+
+It is run by the prepare-object scripts once they saved their file
+"""
+
+import bpy
+import json
+import os
+from mathutils import Vector
+
+## Ratio of the triangles kept by each level, levels that don't remove enough triangles are not generated
+lodRatios = (0.3, 0.08)
+lodMinReduction = 0.8
+
+def countTriangles(mesh):
+    mesh.calc_loop_triangles()
+    return len(mesh.loop_triangles)
+
+blendFilePath = bpy.data.filepath
+sourceObject = bpy.data.objects['__render_importObject']
+
+levels = [{'file': os.path.basename(blendFilePath), 'triangles': countTriangles(sourceObject.data)}]
+
+## Bounds in the space of the file, which is the space of the asset null once imported
+corners = [sourceObject.matrix_world @ Vector(corner) for corner in sourceObject.bound_box]
+bounds = [[min(corner[axis] for corner in corners) for axis in range(3)],
+          [max(corner[axis] for corner in corners) for axis in range(3)]]
+
+## The levels are written with the same object name, the source is renamed meanwhile
+sourceObject.name = '__render_lodSource'
+
+try:
+    for (lodLevel, lodRatio) in enumerate(lodRatios, 1):
+        modifier = sourceObject.modifiers.new('__render_lod', 'DECIMATE')
+        modifier.decimate_type = 'COLLAPSE'
+        modifier.ratio = lodRatio
+
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        lodMesh = bpy.data.meshes.new_from_object(sourceObject.evaluated_get(depsgraph),
+                                                  preserve_all_data_layers=True, depsgraph=depsgraph)
+        sourceObject.modifiers.remove(modifier)
+
+        triangles = countTriangles(lodMesh)
+
+        if triangles >= levels[-1]['triangles'] * lodMinReduction:
+            bpy.data.meshes.remove(lodMesh)
+            break
+
+        lodObject = bpy.data.objects.new('__render_importObject', lodMesh)
+        lodObject.matrix_world = sourceObject.matrix_world
+
+        lodFilePath = blendFilePath.replace('.blend', f'-lod{lodLevel}.blend')
+        bpy.data.libraries.write(lodFilePath, {lodObject}, path_remap='RELATIVE')
+
+        bpy.data.objects.remove(lodObject, do_unlink=True)
+        bpy.data.meshes.remove(lodMesh)
+
+        levels.append({'file': os.path.basename(lodFilePath), 'triangles': triangles})
+        print(f'Level of detail {lodLevel}: {triangles} triangles')
+finally:
+    sourceObject.name = '__render_importObject'
+
+with open(blendFilePath.replace('.blend', '-lods.json'), 'w') as lodsFile:
+    json.dump({'bounds': bounds, 'levels': levels}, lodsFile)
@@ -3,8 +3,10 @@ Imports a GLTF file, joins all meshes, and saves the blend file at the same plac
 """
 
 import bpy
+import runpy
 import sys
 import bmesh
+from os import path
 
 argv = sys.argv
 argv = argv[argv.index("--") + 1:] # get all args after "--"
@@ -38,3 +40,6 @@ joinedMesh.name = "__render_importObject"
 
 
 bpy.ops.wm.save_mainfile(filepath=gltfPath.replace('.gltf', '.blend'))
+
+# Generate the levels of detail next to the saved file
+runpy.run_path(path.join(path.dirname(path.abspath(__file__)), 'prepare-object-lods-file.py'))
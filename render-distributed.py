@@ -0,0 +1,382 @@
+"""
+Renders one frame of a prepared scene with several Blender processes and merges their parts into the final image
+
+    python render-distributed.py --scene-environment exterior --session xxx --parts 4 --jobs 4 \
+        --render-args --cycles-device CPU --position x,y,z --orientation x,y,z --camera perspective,... \
+        --sun-orientation x,y,z --render-tier final
+
+Every part opens cache/scene-{env}-{session}.blend, runs render-scene-fast.py with the --render-args (camera,
+sun, render tier...) and renders its share of the frame:
+
+- regions (default): a horizontal band of the frame, rendered with a margin around it so that the pixel filter
+  sees the same neighbourhood as in a single render, the margin is cropped when stitching. Cycles samples and
+  adaptively stops each pixel the same way whatever the border, so the stitched frame is the one of a single render
+- samples: a range of the samples of the whole frame (Cycles sample offset), the parts are averaged by their
+  sample count. The adaptive sampling can't be split that way, it is turned off
+
+The parts are rendered without denoising, with their albedo and normal passes. Once all the parts are rendered, a
+last Blender process merges them, denoises the whole frame once from the merged passes, runs the compositor of the
+scene on it and saves it like -o //Result#### -f 1 (or --output) with the color management and the file format of
+the scene.
+
+What still differs from a single-process render:
+
+- the merged frame is denoised by the compositor with OpenImageDenoise, even when the scene uses the OptiX denoiser
+- a render time budget applies to each part, which then gets more samples than a single render would
+- samples: no adaptive sampling, the frame gets all the samples of the scene, and the noise pattern differs
+- the compositor only gets the Image and Alpha outputs of the Render Layers nodes, the other passes are not
+  merged and are left out
+
+The parts run as local Blender processes (--executor local, each one with its share of the CPU threads), or
+through a command (--executor command --executor-command "ssh render-{index} cd /srv/mdc-render-package && {command}")
+for remote nodes, which then need the package and its cache/ directory on a shared file system.
+
+Inside Blender (--part or --merge), the script renders one part, or merges the parts.
+"""
+
+import json
+import os
+import runpy
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+rootPath = path.dirname(path.abspath(__file__))
+
+splitModes = ('regions', 'samples')
+
+def getArg(argv, name, default=None):
+    return argv[argv.index(name) + 1] if name in argv else default
+
+def getPartPath(workPath, partIndex):
+    return path.join(workPath, f'part-{partIndex:03d}')
+
+## Worker, inside Blender
+
+def getRenderSize(scene):
+    ## Same integer size as the one Cycles renders
+    return (scene.render.resolution_x * scene.render.resolution_percentage // 100,
+            scene.render.resolution_y * scene.render.resolution_percentage // 100)
+
+# Fraction of the frame for a border starting on a pixel, Blender truncates border * size to get the pixel back
+def getBorderFraction(pixel, size):
+    if pixel <= 0:
+        return 0
+    if pixel >= size:
+        return 1
+
+    return (pixel + 0.5) / size
+
+## Passes the denoiser needs besides the image, and the outputs of the Render Layers node they come from
+denoisingPasses = {'albedo': 'Denoising Albedo', 'normal': 'Denoising Normal'}
+
+# Replaces the compositor of the part with one that passes the image through and writes the denoising passes next
+# to it, as {partPath}-albedo-0001.exr and {partPath}-normal-0001.exr
+def writeDenoisingPasses(scene, partPath):
+    bpy.context.view_layer.cycles.denoising_store_passes = True
+
+    scene.use_nodes = True
+    nodeTree = scene.node_tree
+    nodeTree.nodes.clear()
+
+    renderLayers = nodeTree.nodes.new('CompositorNodeRLayers')
+    composite = nodeTree.nodes.new('CompositorNodeComposite')
+    nodeTree.links.new(renderLayers.outputs['Image'], composite.inputs['Image'])
+
+    fileOutput = nodeTree.nodes.new('CompositorNodeOutputFile')
+    fileOutput.base_path = partPath + '-'
+    fileOutput.format.file_format = 'OPEN_EXR'
+    fileOutput.format.color_depth = '32'
+    fileOutput.file_slots.clear()
+
+    for (passName, outputName) in denoisingPasses.items():
+        fileOutput.file_slots.new(f'{passName}-####')
+        nodeTree.links.new(renderLayers.outputs[outputName], fileOutput.inputs[-1])
+
+    scene.render.use_compositing = True
+
+def renderPart(partArgs, renderArgs):
+    scene = bpy.context.scene
+
+    partIndex = int(getArg(partArgs, '--part'))
+    parts = int(getArg(partArgs, '--parts'))
+    splitMode = getArg(partArgs, '--split', 'regions')
+    margin = int(getArg(partArgs, '--margin', 32))
+    partPath = getArg(partArgs, '--part-path')
+
+    ## Camera, sun and render tier, like a fast render
+    workerArgv = sys.argv
+    sys.argv = [workerArgv[0], '--', *renderArgs]
+
+    try:
+        runpy.run_path(path.join(rootPath, 'render-scene-fast.py'), run_name='__main__')
+    finally:
+        sys.argv = workerArgv
+
+    (width, height) = getRenderSize(scene)
+    part = {'index': partIndex, 'width': width, 'height': height, 'samples': scene.cycles.samples,
+            'denoise': scene.cycles.use_denoising, 'denoisePrefilter': scene.cycles.denoising_prefilter}
+
+    ## The frame is denoised once merged, from the albedo and normal passes of the parts
+    scene.cycles.use_denoising = False
+
+    if splitMode == 'regions':
+        ## Bands of the frame, from the bottom like the pixels of the images
+        bandStart = height * partIndex // parts
+        bandEnd = height * (partIndex + 1) // parts
+        renderStart = max(bandStart - margin, 0)
+        renderEnd = min(bandEnd + margin, height)
+
+        scene.render.use_border = True
+        scene.render.use_crop_to_border = True
+        scene.render.border_min_x = 0
+        scene.render.border_max_x = 1
+        scene.render.border_min_y = getBorderFraction(renderStart, height)
+        scene.render.border_max_y = getBorderFraction(renderEnd, height)
+
+        part.update({'bandStart': bandStart, 'bandEnd': bandEnd, 'renderStart': renderStart})
+
+    else:
+        samples = scene.cycles.samples
+        sampleStart = samples * partIndex // parts
+        sampleEnd = samples * (partIndex + 1) // parts
+
+        ## The slices must add up to exactly the samples of the frame
+        scene.cycles.use_adaptive_sampling = False
+        scene.cycles.time_limit = 0
+        scene.cycles.sample_offset = sampleStart
+        scene.cycles.samples = max(sampleEnd - sampleStart, 1)
+
+        part.update({'samples': sampleEnd - sampleStart})
+
+    ## Parts are kept linear and in full float, the view transform is applied once merged
+    scene.render.use_compositing = False
+    scene.render.use_sequencer = False
+    scene.render.use_file_extension = True
+    scene.render.image_settings.file_format = 'OPEN_EXR'
+    scene.render.image_settings.color_depth = '32'
+    scene.render.filepath = partPath + '-####'
+    scene.frame_set(1)
+
+    if part['denoise']:
+        writeDenoisingPasses(scene, partPath)
+
+    if part['samples'] > 0:
+        bpy.ops.render.render(write_still=True)
+        part['file'] = bpy.path.abspath(scene.render.frame_path(frame=1))
+
+        if part['denoise']:
+            part.update({f'{passName}File': f'{partPath}-{passName}-0001.exr' for passName in denoisingPasses})
+
+    with open(partPath + '.json', 'w') as partFile:
+        json.dump(part, partFile)
+
+def mergeParts(mergeArgs):
+    import numpy as np
+
+    scene = bpy.context.scene
+    workPath = getArg(mergeArgs, '--work-path')
+    parts = int(getArg(mergeArgs, '--parts'))
+    splitMode = getArg(mergeArgs, '--split', 'regions')
+    output = getArg(mergeArgs, '--output', '//Result####')
+
+    partRecords = []
+    for partIndex in range(parts):
+        with open(getPartPath(workPath, partIndex) + '.json') as partFile:
+            partRecords.append(json.load(partFile))
+
+    width = partRecords[0]['width']
+    height = partRecords[0]['height']
+    totalSamples = sum(part['samples'] for part in partRecords)
+    denoise = partRecords[0]['denoise']
+
+    ## The image, then the albedo and the normal when the frame is denoised, stitched or averaged the same way
+    fileKeys = ['file', *(f'{passName}File' for passName in denoisingPasses)] if denoise else ['file']
+    mergedPixels = {fileKey: np.zeros((height, width, 4), dtype=np.float32) for fileKey in fileKeys}
+
+    for part in partRecords:
+        if 'file' not in part:
+            continue
+
+        for fileKey in fileKeys:
+            partImage = bpy.data.images.load(part[fileKey])
+            (partWidth, partHeight) = partImage.size
+            partPixels = np.empty(partWidth * partHeight * 4, dtype=np.float32)
+            partImage.pixels.foreach_get(partPixels)
+            partPixels = partPixels.reshape(partHeight, partWidth, 4)
+            bpy.data.images.remove(partImage)
+
+            pixels = mergedPixels[fileKey]
+
+            if splitMode == 'regions':
+                bandOffset = part['bandStart'] - part['renderStart']
+                pixels[part['bandStart']:part['bandEnd']] = partPixels[bandOffset:bandOffset + part['bandEnd'] - part['bandStart']]
+            else:
+                pixels += partPixels * (part['samples'] / totalSamples)
+
+    mergedImages = {}
+    for (fileKey, pixels) in mergedPixels.items():
+        mergedImage = bpy.data.images.new(f'__render_distributed-{fileKey}', width, height, alpha=True, float_buffer=True)
+        mergedImage.pixels.foreach_set(pixels.ravel())
+        mergedImages[fileKey] = mergedImage
+
+    scene.render.filepath = output
+    scene.frame_set(1)
+    outputPath = bpy.path.abspath(scene.render.frame_path(frame=1))
+
+    renderLayersNodes = [node for node in scene.node_tree.nodes if node.bl_idname == 'CompositorNodeRLayers'] \
+        if scene.use_nodes and scene.node_tree is not None else []
+
+    if renderLayersNodes or denoise:
+        ## The compositor of the scene runs on the merged frame: its Render Layers nodes are replaced by the merged
+        ## image, and without them Blender only composites instead of rendering the scene again
+        if not renderLayersNodes:
+            scene.use_nodes = True
+            scene.node_tree.nodes.clear()
+            composite = scene.node_tree.nodes.new('CompositorNodeComposite')
+
+        nodeTree = scene.node_tree
+        imageNode = nodeTree.nodes.new('CompositorNodeImage')
+        imageNode.image = mergedImages['file']
+        imageOutput = imageNode.outputs['Image']
+
+        ## Denoised once, over the whole frame, like a single render
+        if denoise:
+            denoiseNode = nodeTree.nodes.new('CompositorNodeDenoise')
+            denoiseNode.use_hdr = True
+            denoiseNode.prefilter = partRecords[0]['denoisePrefilter']
+            nodeTree.links.new(imageOutput, denoiseNode.inputs['Image'])
+
+            for (passName, inputName) in (('albedo', 'Albedo'), ('normal', 'Normal')):
+                passNode = nodeTree.nodes.new('CompositorNodeImage')
+                passNode.image = mergedImages[f'{passName}File']
+                nodeTree.links.new(passNode.outputs['Image'], denoiseNode.inputs[inputName])
+
+            imageOutput = denoiseNode.outputs['Image']
+
+        if not renderLayersNodes:
+            nodeTree.links.new(imageOutput, composite.inputs['Image'])
+
+        for renderLayersNode in renderLayersNodes:
+            for renderOutput in renderLayersNode.outputs:
+                for link in list(renderOutput.links):
+                    if renderOutput.name == 'Image':
+                        nodeTree.links.new(imageOutput, link.to_socket)
+                    elif renderOutput.name == 'Alpha':
+                        nodeTree.links.new(imageNode.outputs['Alpha'], link.to_socket)
+                    else:
+                        print(f'The {renderOutput.name} pass of {renderLayersNode.name} is not rendered by the parts, '
+                              f'it is left out of the compositing', file=sys.stderr)
+
+            nodeTree.nodes.remove(renderLayersNode)
+
+        scene.render.use_compositing = True
+        scene.render.use_border = False
+        scene.render.resolution_x = width
+        scene.render.resolution_y = height
+        scene.render.resolution_percentage = 100
+
+        ## Saved with the format and the view transform of the scene, like a render written with -o
+        bpy.ops.render.render(write_still=True)
+    else:
+        mergedImages['file'].save_render(outputPath, scene=scene)
+
+    print(f'Merged {parts} parts into {outputPath}')
+
+## Orchestrator, outside Blender
+
+def runLocalPart(command, partIndex):
+    return subprocess.run(command).returncode
+
+def makeCommandExecutor(commandTemplate):
+    def runCommandPart(command, partIndex):
+        remoteCommand = commandTemplate.format(index=partIndex, command=shlex.join(command))
+        return subprocess.run(remoteCommand, shell=True).returncode
+
+    return runCommandPart
+
+def runOrchestrator(argv):
+    startTime = time.time()
+
+    ## Arguments given to render-scene-fast.py, after --render-args
+    renderArgs = argv[argv.index('--render-args') + 1:] if '--render-args' in argv else []
+    optionArgs = argv[:argv.index('--render-args')] if '--render-args' in argv else argv
+
+    sceneEnvironment = getArg(optionArgs, '--scene-environment')
+    session = getArg(optionArgs, '--session')
+    parts = int(getArg(optionArgs, '--parts', 4))
+    jobs = int(getArg(optionArgs, '--jobs', parts))
+    splitMode = getArg(optionArgs, '--split', 'regions')
+    margin = getArg(optionArgs, '--margin', '32')
+    output = getArg(optionArgs, '--output', '//Result####')
+    blenderPath = getArg(optionArgs, '--blender', 'blender')
+    executorName = getArg(optionArgs, '--executor', 'local')
+
+    if splitMode not in splitModes:
+        raise ValueError(f'Unknown split mode {splitMode}, expected one of {", ".join(splitModes)}')
+
+    if executorName == 'local':
+        runPart = runLocalPart
+        ## Local processes share the CPU instead of each starting one thread per core
+        threadArgs = ['-t', str(max((os.cpu_count() or 1) // min(jobs, parts), 1))]
+    elif executorName == 'command':
+        runPart = makeCommandExecutor(getArg(optionArgs, '--executor-command'))
+        threadArgs = []
+    else:
+        raise ValueError(f'Unknown executor {executorName}')
+
+    scenePath = path.abspath(path.join('cache', f'scene-{sceneEnvironment}-{session}.blend'))
+    workPath = path.abspath(path.join('cache', f'distributed-{sceneEnvironment}-{session}'))
+    os.makedirs(workPath, exist_ok=True)
+
+    ## Parts of a previous render must not be taken for the ones of this render
+    for entry in os.scandir(workPath):
+        if entry.name.startswith('part-'):
+            os.remove(entry.path)
+
+    scriptPath = path.abspath(__file__)
+    sceneArgs = ['--scene-environment', sceneEnvironment, '--session', session]
+
+    def buildPartCommand(partIndex):
+        return [blenderPath, '-b', scenePath, *threadArgs, '--python', scriptPath, '--',
+                '--part', str(partIndex), '--parts', str(parts), '--split', splitMode, '--margin', margin,
+                '--part-path', getPartPath(workPath, partIndex), '--render-args', *sceneArgs, *renderArgs]
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        returnCodes = list(executor.map(lambda partIndex: runPart(buildPartCommand(partIndex), partIndex), range(parts)))
+
+    failedParts = [partIndex for (partIndex, returnCode) in enumerate(returnCodes)
+                   if returnCode != 0 or not path.exists(getPartPath(workPath, partIndex) + '.json')]
+
+    if failedParts:
+        print(f'Failed to render parts {failedParts}', file=sys.stderr)
+        return 1
+
+    ## The output path is relative to the scene, like -o
+    mergeCommand = [blenderPath, '-b', scenePath, '--python', scriptPath, '--',
+                    '--merge', '--work-path', workPath, '--parts', str(parts), '--split', splitMode, '--output', output]
+    returnCode = subprocess.run(mergeCommand).returncode
+
+    print(f'--- render-distributed.py execution time: {time.time() - startTime} seconds ---')
+
+    return returnCode
+
+if bpy is not None:
+    blenderArgs = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+
+    if '--merge' in blenderArgs:
+        mergeParts(blenderArgs)
+    else:
+        partRenderArgs = blenderArgs[blenderArgs.index('--render-args') + 1:]
+        renderPart(blenderArgs[:blenderArgs.index('--render-args')], partRenderArgs)
+
+elif __name__ == '__main__':
+    sys.exit(runOrchestrator(sys.argv[1:]))
@@ -0,0 +1,30 @@
+# Noeuds de culling de l'herbe, partagés par render-scene-import.py et render-scene-fast.py
+#
+# setupGrassCulling (render-scene-import.py) ajoute au groupe ScatterGrassAndFlowers des noeuds qui lisent la
+# caméra et son frustum, refreshGrassCulling les met à jour à chaque changement de caméra. Les scripts le chargent
+# avec runpy.run_path, comme render-distributed.py charge render-scene-fast.py.
+
+import bpy
+
+# Points the grass culling nodes to the camera and its frustum
+def refreshGrassCulling(camera):
+    grassNodeGroup = bpy.data.node_groups.get('ScatterGrassAndFlowers')
+
+    if grassNodeGroup is None or '__render_grassCullCamera' not in grassNodeGroup.nodes:
+        return
+
+    nodes = grassNodeGroup.nodes
+
+    ## Corners of the frame in the camera space, at a unit distance for perspective cameras
+    frame = camera.data.view_frame(scene=bpy.context.scene)
+    frameX = max(abs(corner.x) for corner in frame)
+    frameY = max(abs(corner.y) for corner in frame)
+    frameZ = abs(frame[0].z)
+    isPerspective = camera.data.type == 'PERSP'
+
+    nodes['__render_grassCullCamera'].inputs['Object'].default_value = camera
+    nodes['__render_grassCullTanX'].outputs[0].default_value = frameX / frameZ if isPerspective else 0
+    nodes['__render_grassCullTanY'].outputs[0].default_value = frameY / frameZ if isPerspective else 0
+    nodes['__render_grassCullHalfWidth'].outputs[0].default_value = 0 if isPerspective else frameX
+    nodes['__render_grassCullHalfHeight'].outputs[0].default_value = 0 if isPerspective else frameY
+    nodes['__render_grassCullPerspective'].outputs[0].default_value = 1 if isPerspective else 0
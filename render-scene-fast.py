@@ -1,10 +1,22 @@
 # Ce script va s'occuper de faire juste le changement de caméra pour le rendu
+#
+# Avec --views job.json, il rend lui-même plusieurs vues de la scène dans le même process :
+# {"views": [{"position": "x,y,z", "orientation": "x,y,z", "camera": "perspective,...", "sunOrientation": "x,y,z",
+#             "output": "//Result-front-####"}, ...]}
+# Les champs absents d'une vue reprennent ceux de la vue précédente, ou ceux de la ligne de commande.
+#
+# Avec --render-tier preview|standard|final, il règle l'échantillonnage, la résolution et le débruitage au lieu
+# de garder ceux du template, et avec --render-time-budget secondes, le rendu s'arrête au bout de ce temps
+# (compté depuis le lancement du script, ou depuis le début de la vue en mode batch).
+# Une vue peut aussi avoir son propre "renderTier" et son propre "renderTimeBudget".
 
 import bpy
 import idprop.types
+import json
 import math
 import mathutils
 import re
+import runpy
 import sys
 import time
 from os import path
@@ -19,66 +31,152 @@ sceneEnvironment = argv[argv.index('--scene-environment') + 1]
 isInterior = sceneEnvironment == 'interior'
 isNightly = sceneEnvironment == 'nightly'
 
+def getArg(name, default=None):
+    return argv[argv.index(name) + 1] if name in argv else default
+
 session = argv[argv.index('--session') + 1]
-positionArg = argv[argv.index('--position') + 1]
-orientationArg = argv[argv.index('--orientation') + 1]
-cameraArg = argv[argv.index('--camera') + 1]
-sunOrientationArg = argv[argv.index('--sun-orientation') + 1]
-
-# Transforme le positionArgs en 3 flottant x y z
-positionValues = positionArg.split(",")
-positionX, positionY, positionZ = map(float, positionValues)
-orientationValues = orientationArg.split(",")
-orientationX, orientationY, orientationZ = map(float, orientationValues)
-sunOrientationValues = sunOrientationArg.split(",")
-sunOrientationX, sunOrientationY, sunOrientationZ = map(float, sunOrientationValues)
-
-cameraValues = cameraArg.split(",")
-cameraType = cameraValues[0]
-
-# Supprime toutes les caméras existantes
-bpy.ops.object.select_all(action='DESELECT')
-bpy.ops.object.select_by_type(type='CAMERA')
-bpy.ops.object.delete()
-
-bpy.ops.object.camera_add(location=(positionX, positionY, positionZ),
-                          rotation=(orientationX, orientationY, orientationZ))
-
-camera = bpy.context.active_object
-
-# creation de la caméra en fonction du type
-if cameraType == 'perspective':
-    aspectRatio = cameraValues[1]
-    fov = cameraValues[2]
-    znear = cameraValues[3]
-    zfar = cameraValues[4]
-
-    camera.data.type = 'PERSP'
-    camera.data.lens_unit = 'FOV'
-    camera.data.sensor_fit = 'VERTICAL'
-    camera.data.angle = float(fov)
-    camera.data.clip_start = float(znear)
-    camera.data.clip_end = float(zfar)
+positionArg = getArg('--position')
+orientationArg = getArg('--orientation')
+cameraArg = getArg('--camera')
+sunOrientationArg = getArg('--sun-orientation')
+viewsArg = getArg('--views')
+renderTierArg = getArg('--render-tier')
+renderTimeBudgetArg = getArg('--render-time-budget')
+cyclesDevice = getArg('--cycles-device', 'CPU')
+
+# Supprime toutes les caméras existantes et en crée une nouvelle
+def createCamera():
+    bpy.ops.object.select_all(action='DESELECT')
+    bpy.ops.object.select_by_type(type='CAMERA')
+    bpy.ops.object.delete()
+
+    bpy.ops.object.camera_add()
+
+    camera = bpy.context.active_object
+    bpy.context.scene.camera = camera
+
+    return camera
+
+def applyCamera(camera, positionArg, orientationArg, cameraArg):
+    # Transforme le positionArgs en 3 flottant x y z
+    positionValues = positionArg.split(",")
+    positionX, positionY, positionZ = map(float, positionValues)
+    orientationValues = orientationArg.split(",")
+    orientationX, orientationY, orientationZ = map(float, orientationValues)
+
+    cameraValues = cameraArg.split(",")
+    cameraType = cameraValues[0]
+
+    camera.location = (positionX, positionY, positionZ)
+    camera.rotation_euler = Euler((orientationX, orientationY, orientationZ), 'XYZ')
+
+    # creation de la caméra en fonction du type
+    if cameraType == 'perspective':
+        aspectRatio = cameraValues[1]
+        fov = cameraValues[2]
+        znear = cameraValues[3]
+        zfar = cameraValues[4]
+
+        camera.data.type = 'PERSP'
+        camera.data.lens_unit = 'FOV'
+        camera.data.sensor_fit = 'VERTICAL'
+        camera.data.angle = float(fov)
+        camera.data.clip_start = float(znear)
+        camera.data.clip_end = float(zfar)
+
+    else:
+        znear = cameraValues[1]
+        zfar = cameraValues[2]
+        xmag = cameraValues[3]
+        ymag = cameraValues[4]
+
+        camera.data.type = 'ORTHO'
+        camera.data.ortho_scale = float(xmag)
+        camera.data.clip_start = float(znear)
+        camera.data.clip_end = float(zfar)
+
+# Les noeuds de culling de l'herbe suivent la caméra (voir setupGrassCulling dans render-scene-import.py)
+refreshGrassCulling = runpy.run_path(path.join(path.dirname(path.abspath(__file__)), 'render-grass-culling.py'))['refreshGrassCulling']
+
+# on change la position du soleil
+def applySun(sunOrientationArg):
+    sunOrientationValues = sunOrientationArg.split(",")
+    sunOrientationX, sunOrientationY, sunOrientationZ = map(float, sunOrientationValues)
+
+    sun = bpy.data.objects["__render_sun"]
+    sun.data.energy = 0
+    sun.rotation_euler = Euler((sunOrientationX, sunOrientationY, sunOrientationZ), 'XYZ')
+    sceneSunRotation = sunOrientationZ
+    hdrMapSunRotation = 0.86924
+
+    bpy.data.worlds["World"].node_tree.nodes["Mapping"].inputs[2].default_value[2] = hdrMapSunRotation - sceneSunRotation
+
+# Les paliers de rendu, avec les réglages du template remis avant chaque vue (voir render-tiers.py)
+applyRenderTier = runpy.run_path(path.join(path.dirname(path.abspath(__file__)), 'render-tiers.py'))['applyRenderTier']
+
+## Paths of the images rendered by this script in batch mode
+renderedOutputs = []
+
+if viewsArg is None:
+    camera = createCamera()
+    applyCamera(camera, positionArg, orientationArg, cameraArg)
+    refreshGrassCulling(camera)
+    applySun(sunOrientationArg)
+    applyRenderTier(renderTierArg, renderTimeBudgetArg, startTime, cyclesDevice)
 
 else:
-    znear = cameraValues[1]
-    zfar = cameraValues[2]
-    xmag = cameraValues[3]
-    ymag = cameraValues[4]
+    with open(viewsArg) as viewsFile:
+        views = json.load(viewsFile)
 
-    camera.data.type = 'ORTHO'
-    camera.data.ortho_scale = float(xmag)
-    camera.data.clip_start = float(znear)
-    camera.data.clip_end = float(zfar)
+    if isinstance(views, dict):
+        views = views['views']
 
-bpy.context.scene.camera = camera
+    ## Chaque vue doit avoir une caméra complète, la sienne, celle d'une vue précédente ou celle de la ligne de commande
+    viewCameraArgs = {'position': positionArg, 'orientation': orientationArg, 'camera': cameraArg}
 
-# on change la position du soleil
-sun = bpy.data.objects["__render_sun"]
-sun.data.energy = 0
-sun.rotation_euler = Euler((sunOrientationX, sunOrientationY, sunOrientationZ), 'XYZ')
-sceneSunRotation = sunOrientationZ
-hdrMapSunRotation = 0.86924
+    for (viewIndex, view) in enumerate(views):
+        viewCameraArgs.update({fieldName: view[fieldName] for fieldName in viewCameraArgs if fieldName in view})
+        missingFields = [fieldName for (fieldName, value) in viewCameraArgs.items() if value is None]
+
+        if missingFields:
+            raise ValueError(f'View {viewIndex} of {viewsArg} has no {", ".join(missingFields)}, '
+                             f'and neither do the previous views nor the command line')
+
+    scene = bpy.context.scene
+
+    ## Cycles keeps the synced scene and its BVH between the renders of the views, only the camera,
+    ## the sun and the world mapping change from one view to the next
+    scene.render.use_persistent_data = True
+    scene.render.use_file_extension = True
+
+    camera = createCamera()
+    appliedCamera = None
+    appliedSun = None
+
+    for (viewIndex, view) in enumerate(views):
+        viewStartTime = time.time()
+
+        positionArg = view.get('position', positionArg)
+        orientationArg = view.get('orientation', orientationArg)
+        cameraArg = view.get('camera', cameraArg)
+        sunOrientationArg = view.get('sunOrientation', sunOrientationArg)
+
+        ## Only touch what changed, so that sun-only views don't even move the camera
+        if appliedCamera != (positionArg, orientationArg, cameraArg):
+            applyCamera(camera, positionArg, orientationArg, cameraArg)
+            refreshGrassCulling(camera)
+            appliedCamera = (positionArg, orientationArg, cameraArg)
+
+        if sunOrientationArg is not None and appliedSun != sunOrientationArg:
+            applySun(sunOrientationArg)
+            appliedSun = sunOrientationArg
+
+        applyRenderTier(view.get('renderTier', renderTierArg), view.get('renderTimeBudget', renderTimeBudgetArg), viewStartTime, cyclesDevice)
+
+        scene.render.filepath = view.get('output', f'//Result-{viewIndex:03d}-####')
+        bpy.ops.render.render(write_still=True)
+
+        renderedOutputs.append(bpy.path.abspath(scene.render.frame_path(frame=scene.frame_current)))
+        print(f'Rendered view {viewIndex} in {time.time() - viewStartTime} seconds')
 
-bpy.data.worlds["World"].node_tree.nodes["Mapping"].inputs[2].default_value[2] = hdrMapSunRotation - sceneSunRotation
 print(f'--- render-scene-fast-import.py execution time: {time.time() - startTime} seconds ---')
@@ -4,18 +4,77 @@ Imports the scene and sets everything as needed for the render
 """
 
 import bpy
+import hashlib
 import idprop.types
+import json
+import logging
 import math
 import mathutils
+import os
 import re
+import runpy
+import shutil
+import struct
 import sys
+import threading
 import time
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from os import path
-from mathutils import Matrix, Vector
+from urllib.parse import unquote
+from mathutils import Matrix, Quaternion, Vector
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 startTime = time.time()
 
+## Wall time spent in each import stage, printed at the end of the script, and resident set size of the process
+## at the end of each stage and its growth during the stage, written to the profile report. Stages run several times
+## add up, the phases run inside another stage (palettes in objectAssets, glass in objectRules) are also counted in it
+stageTimings = {}
+stageRss = {}
+stageRssDeltas = {}
+
+# Peak resident set size of the process in bytes, None where the OS doesn't report it
+def getPeakRss():
+    if resource is None:
+        return None
+
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peakRss if sys.platform == 'darwin' else peakRss * 1024
+
+# Current resident set size of the process in bytes, None where the OS doesn't report it
+def getCurrentRss():
+    try:
+        with open('/proc/self/statm') as statmFile:
+            residentPages = int(statmFile.read().split()[1])
+    except OSError:
+        return None
+
+    return residentPages * os.sysconf('SC_PAGE_SIZE')
+
+@contextmanager
+def timedStage(stageName):
+    stageStartTime = time.time()
+    stageStartRss = getCurrentRss()
+    try:
+        yield
+    finally:
+        stageTimings[stageName] = stageTimings.get(stageName, 0) + time.time() - stageStartTime
+        stageEndRss = getCurrentRss()
+        stageRss[stageName] = stageEndRss
+        if stageEndRss is not None and stageStartRss is not None:
+            stageRssDeltas[stageName] = stageRssDeltas.get(stageName, 0) + stageEndRss - stageStartRss
+
 argv = sys.argv
 
 #argv = ['--scene-environment', 'interior', '--position', '-1.570920,-0.760569,1', '--orientation', '1.570797,7.4503,-1.0471', '--camera', 'perspective,1.7777,1.09955,0.1,11.395', '--session', 'DEBUGGING']
@@ -27,10 +86,30 @@ orientationArg = argv[argv.index('--orientation') + 1]
 cameraArg = argv[argv.index('--camera') + 1]
 
 session = argv[argv.index('--session') + 1]
-## Import the GLTF scene exported from mDC Designer
-sceneFilePath = path.join(path.dirname(bpy.data.filepath), 'myDecoCloud_scene', 'myDecoCloud_scene.gltf')
 
-bpy.ops.import_scene.gltf(filepath=sceneFilePath)
+def getArg(name, default=None):
+    return argv[argv.index(name) + 1] if name in argv else default
+
+## Per object messages are logged at the DEBUG level, --log-level DEBUG shows them
+log = logging.getLogger('render-scene-import')
+log.setLevel(getArg('--log-level', 'INFO').upper())
+log.propagate = False
+
+if not log.handlers:
+    logHandler = logging.StreamHandler(sys.stdout)
+    logHandler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(logHandler)
+
+## The environment template the script was launched on
+templateFilePath = bpy.data.filepath
+
+## Datablocks of the template, by type, kept by the consolidation even when nothing uses them anymore
+templateDatablockTypes = ('objects', 'meshes', 'materials', 'node_groups', 'images', 'textures', 'lights', 'worlds', 'collections')
+templateDatablocks = {datablockType: {datablock.name for datablock in getattr(bpy.data, datablockType)}
+                      for datablockType in templateDatablockTypes}
+
+## The GLTF scene exported from mDC Designer
+sceneFilePath = path.join(path.dirname(bpy.data.filepath), 'myDecoCloud_scene', 'myDecoCloud_scene.gltf')
 
 ## Import and place assets, potentially their high quality versions stored in .blend files
 
@@ -39,73 +118,731 @@ importedObjects = {}
 importedObjectsWorldMatrixes = {}
 importedMaterials = {}
 
+## Meshes shared by the instances of the assets, keyed by (object key, weights, rotation)
+sharedMeshes = {}
+
+## Datablocks loaded from the bundles .blend files, before they are placed or swapped in the scene
+loadedObjects = {}
+loadedMaterials = {}
+
+## With --asset-mode link, the objects of the bundles (and so their meshes) are linked from the bundle files instead of
+## being appended, so that the prepared scenes don't carry a copy of them. Their materials are still appended, and set
+## on object-level slots of the instances, so that they can be swapped, recolored and edited like in append mode
+assetMode = getArg('--asset-mode', 'append')
+
+## Appended copies of the materials of the linked objects, by object key and linked material name
+linkedMaterialCopies = {}
+
+## Files of the bundle directories, listed once before the cache lookup, by directory
+bundleDirectoryFiles = {}
+
+## Bundle directories listed once are checked without going back to the file system
+def assetFileExists(filePath):
+    directoryFiles = bundleDirectoryFiles.get(path.dirname(filePath))
+
+    if directoryFiles is None:
+        return path.exists(filePath)
+
+    return path.basename(filePath) in directoryFiles
+
+def resolveRenderAssetFilePath(renderAssetFileName):
+    ## Use the HQ .blend scene if there is one, or the LQ one
+    hqFilePath = path.join(assetsPath, renderAssetFileName, f'{renderAssetFileName}-hq.blend')
+    lqFilePath = path.join(assetsPath, renderAssetFileName, f'{renderAssetFileName}.blend')
+
+    if assetFileExists(hqFilePath):
+        return hqFilePath
+
+    if assetFileExists(lqFilePath):
+        return lqFilePath
+
+    return None
+
+## Local asset mirror
+## assets/ is a network mount on the render nodes. Each bundle directory is listed once, by a pool of threads started
+## before the cache key hashes the template and the GLTF, and the cache key and the import check the files against
+## these listings. With --asset-mirror {directory}, the bundle files referenced by the GLTF JSON are then copied to
+## that local directory while the GLTF is imported, and appended from there. Copies are checked against the SHA-256 of
+## the source once, when they are made, then trusted as long as their size and modification time are the recorded
+## ones, and the least recently used ones are evicted past --asset-mirror-max-bytes
+assetMirrorPath = getArg('--asset-mirror')
+assetMirrorMaxBytes = int(getArg('--asset-mirror-max-bytes', 20 * 1024 ** 3))
+assetPrefetchJobs = int(getArg('--asset-prefetch-jobs', 8))
+
+## Copies recently used by another import are never evicted, it may be about to load them
+assetMirrorMinAge = 600
+
+## Listings of the bundle directories still running, by bundle
+bundleListing = {'executor': None, 'futures': {}}
+
+## Local copies of the bundle files, by source path, and the copies still running
+mirroredFiles = {}
+assetPrefetch = {'executor': None, 'futures': []}
+
+def getLocalAssetPath(filePath):
+    return mirroredFiles.get(filePath, filePath)
+
+def listBundleDirectory(renderAssetFileName):
+    directoryPath = path.join(assetsPath, renderAssetFileName)
+
+    try:
+        bundleDirectoryFiles[directoryPath] = {entry.name for entry in os.scandir(directoryPath)}
+    except OSError:
+        bundleDirectoryFiles[directoryPath] = set()
+
+    ## The levels of detail are read now rather than on the critical path
+    if lodMode == 'camera' or assetCullingMode != 'off':
+        getObjectLods(renderAssetFileName)
+
+# Starts listing the bundle directories referenced by the GLTF, once
+def startBundleListing(gltf):
+    if bundleListing['executor'] is not None or bundleListing['futures']:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=assetPrefetchJobs)
+    bundleListing['executor'] = executor
+    bundleListing['futures'] = {renderAssetFileName: executor.submit(listBundleDirectory, renderAssetFileName)
+                                for renderAssetFileName in sorted(collectGltfRenderAssetBundles(gltf))}
+
+def finishBundleListing():
+    for future in bundleListing['futures'].values():
+        future.result()
+
+    if bundleListing['executor'] is not None:
+        bundleListing['executor'].shutdown()
+        bundleListing['executor'] = None
+
+def hashMirrorFile(filePath):
+    digest = hashlib.sha256()
+    hashFile(filePath, digest)
+    return digest.hexdigest()
+
+# Whether the record of a copy matches the source file and the copy itself, records from older versions or cut
+# short are not
+def isMirrorRecordValid(record, sourceStat, mirrorPath):
+    try:
+        if record['size'] != sourceStat.st_size or record['mtime'] != sourceStat.st_mtime_ns:
+            return False
+
+        mirrorStat = os.stat(mirrorPath)
+        return mirrorStat.st_size == record['size'] and mirrorStat.st_mtime_ns == record['mirrorMtime']
+    except (KeyError, TypeError, FileNotFoundError):
+        return False
+
+def mirrorAssetFile(sourcePath):
+    mirrorPath = path.join(assetMirrorPath, path.basename(path.dirname(sourcePath)), path.basename(sourcePath))
+    recordPath = mirrorPath + '.mirror.json'
+    sourceStat = os.stat(sourcePath)
+
+    try:
+        with open(recordPath) as recordFile:
+            record = json.load(recordFile)
+    except (FileNotFoundError, ValueError):
+        record = None
+
+    ## Up to date copy of the same source file, its last use is the modification time of its record
+    if isMirrorRecordValid(record, sourceStat, mirrorPath):
+        os.utime(recordPath)
+        mirroredFiles[sourcePath] = mirrorPath
+        return 0
+
+    os.makedirs(path.dirname(mirrorPath), exist_ok=True)
+    tmpPath = f'{mirrorPath}.{os.getpid()}.{threading.get_ident()}.tmp'
+    digest = hashlib.sha256()
+
+    with open(sourcePath, 'rb') as sourceFile, open(tmpPath, 'wb') as tmpFile:
+        for chunk in iter(lambda: sourceFile.read(1024 * 1024), b''):
+            digest.update(chunk)
+            tmpFile.write(chunk)
+
+    ## What was written must be what was read
+    if hashMirrorFile(tmpPath) != digest.hexdigest():
+        os.remove(tmpPath)
+        raise OSError(f'Checksum mismatch for the copy of {sourcePath}')
+
+    os.replace(tmpPath, mirrorPath)
+
+    record = {'size': sourceStat.st_size, 'mtime': sourceStat.st_mtime_ns, 'sha256': digest.hexdigest(),
+              'mirrorMtime': os.stat(mirrorPath).st_mtime_ns}
+
+    with open(f'{recordPath}.{os.getpid()}.{threading.get_ident()}.tmp', 'w') as recordFile:
+        json.dump(record, recordFile)
+    os.replace(f'{recordPath}.{os.getpid()}.{threading.get_ident()}.tmp', recordPath)
+
+    mirroredFiles[sourcePath] = mirrorPath
+    return sourceStat.st_size
+
+def prefetchAssetFile(sourcePath):
+    try:
+        return mirrorAssetFile(sourcePath)
+    except OSError as error:
+        ## The bundle is then appended from assets/
+        log.warning('Could not mirror %s: %s', sourcePath, error)
+        return 0
+
+# Starts copying the bundle files, before the GLTF import, from the listings of the cache lookup
+def startAssetPrefetch():
+    if assetMirrorPath is None:
+        return
+
+    with open(sceneFilePath, encoding='utf-8') as sceneFile:
+        gltf = json.load(sceneFile)
+
+    startBundleListing(gltf)
+    finishBundleListing()
+
+    ## The files that will be appended, with the levels of detail picked for the camera of the job
+    sourcePaths = {resolveObjectFilePath(objectKey) for objectKey in collectGltfObjectKeys(gltf) | collectGltfRenderAssetBundles(gltf)}
+    sourcePaths.discard(None)
+
+    executor = ThreadPoolExecutor(max_workers=assetPrefetchJobs)
+    assetPrefetch['executor'] = executor
+    assetPrefetch['futures'] = [executor.submit(prefetchAssetFile, sourcePath) for sourcePath in sorted(sourcePaths)]
+
+    print(f'Prefetching {len(sourcePaths)} bundle files to {assetMirrorPath}')
+
+# Evicts the least recently used copies until the mirror fits in assetMirrorMaxBytes
+def evictMirroredFiles():
+    usedPaths = set(mirroredFiles.values())
+    mirrorFiles = []
+
+    for (directoryPath, _, fileNames) in os.walk(assetMirrorPath):
+        for fileName in fileNames:
+            if fileName.endswith('.blend'):
+                filePath = path.join(directoryPath, fileName)
+
+                ## Another worker can evict the copy while the mirror is listed
+                try:
+                    fileStat = os.stat(filePath)
+                except OSError:
+                    continue
+
+                ## The copies keep their modification time, their record is touched on each use
+                try:
+                    lastUse = os.stat(filePath + '.mirror.json').st_mtime
+                except OSError:
+                    lastUse = fileStat.st_mtime
+
+                mirrorFiles.append((lastUse, fileStat.st_size, filePath))
+
+    totalBytes = sum(fileSize for (_, fileSize, _) in mirrorFiles)
+    evictedBytes = 0
+
+    for (lastUse, fileSize, filePath) in sorted(mirrorFiles):
+        if totalBytes <= assetMirrorMaxBytes:
+            break
+        if filePath in usedPaths or time.time() - lastUse < assetMirrorMinAge:
+            continue
+
+        for removedPath in (filePath, filePath + '.mirror.json'):
+            try:
+                os.remove(removedPath)
+            except FileNotFoundError:
+                pass
+
+        totalBytes -= fileSize
+        evictedBytes += fileSize
+
+    return evictedBytes
+
+# Waits for the copies, then evicts the old ones
+def finishAssetPrefetch():
+    executor = assetPrefetch['executor']
+
+    if executor is None:
+        return
+
+    copiedBytes = sum(future.result() for future in assetPrefetch['futures'])
+    executor.shutdown()
+    assetPrefetch['executor'] = None
+
+    print(f'Mirrored {len(mirroredFiles)} bundle files, {copiedBytes / 1024 ** 2:.1f} MB copied, '
+          f'{evictMirroredFiles() / 1024 ** 2:.1f} MB evicted')
+
+# Images appended from a local copy point to the mirror, they are pointed back to the bundle directory
+def remapMirroredImagePaths():
+    if not mirroredFiles:
+        return
+
+    mirrorRoot = path.abspath(assetMirrorPath) + os.sep
+
+    for image in bpy.data.images:
+        if image.library is not None or image.source != 'FILE' or image.packed_file is not None:
+            continue
+
+        imagePath = path.abspath(bpy.path.abspath(image.filepath))
+
+        if imagePath.startswith(mirrorRoot):
+            image.filepath = bpy.path.relpath(path.join(path.abspath(assetsPath), imagePath[len(mirrorRoot):]))
+
+## Levels of detail
+## The prepare-object scripts write decimated levels next to the bundle file, with their triangle counts and the bounds
+## of the object in {file}-lods.json. Each instance uses the coarsest level whose estimated error, projected with the
+## camera of the job, stays under --lod-error pixels. Objects keys are "{hash}@lod{level}" for the decimated levels.
+## Fast renders from another camera keep the levels picked for the first one, hence off by default
+lodMode = getArg('--lod', 'off')
+lodErrorThreshold = float(getArg('--lod-error', 1))
+
+## Level of detail metadata of each bundle, None when it has none
+objectLods = {}
+lodLevelCounts = {}
+
+## File of each object key, None when it doesn't exist, resolved once per key
+objectFilePaths = {}
+
+def getObjectKey(renderAssetFileName, lodLevel):
+    return renderAssetFileName if lodLevel == 0 else f'{renderAssetFileName}@lod{lodLevel}'
+
+def resolveObjectFilePath(objectKey):
+    if objectKey not in objectFilePaths:
+        (renderAssetFileName, _, lodLevel) = objectKey.partition('@lod')
+        filePath = resolveRenderAssetFilePath(renderAssetFileName)
+
+        if filePath is not None and lodLevel:
+            lodFilePath = filePath.replace('.blend', f'-lod{lodLevel}.blend')
+            filePath = lodFilePath if assetFileExists(lodFilePath) else None
+
+        objectFilePaths[objectKey] = filePath
+
+    return objectFilePaths[objectKey]
+
+def getObjectLods(renderAssetFileName):
+    if renderAssetFileName not in objectLods:
+        filePath = resolveRenderAssetFilePath(renderAssetFileName)
+        lods = None
+
+        if filePath is not None and assetFileExists(filePath.replace('.blend', '-lods.json')):
+            with open(filePath.replace('.blend', '-lods.json')) as lodsFile:
+                lods = json.load(lodsFile)
+
+        objectLods[renderAssetFileName] = lods
+
+    return objectLods[renderAssetFileName]
+
+# Pixels covered by one meter at the given distance of the camera of the job
+def getPixelsPerMeter(distance):
+    render = bpy.context.scene.render
+    resolutionScale = render.resolution_percentage / 100
+    cameraValues = cameraArg.split(",")
+
+    if cameraValues[0] == 'perspective':
+        fov = float(cameraValues[2])
+        znear = float(cameraValues[3])
+
+        ## The field of view is vertical
+        return render.resolution_y * resolutionScale / (2 * max(distance, znear) * math.tan(fov / 2))
+
+    xmag = float(cameraValues[3])
+    return max(render.resolution_x, render.resolution_y) * resolutionScale / xmag
+
+def getJobCameraPosition():
+    return Vector(map(float, positionArg.split(",")))
+
+# World bounding sphere of an asset placed with the given matrix, from the bounds written at prepare time
+def getAssetBoundingSphere(renderAssetFileName, matrixWorld):
+    lods = getObjectLods(renderAssetFileName)
+
+    if lods is None:
+        return None
+
+    (boundsMin, boundsMax) = lods['bounds']
+    corners = [matrixWorld @ Vector((x, y, z)) for x in (boundsMin[0], boundsMax[0])
+               for y in (boundsMin[1], boundsMax[1]) for z in (boundsMin[2], boundsMax[2])]
+    center = sum(corners, Vector()) / len(corners)
+    radius = max((corner - center).length for corner in corners)
+
+    return (center, radius)
+
+def selectLodLevel(renderAssetFileName, matrixWorld):
+    lods = getObjectLods(renderAssetFileName) if lodMode == 'camera' else None
+
+    if lods is None or len(lods['levels']) < 2:
+        return 0
+
+    (center, radius) = getAssetBoundingSphere(renderAssetFileName, matrixWorld)
+    pixelsPerMeter = getPixelsPerMeter((center - getJobCameraPosition()).length - radius)
+
+    ## The error of a level is estimated as the mean edge length of its triangles over the size of the object
+    for lodLevel in reversed(range(1, len(lods['levels']))):
+        triangles = max(lods['levels'][lodLevel]['triangles'], 1)
+        projectedError = 2 * radius / math.sqrt(triangles) * pixelsPerMeter
+
+        if projectedError <= lodErrorThreshold and resolveObjectFilePath(getObjectKey(renderAssetFileName, lodLevel)) is not None:
+            return lodLevel
+
+    return 0
+
+## Assets culling
+## With --asset-culling skip or proxy, the assets outside of the frustum of the job camera and further than
+## --asset-culling-distance (their contribution to the indirect light) are not imported, or replaced by their bounding box.
+## Fast renders from another camera keep the assets culled for the first one, hence off by default
+assetCullingMode = getArg('--asset-culling', 'off')
+assetCullingDistance = float(getArg('--asset-culling-distance', 10))
+
+## Asset nulls that are not imported
+culledAssets = set()
+culledAssetsCount = 0
+
+def isInJobCameraFrustum(center, radius):
+    cameraValues = cameraArg.split(",")
+    cameraRotation = mathutils.Euler(tuple(map(float, orientationArg.split(","))), 'XYZ').to_matrix()
+
+    ## Camera space, looking down -Z
+    localCenter = cameraRotation.transposed() @ (center - getJobCameraPosition())
+    depth = -localCenter.z
+
+    render = bpy.context.scene.render
+    aspectRatio = (render.resolution_x * render.pixel_aspect_x) / (render.resolution_y * render.pixel_aspect_y)
+
+    if cameraValues[0] == 'perspective':
+        fov = float(cameraValues[2])
+        znear = float(cameraValues[3])
+
+        if depth + radius < znear:
+            return False
+
+        ## The field of view is vertical, the sphere is outside when it is entirely behind a side plane
+        tanY = math.tan(fov / 2)
+        tanX = tanY * aspectRatio
+
+        return abs(localCenter.x) <= depth * tanX + radius * math.sqrt(1 + tanX ** 2)\
+            and abs(localCenter.y) <= depth * tanY + radius * math.sqrt(1 + tanY ** 2)
+
+    if depth + radius < 0:
+        return False
+
+    ## The orthographic scale is the size of the larger side
+    halfSize = float(cameraValues[3]) / 2
+    (halfWidth, halfHeight) = (halfSize, halfSize / aspectRatio) if aspectRatio >= 1 else (halfSize * aspectRatio, halfSize)
+
+    return abs(localCenter.x) <= halfWidth + radius and abs(localCenter.y) <= halfHeight + radius
+
+def isAssetCulled(renderAssetFileName, matrixWorld):
+    if assetCullingMode == 'off':
+        return False
+
+    boundingSphere = getAssetBoundingSphere(renderAssetFileName, matrixWorld)
+
+    if boundingSphere is None:
+        return False
+
+    (center, radius) = boundingSphere
+
+    if (center - getJobCameraPosition()).length - radius <= assetCullingDistance:
+        return False
+
+    return not isInJobCameraFrustum(center, radius)
+
+# Box mesh of the bounds of an asset, shared by its proxies
+def getProxyMesh(renderAssetFileName, proxyMeshes):
+    if renderAssetFileName not in proxyMeshes:
+        (boundsMin, boundsMax) = getObjectLods(renderAssetFileName)['bounds']
+        vertices = [(x, y, z) for x in (boundsMin[0], boundsMax[0]) for y in (boundsMin[1], boundsMax[1])
+                    for z in (boundsMin[2], boundsMax[2])]
+        faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+
+        mesh = bpy.data.meshes.new(f'__render_proxy-{renderAssetFileName}')
+        mesh.from_pydata(vertices, [], faces)
+        proxyMeshes[renderAssetFileName] = mesh
+
+    return proxyMeshes[renderAssetFileName]
+
+def cullAssets():
+    global culledAssetsCount
+
+    if assetCullingMode == 'off':
+        return
+
+    proxyMeshes = {}
+
+    for obj in list(bpy.context.scene.objects):
+        if 'assetBundleHash' not in obj or not isAssetCulled(obj['assetBundleHash'], obj.matrix_world):
+            continue
+
+        culledAssets.add(obj)
+        culledAssetsCount += 1
+
+        if assetCullingMode == 'proxy':
+            proxy = bpy.data.objects.new(f'__render_proxy-{obj.name}', getProxyMesh(obj['assetBundleHash'], proxyMeshes))
+            proxy.matrix_world = obj.matrix_world
+            bpy.context.collection.objects.link(proxy)
+
+    print(f'Culled {culledAssetsCount} assets ({assetCullingMode})')
+
+# Collects every bundle referenced by the GLTF custom properties, so that they can all be loaded at once
+def collectRenderAssetBundles():
+    objectBundles = set()
+    materialBundles = set()
+
+    for obj in bpy.context.scene.objects:
+        if obj in culledAssets:
+            continue
+
+        if 'assetBundleHash' in obj:
+            objectBundles.add(getObjectKey(obj['assetBundleHash'], selectLodLevel(obj['assetBundleHash'], obj.matrix_world)))
+
+        if 'materialsMap' in obj and isinstance(obj['materialsMap'], idprop.types.IDPropertyGroup):
+            for renderAssetRef in obj['materialsMap'].values():
+                if isinstance(renderAssetRef, idprop.types.IDPropertyGroup) and 'assetBundleHash' in renderAssetRef:
+                    materialBundles.add(renderAssetRef['assetBundleHash'])
+
+    for mat in bpy.data.materials:
+        if 'assetBundleHash' in mat:
+            materialBundles.add(mat['assetBundleHash'])
+
+    return objectBundles, materialBundles
+
+## Load time and datablocks loaded from each bundle file, for the profile report
+assetProfiles = []
+
+## Bundles without a file to import, reported once
+missingBundles = set()
+
+# Loads the objects and materials of the bundles with one bpy.data.libraries.load pass per file,
+# instead of going through the bpy.ops.wm.append operator for every asset
+def loadRenderAssetLibraries(objectBundles, materialBundles):
+    objectName = '__render_importObject'
+    materialName = '__render_importMaterial'
+
+    for renderAssetFileName in sorted(objectBundles | materialBundles):
+        if renderAssetFileName in missingBundles:
+            continue
+
+        importedFilePath = resolveObjectFilePath(renderAssetFileName)
+
+        if importedFilePath is None:
+            log.warning('Did not find file to import for %s', renderAssetFileName)
+            missingBundles.add(renderAssetFileName)
+            continue
+
+        log.debug('Import file %s', importedFilePath)
+
+        fileStartTime = time.time()
+        datablockCounts = (len(bpy.data.meshes), len(bpy.data.materials), len(bpy.data.images), len(bpy.data.lights))
+
+        linkObjects = assetMode == 'link' and renderAssetFileName in objectBundles
+        linkedMaterialNames = []
+
+        if linkObjects:
+            with bpy.data.libraries.load(importedFilePath, link=True) as (dataFrom, linkedData):
+                if objectName in dataFrom.objects:
+                    linkedData.objects = [objectName]
+
+            ## Linked datablocks keep their name in their library, only the materials on the slots of the linked
+            ## object are appended, to be overridden on its instances
+            for linkedObject in linkedData.objects:
+                if linkedObject is not None:
+                    loadedObjects[renderAssetFileName] = linkedObject
+                    linkedMaterialNames = [slot.material.name for slot in linkedObject.material_slots
+                                           if slot.material is not None and slot.material.library is not None]
+
+        ## Appended from the local copy when there is one, linked from the bundle itself so that the prepared scenes
+        ## don't depend on the mirror of this node
+        with bpy.data.libraries.load(getLocalAssetPath(importedFilePath), link=False) as (dataFrom, dataTo):
+            if renderAssetFileName in objectBundles and objectName in dataFrom.objects and not linkObjects:
+                dataTo.objects = [objectName]
+
+            if renderAssetFileName in materialBundles and materialName in dataFrom.materials:
+                dataTo.materials = [materialName]
+
+            if linkedMaterialNames:
+                dataTo.materials = list(dict.fromkeys(dataTo.materials + [linkedMaterialName for linkedMaterialName in linkedMaterialNames
+                                                                          if linkedMaterialName in dataFrom.materials]))
+
+            ## The names are replaced by the datablocks once loaded
+            appendedMaterialNames = list(dataTo.materials)
+
+        ## Loaded datablocks all come with the same name, give them their final name right away
+        for importedObject in dataTo.objects:
+            if importedObject is not None:
+                importedObject.name = objectName + '-' + renderAssetFileName
+                loadedObjects[renderAssetFileName] = importedObject
+
+        for (importedMaterialName, importedMaterial) in zip(appendedMaterialNames, dataTo.materials):
+            if importedMaterial is not None and importedMaterialName == materialName and renderAssetFileName in materialBundles:
+                importedMaterial.name = materialName + '-' + renderAssetFileName
+                loadedMaterials[renderAssetFileName] = importedMaterial
+
+        if linkObjects and renderAssetFileName in loadedObjects:
+            linkedMaterialCopies[renderAssetFileName] = dict(zip(appendedMaterialNames, dataTo.materials))
+
+        assetProfiles.append({
+            'bundle': renderAssetFileName,
+            'file': importedFilePath,
+            'mirrored': importedFilePath in mirroredFiles,
+            'time': time.time() - fileStartTime,
+            'meshes': len(bpy.data.meshes) - datablockCounts[0],
+            'polygons': sum(len(obj.data.polygons) for obj in dataTo.objects if obj is not None and obj.type == 'MESH'),
+            'materials': len(bpy.data.materials) - datablockCounts[1],
+            'images': len(bpy.data.images) - datablockCounts[2],
+            'lights': len(bpy.data.lights) - datablockCounts[3],
+        })
+
+    remapMirroredImagePaths()
+
 def importObjectRenderAsset(obj, renderAssetRef):
-    print(f'Import object {obj.name} RenderAsset')
+    log.debug('Import object %s RenderAsset', obj.name)
 
     renderAssetFileName = renderAssetRef["assetBundleHash"]
 
+    ## Instances of the same asset can use different levels of detail, they are imported as separate objects
+    lodLevel = selectLodLevel(renderAssetFileName, obj.matrix_world)
+    lodLevelCounts[lodLevel] = lodLevelCounts.get(lodLevel, 0) + 1
+    renderAssetFileName = getObjectKey(renderAssetFileName, lodLevel)
+
     ## Use a simple dict cache to see if we already imported this object
-    if renderAssetFileName in importedObjects:
-        cachedObject = importedObjects[renderAssetFileName]
+    if renderAssetFileName not in importedObjects:
+        ## Bundles that were not collected beforehand are loaded on their own
+        if renderAssetFileName not in loadedObjects:
+            loadRenderAssetLibraries({renderAssetFileName}, set())
 
-        # Duplicate it
-        importedObject = cachedObject.copy()
-        importedObject.data = cachedObject.data.copy()
-        bpy.context.collection.objects.link(importedObject)
+        if renderAssetFileName not in loadedObjects:
+            return
 
-    else:
-        ## Import the HQ or LQ .blend scene
-        hqFilePath = path.join(assetsPath, renderAssetFileName, f'{renderAssetFileName}-hq.blend')
-        lqFilePath = path.join(assetsPath, renderAssetFileName, f'{renderAssetFileName}.blend')
+        ## The loaded object is kept out of the scene as a template for all the instances of the asset,
+        ## so that material swaps on an instance never leak to the next ones
+        templateObject = loadedObjects.pop(renderAssetFileName)
+        importedObjects[renderAssetFileName] = templateObject
+        sharedMeshes[(renderAssetFileName, (), None)] = templateObject.data
 
-        if path.exists(hqFilePath):
-            print(f'Import HQ file {hqFilePath}')
-            importedFilePath = hqFilePath
+        ## Store its original matrix values to be able to move its duplicates correctly
+        importedObjectsWorldMatrixes[renderAssetFileName] = templateObject.matrix_world.copy()
 
-        elif path.exists(lqFilePath):
-            print(f'Import LQ file {lqFilePath}')
-            importedFilePath = lqFilePath
+    templateObject = importedObjects[renderAssetFileName]
 
-        else:
-            print(f'Did not find file to import for {renderAssetFileName}', file=sys.stderr)
-            return
+    ## Instances share one mesh, unless they need different blendshape weights or UV rotation
+    meshKey = getSharedMeshKey(obj, renderAssetFileName)
 
-        objectName = '__render_importObject'
+    if meshKey not in sharedMeshes:
+        mesh = templateObject.data.copy()
 
-        bpy.ops.wm.append(
-            filepath=path.join(importedFilePath, 'Object', objectName),
-            directory=path.join(importedFilePath, 'Object'),
-            filename=objectName)
+        ## Apply the weights of the blendshape
+        for weightIndex, weight in enumerate(meshKey[1]):
+            if mesh.shape_keys is not None:
+                mesh.shape_keys.key_blocks[weightIndex + 1].value = weight
+            else:
+                log.warning('Weights on an object without shape keys ! %s -> %s', obj.name, renderAssetFileName)
 
-        ## Get the imported object and change its name
-        importedObject = bpy.data.objects['__render_importObject']
-        
-        importedObject.name += '-' + renderAssetFileName
+        sharedMeshes[meshKey] = mesh
 
-        ## Cache a copy of it. We can't cache it directly because if we swap materials on it,
-        ## duplicates of it will not be able to swap material
-        importedObjectCopy = importedObject.copy()
-        importedObjectCopy.data = importedObject.data.copy()
-        importedObjects[renderAssetFileName] = importedObjectCopy
+    # Duplicate it, the copy uses the same mesh as the template, we then point it to the shared variant
+    importedObject = templateObject.copy()
+    importedObject.data = sharedMeshes[meshKey]
+    bpy.context.collection.objects.link(importedObject)
+
+    ## The materials of a linked mesh are overridden on the slots of the instance by their appended copies
+    if renderAssetFileName in linkedMaterialCopies:
+        for slot in importedObject.material_slots:
+            if slot.link == 'DATA' and slot.material is not None and slot.material.library is not None:
+                materialCopy = linkedMaterialCopies[renderAssetFileName].get(slot.material.name)
+
+                if materialCopy is not None:
+                    slot.link = 'OBJECT'
+                    slot.material = materialCopy
+
+    indexObjectMaterialSlots(importedObject)
 
-        ## Store its original matrix values to be able to move it and its duplicate correctly
-        importedObjectsWorldMatrixes[renderAssetFileName] = importedObject.matrix_world.copy()
-    
     ## Move the imported object where the null is
     ## Don't set its parent, because it takes a long time
     importedObject.matrix_world = obj.matrix_world @ importedObjectsWorldMatrixes[renderAssetFileName]
 
-    ## Apply the weights of the blendshape
-    if 'weights' in obj and isinstance(obj['weights'], idprop.types.IDPropertyArray):
-        for weightIndex, weight in enumerate(obj['weights']):
-            if importedObject.data.shape_keys is not None:
-                importedObject.data.shape_keys.key_blocks[weightIndex + 1].value = weight
-            else:
-                print(f'Weights on an object without shape keys ! {obj.name} -> {renderAssetFileName}')
-
     ## Return the importedObject so that it can be used for material map
     return importedObject
 
+# Key of the mesh an instance can share with the other instances of the same asset
+def getSharedMeshKey(obj, renderAssetFileName):
+    weights = ()
+    if 'weights' in obj and isinstance(obj['weights'], idprop.types.IDPropertyArray):
+        weights = tuple(obj['weights'].to_list())
+
+    ## The UV rotation pass edits the mesh itself, so instances with a different rotation can't share it
+    rotation = obj['rotation'] if 'rotation' in obj else None
+
+    return (renderAssetFileName, weights, rotation)
+
+## Material slots of the scene meshes, keyed by the name of their material without its .001 suffix,
+## so that substitutions go straight to the slots using a material instead of walking every object
+materialSlotIndex = {}
+materialSuffixPattern = re.compile(r'\.\d+$')
+
+def getMaterialBaseName(materialName):
+    return materialSuffixPattern.sub('', materialName)
+
+def indexObjectMaterialSlots(obj):
+    if obj.type != 'MESH':
+        return
+
+    for (slotIndex, slot) in enumerate(obj.material_slots):
+        if slot.material is not None:
+            ## Dicts are used as ordered sets, to keep the scene order of the slots
+            materialSlotIndex.setdefault(getMaterialBaseName(slot.material.name), {})[(obj, slotIndex)] = None
+
+def buildMaterialSlotIndex():
+    materialSlotIndex.clear()
+
+    for obj in bpy.context.scene.objects:
+        indexObjectMaterialSlots(obj)
+
+# Slots among the given objects (or all the scene if None) whose material matches matName, with or without a .001 suffix
+def findMaterialSlots(objects, matName, exactMatch=False):
+    pattern = re.compile(rf'^{re.escape(matName)}(\.\d+)?$')
+    objectsFilter = None if objects is None else set(objects)
+
+    ## A material named "name.001.002" has "name.001" as base name
+    baseNames = dict.fromkeys((getMaterialBaseName(matName), matName))
+    if exactMatch:
+        baseNames = dict.fromkeys((getMaterialBaseName(matName),))
+
+    slots = []
+    for baseName in baseNames:
+        for (obj, slotIndex) in materialSlotIndex.get(baseName, {}):
+            if objectsFilter is not None and obj not in objectsFilter:
+                continue
+
+            material = obj.material_slots[slotIndex].material
+            if material is None:
+                continue
+
+            if material.name == matName if exactMatch else pattern.match(material.name) is not None:
+                slots.append((obj, slotIndex))
+
+    return slots
+
+# Slots among the given objects whose material name starts with prefix
+def findMaterialSlotsWithPrefix(objects, prefix):
+    objectsFilter = None if objects is None else set(objects)
+
+    slots = []
+    for (baseName, indexedSlots) in materialSlotIndex.items():
+        if not baseName.startswith(prefix):
+            continue
+
+        for (obj, slotIndex) in indexedSlots:
+            if objectsFilter is not None and obj not in objectsFilter:
+                continue
+
+            material = obj.material_slots[slotIndex].material
+            if material is not None and material.name.startswith(prefix):
+                slots.append((obj, slotIndex))
+
+    return slots
+
+# Sets the material of a slot and keeps the slot index up to date. When the mesh is shared between several objects,
+# the material is set on an object-level slot so that the other users of the mesh keep theirs
+def setSlotMaterial(obj, slotIndex, material):
+    slot = obj.material_slots[slotIndex]
+
+    if slot.material is not None:
+        materialSlotIndex.get(getMaterialBaseName(slot.material.name), {}).pop((obj, slotIndex), None)
+
+    if slot.link == 'DATA' and (obj.data.users > 1 or obj.data.library is not None):
+        slot.link = 'OBJECT'
+
+    slot.material = material
+
+    if material is not None:
+        materialSlotIndex.setdefault(getMaterialBaseName(material.name), {})[(obj, slotIndex)] = None
+
 def srgb_to_linear(c):
     if c <= 0.04045:
         return c / 12.92
@@ -115,29 +852,44 @@ def srgb_to_linear(c):
 # Fonction de processing des matériaux.
 
 # Cette méthode va s'occuper d'application la rotation custom d'un revêtement de sol
-def applyRotation(objects, rotation):
-    print(f'Apply rotation to', object.__name__)
+# Les UVs de tous les meshes qui ont le même angle sont tournées d'un seul coup, autour du point fixe (0.5, 0.5) de
+# l'espace UV, comme la rotation d'origine
+def applyRotation(meshes, rotation):
+    log.debug('Apply rotation %s to %s meshes', rotation, len(meshes))
 
-    pivot = Vector((0.5,0.5))
+    pivot = np.array((0.5, 0.5))
     angle = math.radians(-rotation)
 
-    for obj in objects:
-        uvlayer  = obj.data.uv_layers.active
+    p = 1 #obj.dimensions.y / obj.dimensions.x
 
-        p = 1 #obj.dimensions.y / obj.dimensions.x
+    R = np.array((
+        (np.cos(angle), np.sin(angle) / p),
+        (-p * np.sin(angle), np.cos(angle))
+    ))
 
-        R = Matrix((
-            (np.cos(angle), np.sin(angle) / p),
-            (-p * np.sin(angle), np.cos(angle))
-        ))
+    uvLayers = [mesh.uv_layers.active for mesh in meshes]
+    uvLayers = [uvLayer for uvLayer in uvLayers if uvLayer is not None and len(uvLayer.data)]
 
-        uvs = np.empty(2*len(obj.data.loops))
-        uvlayer.data.foreach_get("uv", uvs)
+    if not uvLayers:
+        return 0
 
-        uvs = np.dot(uvs.reshape((-1,2)) - pivot, R) + pivot
-        uvlayer.data.foreach_set("uv", uvs.ravel())
+    loopCounts = [len(uvLayer.data) for uvLayer in uvLayers]
+    uvs = np.empty(2 * sum(loopCounts))
 
-        obj.data.update()
+    offset = 0
+    for (uvLayer, loopCount) in zip(uvLayers, loopCounts):
+        uvLayer.data.foreach_get("uv", uvs[offset:offset + 2 * loopCount])
+        offset += 2 * loopCount
+
+    uvs = (np.dot(uvs.reshape((-1, 2)) - pivot, R) + pivot).ravel()
+
+    offset = 0
+    for (uvLayer, loopCount) in zip(uvLayers, loopCounts):
+        uvLayer.data.foreach_set("uv", uvs[offset:offset + 2 * loopCount])
+        uvLayer.id_data.update_tag()
+        offset += 2 * loopCount
+
+    return len(uvs) // 2
 
 def applyOldRotation(objects, rotation):
     print(f'Apply rotation to', object.__name__)
@@ -167,70 +919,88 @@ def applyOldRotation(objects, rotation):
             tree.links.new(mapping.outputs['Vector'], metallic.inputs['Vector'])
             tree.links.new(mapping.outputs['Vector'], normal.inputs['Vector'])
 
+## Recolored copies of the materials, keyed by (source material, linear RGBA, operation), so that the same
+## material in the same color is only copied and compiled once
+materialVariants = {}
+
+def getLinearColor(colorToApply):
+    return (srgb_to_linear(colorToApply['r']), srgb_to_linear(colorToApply['g']), srgb_to_linear(colorToApply['b']),
+            colorToApply['a'])
+
+def getMaterialColorVariant(material, colorToApply):
+    new_color = getLinearColor(colorToApply)
+    variantKey = (material, tuple(round(channel, 6) for channel in new_color), 'baseColor')
+
+    if variantKey not in materialVariants:
+        log.debug('Apply color to %s', material.name)
+
+        variant = material.copy()
+        applyBaseColor(variant, new_color)
+        materialVariants[variantKey] = variant
+
+        ## Applying the same color again to the variant gives the variant itself
+        materialVariants[(variant, variantKey[1], variantKey[2])] = variant
+
+    return materialVariants[variantKey]
+
+def applyBaseColor(material, new_color):
+    tree = material.node_tree
+    principled = tree.nodes['Principled BSDF']
+
+    base_color = principled.inputs['Base Color']
+
+    # On a à présent plusieurs cas de figure, si il s'agit d'une base color simple, s'il s'agit d'un color
+    # mix en source, ou alors d'une simple texture (cas le plus chiant)
+    if len(base_color.links) == 0:
+        # cas simple en gros, on a pas de lien complexe, c'est une couleur simple
+        base_color.default_value = new_color
+    else:
+        link = base_color.links[0]
+        if link.from_node.name == 'Mix':
+            # Cas où on a un mixer de couleur
+            mix = link.from_node
+            mix.inputs['B'].default_value = new_color
+        else:
+            if link.from_node.name == 'Image Texture':
+                # cas où la couleur de base provient d'une texture, il faut insérer notre mix à la volée
+                image_node = link.from_node
+                new_node = tree.nodes.new('ShaderNodeMix')
+                new_node.name = 'Mix'
+                new_node.blend_type = 'MULTIPLY'
+                new_node.data_type = 'RGBA'
+                new_node.clamp_result = False
+                new_node.clamp_factor = True
+                new_node.inputs['B'].default_value = new_color
+                new_node.inputs['Factor'].default_value = 1.0
+
+                tree.links.new(new_node.outputs['Result'], link.to_node.inputs['Base Color'])
+                tree.links.new(image_node.outputs['Color'], new_node.inputs['A'])
+
 # Cette méthode sert à appliquer une palette, on est obligé de filer la materialMap car si c'était un matériaux
 # customisable, il s'est fait importer la face dans un nom qui n'a plus rien à voir avec son nom original
 # du coup on doit pouvoir accéder au hash du bundle pour pouvoir retrouver le matériaux et le dupliquer.
 def applyColorMaterial(objects, matName, colorToApply, materialsMap):
-    print(f'Apply color to {matName}')
+    log.debug('Apply color to %s', matName)
 
     # on commence par regarder si le matériau cible de la palette n'est pas déjà customiser
     # par un autre matéfiau, et dans ce cas
     full_name = "NOT IMPORTED"
 
-    print("Trying to get " + matName)
+    log.debug('Trying to get %s', matName)
     for (localName, localRenderAsset) in materialsMap.items():
         if localName == matName:
             full_name = "__render_importMaterial-" + localRenderAsset["assetBundleHash"]
             full_name = full_name[:59] # Superbe contrainte en dur, blender tronque les identifiants
 
-    for obj in objects:
-        if obj.type != 'MESH':
-            continue
-
-        for slot in obj.material_slots:
-            if re.search(f'^{re.escape(matName)}(\.\d+)?$', slot.material.name) is not None\
-                    or slot.material.name[:len(full_name)] == full_name[:len(full_name)]:
-                new_material = slot.material.copy()
-                tree = new_material.node_tree
-                principled = tree.nodes['Principled BSDF']
-                slot.material = new_material
-            else:
-                continue
-
-            base_color = principled.inputs['Base Color']
-            new_color = (srgb_to_linear(colorToApply['r']), srgb_to_linear(colorToApply['g']), srgb_to_linear(colorToApply['b']), colorToApply['a'])
-
-            # On a à présent plusieurs cas de figure, si il s'agit d'une base color simple, s'il s'agit d'un color
-            # mix en source, ou alors d'une simple texture (cas le plus chiant)
-            if len(base_color.links) == 0:
-                # cas simple en gros, on a pas de lien complexe, c'est une couleur simple
-                base_color.default_value = new_color
-            else:
-                link = base_color.links[0]
-                if link.from_node.name == 'Mix':
-                    # Cas où on a un mixer de couleur
-                    mix = link.from_node
-                    mix.inputs['B'].default_value = new_color
-                else:
-                    if link.from_node.name == 'Image Texture':
-                        # cas où la couleur de base provient d'une texture, il faut insérer notre mix à la volée
-                        image_node = link.from_node
-                        new_node = tree.nodes.new('ShaderNodeMix')
-                        new_node.name = 'Mix'
-                        new_node.blend_type = 'MULTIPLY'
-                        new_node.data_type = 'RGBA'
-                        new_node.clamp_result = False
-                        new_node.clamp_factor = True
-                        new_node.inputs['B'].default_value = new_color
-                        new_node.inputs['Factor'].default_value = 1.0
-
-                        tree.links.new(new_node.outputs['Result'], link.to_node.inputs['Base Color'])
-                        tree.links.new(image_node.outputs['Color'], new_node.inputs['A'])
-
+    slots = dict.fromkeys(findMaterialSlots(objects, matName) + findMaterialSlotsWithPrefix(objects, full_name))
 
+    # Les slots qui ont le même matériau et la même couleur partagent la même variante
+    for (obj, slotIndex) in slots:
+        material = obj.material_slots[slotIndex].material
+        setSlotMaterial(obj, slotIndex, getMaterialColorVariant(material, colorToApply))
 
 def importMaterialRenderAsset(objects, matName, renderAssetRef, exactMatch):
-    print(f'Import material asset {matName}')
+    log.debug('Import material asset %s', matName)
     
     renderAssetFileName = renderAssetRef["assetBundleHash"]
 
@@ -242,59 +1012,31 @@ def importMaterialRenderAsset(objects, matName, renderAssetRef, exactMatch):
     if renderAssetFileName in importedMaterials:
         importedMaterial = importedMaterials[renderAssetFileName]
     else:
-        ## Import the HQ or LQ .blend scene
-        hqFilePath = path.join(assetsPath, renderAssetFileName, f'{renderAssetFileName}-hq.blend')
-        lqFilePath = path.join(assetsPath, renderAssetFileName, f'{renderAssetFileName}.blend')
-
-        if path.exists(hqFilePath):
-            print(f'Import HQ file {hqFilePath}')
-            importedFilePath = hqFilePath
-
-        elif path.exists(lqFilePath):
-            print(f'Import LQ file {lqFilePath}')
-            importedFilePath = lqFilePath
+        ## Bundles that were not collected beforehand are loaded on their own
+        if renderAssetFileName not in loadedMaterials:
+            loadRenderAssetLibraries(set(), {renderAssetFileName})
 
-        else:
-            print(f'Did not find file to import for {renderAssetFileName}', file=sys.stderr)
+        if renderAssetFileName not in loadedMaterials:
             return
 
-        materialName = '__render_importMaterial'
-
-        bpy.ops.wm.append(
-            filepath=path.join(importedFilePath, 'Material', materialName),
-            directory=path.join(importedFilePath, 'Material'),
-            filename=materialName)
-        
-        ## Get the imported object and change its name
-        importedMaterial = bpy.data.materials['__render_importMaterial']
+        ## Get the loaded material, it is already named after its bundle
+        importedMaterial = loadedMaterials.pop(renderAssetFileName)
 
         if exactMatch:
             importedMaterial.name = matName
-        else:
-            importedMaterial.name = importedMaterial.name + '-' + renderAssetFileName
 
         ## Cache it
         importedMaterials[renderAssetFileName] = importedMaterial
 
     # Si on a une custom color, on va dupliquer le matériaux et appliquer notre couleur.
     if hasCustomColor:
-        importedMaterial = importedMaterial.copy()
-        applyCustomColorToMaterial(importedMaterial, customColor)
+        importedMaterial = getMaterialColorVariant(importedMaterial, customColor)
 
     # Replace the material in all slots of meshes
-    for obj in objects:
-        if obj.type != 'MESH': continue
-
-        # On devient plus strict sur le remplacement des slots vu qu'à présent on a des variantes d'un même matériau
-        # on ne peut donc pas s'amuser à aller bourriner comme un sac tous les matériaux qui ont un nom similaire.
-        for slot in obj.material_slots:
-            #if re.search(f'^{re.escape(matName)}(\.\d+)?$', slot.material.name) is not None:
-            if exactMatch:
-                if matName == slot.material.name:
-                    slot.material = importedMaterial
-            else:
-                if re.search(f'^{re.escape(matName)}(\.\d+)?$', slot.material.name) is not None:
-                    slot.material = importedMaterial
+    # On devient plus strict sur le remplacement des slots vu qu'à présent on a des variantes d'un même matériau
+    # on ne peut donc pas s'amuser à aller bourriner comme un sac tous les matériaux qui ont un nom similaire.
+    for (obj, slotIndex) in findMaterialSlots(objects, matName, exactMatch):
+        setSlotMaterial(obj, slotIndex, importedMaterial)
 
     ## Delete the dummy that were used in the files to keep the material, if they exist
     dummy = bpy.data.objects.get('__render_dummy')
@@ -305,21 +1047,27 @@ def importMaterialRenderAsset(objects, matName, renderAssetRef, exactMatch):
 importedObjectsCount = 0
 importedMaterialsCount = 0
 importedColorsCount = 0
+rotatedLoopsCount = 0
 
-# On commence par traiter l'herbe. On fait ça avant la substitution de matériaux car
-# cette dernière risque de faire disparaitre des informations
+## Object each asset null was replaced with
+nodeImportedObjects = {}
 
-for obj in bpy.context.scene.objects:
-    if obj.type != 'MESH': continue
+# Places the asset of a node and swaps its materials
+def importNodeAssets(obj):
+    global importedObjectsCount, importedMaterialsCount
 
-# On s'occupe de tous les modificateurs de matériaux
-for obj in bpy.context.scene.objects:
     importedObject = None
 
     if 'assetBundleHash' in obj:
         importedObject = importObjectRenderAsset(obj, obj)
         importedObjectsCount += 1
 
+        if importedObject is not None:
+            nodeImportedObjects[obj] = importedObject
+
+            if gltfNodeProperty in obj:
+                importedObject[gltfNodeAssetProperty] = obj[gltfNodeProperty]
+
     if 'materialsMap' in obj and isinstance(obj['materialsMap'], idprop.types.IDPropertyGroup)\
             or 'palettesMap' in obj and isinstance(obj['palettesMap'], idprop.types.IDPropertyGroup):
 
@@ -330,268 +1078,1708 @@ for obj in bpy.context.scene.objects:
             importMaterialRenderAsset(appliedObjects, materialName, renderAssetRef, False)
             importedMaterialsCount += 1
 
-        if 'palettesMap' in obj:
+def applyNodePalettes(obj):
+    global importedColorsCount
+
+    if 'palettesMap' in obj and isinstance(obj['palettesMap'], idprop.types.IDPropertyGroup):
+        appliedObject = nodeImportedObjects.get(obj, obj)
+        appliedObjects = [appliedObject, *appliedObject.children_recursive]
+
+        with timedStage('palettes'):
             for (materialName, color) in obj['palettesMap'].items():
                 applyColorMaterial(appliedObjects, materialName, color, obj['materialsMap'])
                 importedColorsCount += 1
 
-def applyCustomColorToMaterial(material, colorToApply):
-    print(f'Apply custom color to {material.name}')
+def importAssets():
+    global importedMaterialsCount
 
-    tree = material.node_tree
-    principled = tree.nodes['Principled BSDF']
+    ## Load every referenced bundle before placing the assets
+    with timedStage('collectBundles'):
+        (objectBundles, materialBundles) = collectRenderAssetBundles()
 
-    base_color = principled.inputs['Base Color']
-    new_color = (srgb_to_linear(colorToApply['r']), srgb_to_linear(colorToApply['g']), srgb_to_linear(colorToApply['b']),
-                 colorToApply['a'])
+    with timedStage('assetPrefetchWait'):
+        finishAssetPrefetch()
 
-    # On a à présent plusieurs cas de figure, si il s'agit d'une base color simple, s'il s'agit d'un color
-    # mix en source, ou alors d'une simple texture (cas le plus chiant)
-    if len(base_color.links) == 0:
-        # cas simple en gros, on a pas de lien complexe, c'est une couleur simple
-        base_color.default_value = new_color
+    with timedStage('libraryLoad'):
+        loadRenderAssetLibraries(objectBundles, materialBundles)
+
+    print(f'Loaded {len(loadedObjects)} object bundles and {len(loadedMaterials)} material bundles')
+
+    with timedStage('materialSlotIndex'):
+        buildMaterialSlotIndex()
+
+    # On s'occupe de tous les modificateurs de matériaux
+    # Les couleurs d'un objet s'appliquent juste après ses matériaux, avant ceux des objets suivants
+    with timedStage('objectAssets'):
+        for obj in bpy.context.scene.objects:
+            if obj in culledAssets:
+                continue
+
+            importNodeAssets(obj)
+            applyNodePalettes(obj)
+
+    with timedStage('materialAssets'):
+        for mat in list(bpy.data.materials):
+            if 'assetBundleHash' in mat:
+                importMaterialRenderAsset(None, mat.name, mat, True)
+                importedMaterialsCount += 1
+
+## Grass cutouts
+## "boolean" adds a boolean modifier to each grass surface for each paving slab overlapping it,
+## "mask" removes the scattered grass points under the slabs in ScatterGrassAndFlowers instead
+grassCutoutMode = getArg('--grass-cutout', 'boolean')
+grassCutoutCellSize = float(getArg('--grass-cutout-cell-size', 4))
+
+## Slabs resting on a grass plane only touch it, their bounds are extended a bit to still count as overlapping
+grassCutoutTolerance = 0.01
+
+# World axis-aligned bounds of an object, as ((minX, minY, minZ), (maxX, maxY, maxZ))
+def getWorldBounds(obj, tolerance=0):
+    corners = [obj.matrix_world @ Vector(corner) for corner in obj.bound_box]
+
+    return (tuple(min(corner[axis] for corner in corners) - tolerance for axis in range(3)),
+            tuple(max(corner[axis] for corner in corners) + tolerance for axis in range(3)))
+
+def boundsOverlap(bounds, otherBounds):
+    return all(bounds[0][axis] <= otherBounds[1][axis] and otherBounds[0][axis] <= bounds[1][axis] for axis in range(3))
+
+# Cells of the horizontal grid covered by the bounds
+def getGridCells(bounds):
+    (minX, minY) = (math.floor(bounds[0][axis] / grassCutoutCellSize) for axis in range(2))
+    (maxX, maxY) = (math.floor(bounds[1][axis] / grassCutoutCellSize) for axis in range(2))
+
+    return [(x, y) for x in range(minX, maxX + 1) for y in range(minY, maxY + 1)]
+
+def buildCutterGrid(cutters):
+    cutterGrid = {}
+
+    for cutter in cutters:
+        bounds = getWorldBounds(cutter, grassCutoutTolerance)
+
+        for cell in getGridCells(bounds):
+            cutterGrid.setdefault(cell, []).append((cutter, bounds))
+
+    return cutterGrid
+
+# Cutters whose bounds overlap the bounds of the object, in the order they were found in the scene
+def findOverlappingCutters(cutterGrid, obj):
+    bounds = getWorldBounds(obj)
+    overlappingCutters = {}
+
+    for cell in getGridCells(bounds):
+        for (cutter, cutterBounds) in cutterGrid.get(cell, []):
+            if cutter not in overlappingCutters and boundsOverlap(bounds, cutterBounds):
+                overlappingCutters[cutter] = None
+
+    return sorted(overlappingCutters, key=lambda cutter: cutter.name)
+
+# Inserts a Delete Geometry node on the points of every Distribute Points on Faces node of the grass node group
+# (the grass and the flowers), and returns them so that their selection can be plugged. Returns an empty list if
+# the node group doesn't scatter points itself
+def insertGrassPointsFilter(nodeTree, name):
+    distributeNodes = [node for node in nodeTree.nodes if node.bl_idname == 'GeometryNodeDistributePointsOnFaces']
+
+    if not distributeNodes:
+        log.warning('No Distribute Points on Faces node in %s', nodeTree.name)
+
+    deleteNodes = []
+
+    for (index, distributeNode) in enumerate(distributeNodes):
+        pointsOutput = distributeNode.outputs['Points']
+        targetSockets = [link.to_socket for link in pointsOutput.links]
+
+        for link in list(pointsOutput.links):
+            nodeTree.links.remove(link)
+
+        deleteNode = nodeTree.nodes.new('GeometryNodeDeleteGeometry')
+        deleteNode.name = f'{name}_{index}'
+        deleteNode.domain = 'POINT'
+        deleteNode.location = distributeNode.location + Vector((200, -200))
+
+        nodeTree.links.new(pointsOutput, deleteNode.inputs['Geometry'])
+        for targetSocket in targetSockets:
+            nodeTree.links.new(deleteNode.outputs['Geometry'], targetSocket)
+
+        deleteNodes.append(deleteNode)
+
+    return deleteNodes
+
+# Removes the grass points that have a paving slab right above or below them
+def setupGrassCutoutMask(grassNodeModifier, cutters):
+    deleteNodes = insertGrassPointsFilter(grassNodeModifier, '__render_grassCutout')
+
+    if not deleteNodes:
+        return False
+
+    cuttersCollection = bpy.data.collections.new('__render_grassCutters')
+    for cutter in cutters:
+        cuttersCollection.objects.link(cutter)
+
+    nodes = grassNodeModifier.nodes
+    links = grassNodeModifier.links
+
+    collectionInfo = nodes.new('GeometryNodeCollectionInfo')
+    collectionInfo.name = '__render_grassCutoutCutters'
+    collectionInfo.transform_space = 'RELATIVE'
+    collectionInfo.inputs['Collection'].default_value = cuttersCollection
+
+    realizeInstances = nodes.new('GeometryNodeRealizeInstances')
+    position = nodes.new('GeometryNodeInputPosition')
+
+    rayStart = nodes.new('ShaderNodeVectorMath')
+    rayStart.operation = 'ADD'
+    rayStart.inputs[1].default_value = (0, 0, 1)
+
+    raycast = nodes.new('GeometryNodeRaycast')
+    raycast.name = '__render_grassCutoutRaycast'
+    raycast.inputs['Ray Direction'].default_value = (0, 0, -1)
+    raycast.inputs['Ray Length'].default_value = 2
+
+    links.new(collectionInfo.outputs['Instances'], realizeInstances.inputs['Geometry'])
+    links.new(realizeInstances.outputs['Geometry'], raycast.inputs['Target Geometry'])
+    links.new(position.outputs['Position'], rayStart.inputs[0])
+    links.new(rayStart.outputs['Vector'], raycast.inputs['Source Position'])
+    for deleteNode in deleteNodes:
+        links.new(raycast.outputs['Is Hit'], deleteNode.inputs['Selection'])
+
+    print(f'Grass cutout mask with {len(cutters)} cutters')
+
+    return True
+
+## Camera-aware grass
+## The scattered grass points are culled outside of the camera frustum (plus a margin for the shadows) and thinned
+## out with the distance to the camera. The camera is only known after the prepared scene is cached, so the nodes
+## read it from the scene, and refreshGrassCulling() updates them each time the camera changes
+grassCullingMode = getArg('--grass-culling', 'camera')
+grassCullMargin = float(getArg('--grass-cull-margin', 5))
+grassFalloffDistance = float(getArg('--grass-falloff-distance', 20))
+grassMinDensity = float(getArg('--grass-min-density', 0.1))
+
+def linkOrSetInput(nodeTree, socket, value):
+    if isinstance(value, bpy.types.NodeSocket):
+        nodeTree.links.new(value, socket)
     else:
-        link = base_color.links[0]
-        if link.from_node.name == 'Mix':
-            # Cas où on a un mixer de couleurx
-            mix = link.from_node
-            mix.inputs['B'].default_value = new_color
-        else:
-            if link.from_node.name == 'Image Texture':
-                # cas où la couleur de base provient d'une texture, il faut insérer notre mix à la volée
-                image_node = link.from_node
-                new_node = tree.nodes.new('ShaderNodeMix')
-                new_node.name = 'Mix'
-                new_node.blend_type = 'MULTIPLY'
-                new_node.data_type = 'RGBA'
-                new_node.clamp_result = False
-                new_node.clamp_factor = True
-                new_node.inputs['B'].default_value = new_color
-                new_node.inputs['Factor'].default_value = 1.0
+        socket.default_value = value
 
-                tree.links.new(new_node.outputs['Result'], link.to_node.inputs['Base Color'])
-                tree.links.new(image_node.outputs['Color'], new_node.inputs['A'])
+def addMathNode(nodeTree, operation, *values):
+    node = nodeTree.nodes.new('ShaderNodeMath')
+    node.operation = operation
+
+    for (socket, value) in zip(node.inputs, values):
+        linkOrSetInput(nodeTree, socket, value)
+
+    return node.outputs[0]
+
+def addValueNode(nodeTree, name, value):
+    node = nodeTree.nodes.new('ShaderNodeValue')
+    node.name = name
+    node.outputs[0].default_value = value
+
+    return node.outputs[0]
 
+def setupGrassCulling(nodeTree):
+    deleteNodes = insertGrassPointsFilter(nodeTree, '__render_grassCull')
 
-for mat in bpy.data.materials:
-    if 'assetBundleHash' in mat:
-        importMaterialRenderAsset(bpy.context.scene.objects, mat.name, mat, True)
-        importedMaterialsCount += 1
+    if not deleteNodes:
+        return
 
+    nodes = nodeTree.nodes
+    links = nodeTree.links
 
-## Replace windows glass materials and grass
-windowsGlassMaterial = bpy.data.materials["__render_MAT_Vitre"]
-frostedGlassMaterial = bpy.data.materials["__render_MAT_Frosted_Glass"]
-cathedralGlassMaterial = bpy.data.materials["__render_MAT_Cathedral_Glass"]
-microdotGlassMaterial = bpy.data.materials["__render_MAT_Microdot_Glass"]
-boxGlassMaterial = bpy.data.materials["__render_MAT_Boxed_Glass"]
-smokedGlassMaterial = bpy.data.materials["__render_MAT_Smoked_Glass"]
+    ## Position of the points in the camera space
+    camera = nodes.new('GeometryNodeObjectInfo')
+    camera.name = '__render_grassCullCamera'
+    camera.transform_space = 'RELATIVE'
 
-## on s'occupe de générer l'herbe
-grassNodeModifier = bpy.data.node_groups['ScatterGrassAndFlowers']
+    position = nodes.new('GeometryNodeInputPosition')
 
-# On initialise notre tableau de truc qui vont couper les plans de gazon.
-cutters = []
-index_cutter = 0
+    offset = nodes.new('ShaderNodeVectorMath')
+    offset.operation = 'SUBTRACT'
+    links.new(position.outputs['Position'], offset.inputs[0])
+    links.new(camera.outputs['Location'], offset.inputs[1])
 
-# On fait d'abord une passe pour récupérer toutes les dalles qui tuent la pelouse
-for obj in bpy.context.scene.objects:
-    if obj.type != 'MESH': continue
+    cameraSpace = nodes.new('ShaderNodeVectorRotate')
+    cameraSpace.rotation_type = 'EULER_XYZ'
+    cameraSpace.invert = True
+    links.new(offset.outputs['Vector'], cameraSpace.inputs['Vector'])
+    links.new(camera.outputs['Rotation'], cameraSpace.inputs['Rotation'])
 
-    if 'grassDestruction' in obj and obj['grassDestruction']:
-        print("found one grass destruction object {}".format(obj.type))
-        cutters.append(obj)
-        obj.select_set(True)
+    separate = nodes.new('ShaderNodeSeparateXYZ')
+    links.new(cameraSpace.outputs['Vector'], separate.inputs[0])
+    (x, y, z) = (separate.outputs['X'], separate.outputs['Y'], separate.outputs['Z'])
 
-if len(cutters) > 0:
-    scene = bpy.context.scene
-    bpy.context.view_layer.objects.active = cutters[0]
-    #bpy.context.view_layer.objects.selected = cutters
-    bpy.ops.object.join()
+    distance = nodes.new('ShaderNodeVectorMath')
+    distance.operation = 'LENGTH'
+    links.new(offset.outputs['Vector'], distance.inputs[0])
 
+    ## Values of the current camera, set by refreshGrassCulling()
+    tanX = addValueNode(nodeTree, '__render_grassCullTanX', 0)
+    tanY = addValueNode(nodeTree, '__render_grassCullTanY', 0)
+    halfWidth = addValueNode(nodeTree, '__render_grassCullHalfWidth', 0)
+    halfHeight = addValueNode(nodeTree, '__render_grassCullHalfHeight', 0)
+    perspective = addValueNode(nodeTree, '__render_grassCullPerspective', 1)
 
-for obj in bpy.context.scene.objects:
-    if obj.type != 'MESH': continue
+    margin = addValueNode(nodeTree, '__render_grassCullMargin', grassCullMargin)
+    falloffDistance = addValueNode(nodeTree, '__render_grassCullFalloffDistance', grassFalloffDistance)
+    minDensity = addValueNode(nodeTree, '__render_grassCullMinDensity', grassMinDensity)
 
+    ## The camera looks down -Z: behind it, or beyond the sides of the frustum
+    behind = addMathNode(nodeTree, 'GREATER_THAN', z, margin)
+    outsideX = addMathNode(nodeTree, 'GREATER_THAN', addMathNode(nodeTree, 'SUBTRACT',
+        addMathNode(nodeTree, 'ADD', addMathNode(nodeTree, 'ABSOLUTE', x), addMathNode(nodeTree, 'MULTIPLY', z, tanX)),
+        halfWidth), margin)
+    outsideY = addMathNode(nodeTree, 'GREATER_THAN', addMathNode(nodeTree, 'SUBTRACT',
+        addMathNode(nodeTree, 'ADD', addMathNode(nodeTree, 'ABSOLUTE', y), addMathNode(nodeTree, 'MULTIPLY', z, tanY)),
+        halfHeight), margin)
+
+    ## Density in (falloffDistance / distance)², orthographic views keep it all
+    density = addMathNode(nodeTree, 'POWER', addMathNode(nodeTree, 'DIVIDE', falloffDistance, distance.outputs['Value']), 2)
+    density = addMathNode(nodeTree, 'MAXIMUM', density, minDensity)
+    density = addMathNode(nodeTree, 'MAXIMUM', density, addMathNode(nodeTree, 'SUBTRACT', 1, perspective))
+
+    randomValue = nodes.new('FunctionNodeRandomValue')
+    randomValue.data_type = 'FLOAT'
+    randomFloat = next(socket for socket in randomValue.outputs if socket.type == 'VALUE')
+    thinned = addMathNode(nodeTree, 'GREATER_THAN', randomFloat, density)
+
+    culled = addMathNode(nodeTree, 'MAXIMUM', addMathNode(nodeTree, 'MAXIMUM', behind, outsideX),
+                         addMathNode(nodeTree, 'MAXIMUM', outsideY, thinned))
+    for deleteNode in deleteNodes:
+        links.new(culled, deleteNode.inputs['Selection'])
+
+    print(f'Grass culling with a margin of {grassCullMargin} and a falloff distance of {grassFalloffDistance}')
+
+# Points the grass culling nodes to the camera and its frustum, shared with render-scene-fast.py
+refreshGrassCulling = runpy.run_path(path.join(path.dirname(path.abspath(__file__)), 'render-grass-culling.py'))['refreshGrassCulling']
+
+## Dalles qui tuent la pelouse et surfaces de gazon, trouvées par les règles de post-traitement
+grassCutters = []
+grassSurfaces = []
+
+def collectGrassCutter(obj):
+    if obj['grassDestruction']:
+        log.debug('found one grass destruction object %s', obj.type)
+        grassCutters.append(obj)
+
+def collectGrassSurface(obj):
     # On process toutes les surfaces qui sont indiqués comme du jardin
     # Puis on va vérifier que la texture appliquée à cette surface est bien
     # une surface "herbeuse". Dans ce cas on va rajouter un modificateur de node
     # qui génèrera la géométrie de l'herbe.
-    if 'grassGeneration' in obj:
-        match obj['grassGeneration']:
-            case 1:
-                # A présent on va appliquer nos dalles tueuses de gazon
-                if len(cutters) > 0:
-                    name = 'CutOut_' + str(index_cutter)
-                    bool_mod = obj.modifiers.new(name=name, type='BOOLEAN')
-                    bool_mod.operation = 'DIFFERENCE'
-                    bool_mod.object = cutters[0]
-                    bool_mod.solver = 'FAST'
-
-                    print(f"Applying grass modifier type {obj.name} cutout {index_cutter}")
-                    index_cutter += 1
-
-                print(f'Add grass modifier type 1 to {obj.name}')
-                modifier = obj.modifiers.new("Grass", "NODES")
-                modifier.node_group = grassNodeModifier
-
-                bpy.context.view_layer.objects.active = obj
-
-    # Les vitres
-    for slot in obj.material_slots:
-        if slot.material.name.startswith('MAT_Vitre_01'):
-            print(f'Replace {slot.material.name} material in {obj.name} to {windowsGlassMaterial.name}')
-            slot.material = windowsGlassMaterial
-        if slot.material.name.startswith('MAT_Vitre_02'):
-            print(f'Replace {slot.material.name} material in {obj.name} to {frostedGlassMaterial.name}')
-            slot.material = frostedGlassMaterial
-        if slot.material.name.startswith('MAT_Vitre_03'):
-            print(f'Replace {slot.material.name} material in {obj.name} to {cathedralGlassMaterial.name}')
-            slot.material = cathedralGlassMaterial
-        if slot.material.name.startswith('MAT_Vitre_04'):
-            print(f'Replace {slot.material.name} material in {obj.name} to {microdotGlassMaterial.name}')
-            slot.material = microdotGlassMaterial
-        if slot.material.name.startswith('MAT_Vitre_05'):
-            print(f'Replace {slot.material.name} material in {obj.name} to {boxGlassMaterial.name}')
-            slot.material = boxGlassMaterial
-        if slot.material.name.startswith('MAT_Vitre_06'):
-            print(f'Replace {slot.material.name} material in {obj.name} to {smokedGlassMaterial.name}')
-            slot.material = smokedGlassMaterial
-
-
-# Traitement des rotations de surface
-for obj in bpy.context.scene.objects:
-    if 'rotation' in obj:
-        appliedObject = importedObject or obj
-        appliedObjects = [appliedObject, *appliedObject.children_recursive]
+    if obj['grassGeneration'] == 1:
+        grassSurfaces.append(obj)
+
+def generateGrass():
+    ## on s'occupe de générer l'herbe
+    grassNodeModifier = bpy.data.node_groups['ScatterGrassAndFlowers']
+
+    cutters = grassCutters
+    index_cutter = 0
+
+    # Les dalles ne sont plus jointes : chaque surface de gazon n'est découpée que par celles qui la chevauchent
+    cutterGrid = buildCutterGrid(cutters)
+    useCutoutMask = len(cutters) > 0 and grassCutoutMode == 'mask' and setupGrassCutoutMask(grassNodeModifier, cutters)
+    hasGrass = False
+
+
+    for obj in grassSurfaces:
+        # A présent on va appliquer nos dalles tueuses de gazon
+        # Un seul booléen par surface, sur une collection des dalles qui la chevauchent
+        overlappingCutters = findOverlappingCutters(cutterGrid, obj) if not useCutoutMask else []
+        if overlappingCutters:
+            name = 'CutOut_' + str(index_cutter)
+            cutterCollection = bpy.data.collections.new(name)
+            for cutter in overlappingCutters:
+                cutterCollection.objects.link(cutter)
+
+            bool_mod = obj.modifiers.new(name=name, type='BOOLEAN')
+            bool_mod.operation = 'DIFFERENCE'
+            bool_mod.operand_type = 'COLLECTION'
+            bool_mod.collection = cutterCollection
+            bool_mod.solver = 'FAST'
+
+            log.debug('Applying grass modifier type %s cutout %s (%s cutters)', obj.name, index_cutter, len(overlappingCutters))
+            index_cutter += 1
+
+        log.debug('Add grass modifier type 1 to %s', obj.name)
+        modifier = obj.modifiers.new("Grass", "NODES")
+        modifier.node_group = grassNodeModifier
+        hasGrass = True
+
+        bpy.context.view_layer.objects.active = obj
+
+    if hasGrass and grassCullingMode == 'camera':
+        setupGrassCulling(grassNodeModifier)
+
+## Glass materials of the scene, by the prefix of the name of the materials they replace
+glassMaterialNames = {
+    'MAT_Vitre_01': '__render_MAT_Vitre',
+    'MAT_Vitre_02': '__render_MAT_Frosted_Glass',
+    'MAT_Vitre_03': '__render_MAT_Cathedral_Glass',
+    'MAT_Vitre_04': '__render_MAT_Microdot_Glass',
+    'MAT_Vitre_05': '__render_MAT_Boxed_Glass',
+    'MAT_Vitre_06': '__render_MAT_Smoked_Glass',
+}
+
+## Glass materials, looked up by name once
+glassMaterials = {}
+
+def replaceGlassMaterial(obj, slotIndex, glassMaterialName):
+    ## Replace windows glass materials
+    if glassMaterialName not in glassMaterials:
+        glassMaterials[glassMaterialName] = bpy.data.materials[glassMaterialName]
+
+    glassMaterial = glassMaterials[glassMaterialName]
+
+    # Les vitres, sur un slot de l'objet quand le mesh est lié depuis le bundle
+    with timedStage('glass'):
+        log.debug('Replace %s material in %s to %s', obj.material_slots[slotIndex].material.name, obj.name, glassMaterial.name)
+        setSlotMaterial(obj, slotIndex, glassMaterial)
+
+## Angle of the surface rotation of each mesh
+meshRotations = {}
+
+def collectSurfaceRotation(obj):
+    # Traitement des rotations de surface
+    # Les instances d'un même asset partagent leur mesh, on ne le tourne qu'une fois (avec le premier angle trouvé)
+    appliedObject = nodeImportedObjects.get(obj, obj)
+
+    for target in [appliedObject, *appliedObject.children_recursive]:
+        if target.type == 'MESH':
+            meshRotations.setdefault(target.data, obj['rotation'])
+
+def applySurfaceRotations():
+    global rotatedLoopsCount
+
+    rotationGroups = {}
+    for (mesh, rotation) in meshRotations.items():
+        rotationGroups.setdefault(rotation, []).append(mesh)
+
+    for (rotation, meshes) in rotationGroups.items():
+        rotatedLoopsCount += applyRotation(meshes, rotation)
+
+def fixLights():
+    ## On s'occupe de corriger les sources de lumières
+    for light_data in bpy.data.lights:
+        if light_data.users:
+            if light_data.type == 'POINT':
+                    light_data.shadow_soft_size = 0.025
+
+## Openings on the same plane, with the same orientation and less than --opening-merge-gap meters apart (window
+## mullions, glazed façades...) are lit by one area light and one portal covering all of them, with their summed energy,
+## instead of one light and one portal each. Lights and portals of the same size and energy share their light data.
+## The merged light keeps the inset of the outer openings, but also emits across the gaps between them (a few
+## centimeters of mullion), the only visible change from separate lights, which --opening-lights separate restores
+openingLightsMode = getArg('--opening-lights', 'merged')
+openingMergeGap = float(getArg('--opening-merge-gap', 0.05))
+
+## Lights are a bit smaller than their opening
+openingLightInset = 0.95
+
+## Counts of the openings and of the lights and portals created for them
+openingLightsCounts = {'openings': 0, 'lights': 0, 'portals': 0}
+
+openingColor = (1.00017, 0.947265, 0.846812) # FFF9ED, color of the sun in our current HDRI
+
+# Rectangle of an opening in world space: the center and the orthonormal axes of its light, and its world size
+def getOpeningRectangle(obj):
+    (openingSizeX, openingSizeY, openingSizeZ) = obj['opening'].to_list()
+
+    # We need to apply a rotation to the light so that it is oriented the same way the openings nulls (obj) are
+    fixRotationMatrix = mathutils.Matrix.LocRotScale(
+        None,
+        mathutils.Euler((math.radians(90), math.radians(180), math.radians(-90))),
+        mathutils.Vector((1, -1, 1)))
+
+    # And we need to translate the light so that it is in the center of the opening (the null is at the bottom left of it)
+    moveToCenterMatrix = mathutils.Matrix.Translation((openingSizeX / 2, openingSizeY / 2, -openingSizeZ / 2))
+
+    lightMatrix = obj.matrix_world @ fixRotationMatrix @ moveToCenterMatrix
+    axes = [lightMatrix.col[axis].xyz for axis in range(3)]
+
+    energyBase = 15 if isInterior else 0.1 if isNightly else 0.1 # W / m^2
+    size = (openingSizeX * axes[0].length, openingSizeY * axes[1].length)
+
+    return {
+        'center': lightMatrix.translation.copy(),
+        'axes': [axis.normalized() for axis in axes],
+        'size': size,
+        'lightSize': (size[0] * openingLightInset, size[1] * openingLightInset),
+        'energy': energyBase * openingSizeX * openingSizeY,
+    }
+
+def canShareOpeningPlane(rectangle, otherRectangle):
+    (axisX, axisY, normal) = rectangle['axes']
+    (otherAxisX, _, otherNormal) = otherRectangle['axes']
+
+    return (normal.dot(otherNormal) > 0.999 and abs(axisX.dot(otherAxisX)) > 0.999
+            and abs(normal.dot(otherRectangle['center'] - rectangle['center'])) < 0.01)
+
+# Merges the openings of a plane whose union is a rectangle, side by side along one axis of the plane
+def mergeOpeningRectangles(rectangles):
+    (axisX, axisY, _) = rectangles[0]['axes']
+    origin = rectangles[0]['center']
+
+    ## Bounds of the rectangles in the coordinates of the plane
+    plannedRectangles = []
+    for rectangle in rectangles:
+        centerX = axisX.dot(rectangle['center'] - origin)
+        centerY = axisY.dot(rectangle['center'] - origin)
+        ## The rectangles of a plane share its axes (canShareOpeningPlane), their size is along them
+        (sizeX, sizeY) = rectangle['size']
+
+        plannedRectangles.append({
+            'min': [centerX - sizeX / 2, centerY - sizeY / 2],
+            'max': [centerX + sizeX / 2, centerY + sizeY / 2],
+            'lightMin': [centerX - sizeX * openingLightInset / 2, centerY - sizeY * openingLightInset / 2],
+            'lightMax': [centerX + sizeX * openingLightInset / 2, centerY + sizeY * openingLightInset / 2],
+            'energy': rectangle['energy'],
+            'count': 1,
+        })
+
+    ## One sweep per axis over the rectangles sorted by their extent on the other axis, then by their start on the
+    ## swept axis, rows merged along one axis can then merge along the other, until nothing merges anymore
+    mergedCount = None
+    while mergedCount != len(plannedRectangles):
+        mergedCount = len(plannedRectangles)
+
+        for (axis, otherAxis) in ((0, 1), (1, 0)):
+            plannedRectangles.sort(key=lambda rectangle: (round(rectangle['min'][otherAxis], 2),
+                                                          round(rectangle['max'][otherAxis], 2), rectangle['min'][axis]))
+            sweptRectangles = []
+
+            for otherRectangle in plannedRectangles:
+                rectangle = sweptRectangles[-1] if sweptRectangles else None
+
+                ## Same extent on one axis, and touching (or close enough) on the other
+                if (rectangle is not None
+                        and abs(rectangle['min'][otherAxis] - otherRectangle['min'][otherAxis]) < 0.01
+                        and abs(rectangle['max'][otherAxis] - otherRectangle['max'][otherAxis]) < 0.01
+                        and otherRectangle['min'][axis] <= rectangle['max'][axis] + openingMergeGap):
+                    rectangle['max'][axis] = max(rectangle['max'][axis], otherRectangle['max'][axis])
+                    rectangle['lightMin'][axis] = min(rectangle['lightMin'][axis], otherRectangle['lightMin'][axis])
+                    rectangle['lightMax'][axis] = max(rectangle['lightMax'][axis], otherRectangle['lightMax'][axis])
+                    rectangle['energy'] += otherRectangle['energy']
+                    rectangle['count'] += otherRectangle['count']
+                else:
+                    sweptRectangles.append(otherRectangle)
+
+            plannedRectangles = sweptRectangles
+
+    ## The light covers the insets of the outer openings, like their own lights would
+    return [{
+        'center': origin + axisX * ((rectangle['lightMin'][0] + rectangle['lightMax'][0]) / 2) + axisY * ((rectangle['lightMin'][1] + rectangle['lightMax'][1]) / 2),
+        'axes': rectangles[0]['axes'],
+        'size': (rectangle['max'][0] - rectangle['min'][0], rectangle['max'][1] - rectangle['min'][1]),
+        'lightSize': (rectangle['lightMax'][0] - rectangle['lightMin'][0], rectangle['lightMax'][1] - rectangle['lightMin'][1]),
+        'energy': rectangle['energy'],
+        'count': rectangle['count'],
+    } for rectangle in plannedRectangles]
+
+def planOpeningLights(openings):
+    rectangles = [getOpeningRectangle(obj) for obj in openings]
+
+    if openingLightsMode != 'merged':
+        return rectangles
+
+    ## Group the openings by plane, then merge each plane
+    planes = []
+    for rectangle in rectangles:
+        plane = next((plane for plane in planes if canShareOpeningPlane(plane[0], rectangle)), None)
 
-        applyRotation(appliedObjects, obj['rotation'])
-
-## On s'occupe de corriger les sources de lumières
-for light_data in bpy.data.lights:
-    if light_data.users:
-        if light_data.type == 'POINT':
-                light_data.shadow_soft_size = 0.025
-
-## Add light areas / portals to all openings
-
-for obj in bpy.context.scene.objects:
-    if 'opening' in obj and isinstance(obj['opening'], idprop.types.IDPropertyArray):
-        print(f'Add area light to opening {obj.name}')
-        
-        (openingSizeX, openingSizeY, openingSizeZ) = obj['opening'].to_list()
-        
-        lightData = bpy.data.lights.new(name='Area Light Data', type='AREA')
-
-        energyBase = 15 if isInterior else 0.1 if isNightly else 0.1 # W / m^2
-        lightData.energy = energyBase * openingSizeX * openingSizeY
-        
-        lightData.shape = 'RECTANGLE'
-        lightData.size = openingSizeX * 0.95
-        lightData.size_y = openingSizeY * 0.95
-        lightData.color = (1.00017, 0.947265, 0.846812) # FFF9ED, color of the sun in our current HDRI
-
-        light = bpy.data.objects.new(name='Area Light', object_data=lightData)
+        if plane is None:
+            planes.append([rectangle])
+        else:
+            plane.append(rectangle)
+
+    return [mergedRectangle for plane in planes for mergedRectangle in mergeOpeningRectangles(plane)]
+
+## Opening nulls of the scene
+openings = []
+
+def collectOpening(obj):
+    if isinstance(obj['opening'], idprop.types.IDPropertyArray):
+        openings.append(obj)
+
+def addOpeningLights():
+    ## Add light areas / portals to all openings
+
+    ## Shared light data, by portal or not, size and energy
+    lightDatas = {}
+
+    def getLightData(rectangle, isPortal):
+        lightDataKey = (isPortal, round(rectangle['lightSize'][0], 4), round(rectangle['lightSize'][1], 4), round(rectangle['energy'], 4))
+
+        if lightDataKey not in lightDatas:
+            lightData = bpy.data.lights.new(name='Area Light Data', type='AREA')
+            lightData.energy = rectangle['energy']
+            lightData.shape = 'RECTANGLE'
+            lightData.size = rectangle['lightSize'][0]
+            lightData.size_y = rectangle['lightSize'][1]
+            lightData.color = openingColor
+            lightData.cycles.is_portal = isPortal
+
+            lightDatas[lightDataKey] = lightData
+
+        return lightDatas[lightDataKey]
+
+    for rectangle in planOpeningLights(openings):
+        log.debug('Add area light for %d openings', rectangle.get('count', 1))
+
+        light = bpy.data.objects.new(name='Area Light', object_data=getLightData(rectangle, False))
         light.visible_camera = False
         light.visible_glossy = False
         light.visible_transmission = False
         light.visible_volume_scatter = False
+        light['__render_openingLight'] = True
 
-        # We need to apply a rotation to the light so that it is oriented the same way the openings nulls (obj) are
-        fixRotationMatrix = mathutils.Matrix.LocRotScale(
-            None,
-            mathutils.Euler((math.radians(90), math.radians(180), math.radians(-90))),
-            mathutils.Vector((1, -1, 1)))
-
-        # And we need to translate the light so that it is in the center of the opening (the null is at the bottom left of it)
-        moveToCenterMatrix = mathutils.Matrix.Translation((openingSizeX / 2, openingSizeY / 2, -openingSizeZ / 2))
-        
-        light.matrix_world = obj.matrix_world @ fixRotationMatrix @ moveToCenterMatrix
+        ## Orthonormal axes, the size of the opening is on the light data
+        light.matrix_world = mathutils.Matrix((
+            (*rectangle['axes'][0], 0), (*rectangle['axes'][1], 0), (*rectangle['axes'][2], 0), (*rectangle['center'], 1),
+        )).transposed()
 
         bpy.context.collection.objects.link(light)
-        
+        openingLightsCounts['lights'] += 1
+
         ## Add the light portal, only in interior
         if isInterior:
             portal = light.copy()
-            portal.data = lightData.copy()
-            portal.data.cycles.is_portal = True
+            portal.data = getLightData(rectangle, True)
             portal.name = 'Area Light Portal'
 
             bpy.context.collection.objects.link(portal)
+            openingLightsCounts['portals'] += 1
 
+    openingLightsCounts['openings'] = len(openings)
 
-## Apply a little bit of sheen on all materials
+    print(f'Opening lights: {len(openings)} openings lit by {openingLightsCounts["lights"]} lights and '
+          f'{openingLightsCounts["portals"]} portals (instead of {len(openings)} lights and '
+          f'{len(openings) if isInterior else 0} portals), {len(lightDatas)} light data')
 
-for mat in bpy.data.materials:
+def applySheen(mat):
+    ## Apply a little bit of sheen on all materials
     if (
-        mat.node_tree is not None
+        mat.library is None
+        and mat.node_tree is not None
         and "Principled BSDF" in mat.node_tree.nodes
         and mat.node_tree.nodes["Principled BSDF"].inputs[23].default_value == 0
     ):
         mat.node_tree.nodes["Principled BSDF"].inputs[23].default_value = 0.02
 
+def rotateHdri():
+    ## Rotate the HDRI to have similar sun rotation (and similar shadows) as exported scene
+
+    if "__render_sun" in bpy.data.objects:
+        sun = bpy.data.objects["__render_sun"]
+        sun.data.energy = 0
+
+        sceneSunRotation = sun.matrix_world.decompose()[1].to_euler().z
+        hdrMapSunRotation = 0.86924
 
-## Rotate the HDRI to have similar sun rotation (and similar shadows) as exported scene
+        bpy.data.worlds["World"].node_tree.nodes["Mapping"].inputs[2].default_value[2] = hdrMapSunRotation - sceneSunRotation
 
-if "__render_sun" in bpy.data.objects:
-    sun = bpy.data.objects["__render_sun"]
-    sun.data.energy = 0
+def setActiveCamera():
+    ## Set the active camera
+    # Transforme le positionArgs en 3 flottant x y z
+    positionValues = positionArg.split(",")
+    positionX, positionY, positionZ = map(float, positionValues)
+    orientationValues = orientationArg.split(",")
+    orientationX, orientationY, orientationZ = map(float, orientationValues)
 
-    sceneSunRotation = sun.matrix_world.decompose()[1].to_euler().z
-    hdrMapSunRotation = 0.86924
+    cameraValues = cameraArg.split(",")
+    cameraType = cameraValues[0]
 
-    bpy.data.worlds["World"].node_tree.nodes["Mapping"].inputs[2].default_value[2] = hdrMapSunRotation - sceneSunRotation
+    # Supprime toutes les caméras existantes
+    bpy.ops.object.select_all(action='DESELECT')
+    bpy.ops.object.select_by_type(type='CAMERA')
+    bpy.ops.object.delete()
 
+    bpy.ops.object.camera_add(location=(positionX, positionY, positionZ),
+                              rotation=(orientationX, orientationY, orientationZ))
 
-## Set the active camera
-# Transforme le positionArgs en 3 flottant x y z
-positionValues = positionArg.split(",")
-positionX, positionY, positionZ = map(float, positionValues)
-orientationValues = orientationArg.split(",")
-orientationX, orientationY, orientationZ = map(float, orientationValues)
+    camera = bpy.context.active_object
 
-cameraValues = cameraArg.split(",")
-cameraType = cameraValues[0]
+    # creation de la caméra en fonction du type
+    if cameraType == 'perspective':
+        aspectRatio = cameraValues[1]
+        fov = cameraValues[2]
+        znear = cameraValues[3]
+        zfar = cameraValues[4]
 
-# Supprime toutes les caméras existantes
-bpy.ops.object.select_all(action='DESELECT')
-bpy.ops.object.select_by_type(type='CAMERA')
-bpy.ops.object.delete()
+        camera.data.type = 'PERSP'
+        camera.data.lens_unit = 'FOV'
+        camera.data.sensor_fit = 'VERTICAL'
+        camera.data.angle = float(fov)
+        camera.data.clip_start = float(znear)
+        camera.data.clip_end = float(zfar)
 
-bpy.ops.object.camera_add(location=(positionX, positionY, positionZ),
-                          rotation=(orientationX, orientationY, orientationZ))
+    else:
+        znear = cameraValues[1]
+        zfar = cameraValues[2]
+        xmag = cameraValues[3]
+        ymag = cameraValues[4]
+
+        camera.data.type = 'ORTHO'
+        camera.data.ortho_scale = float(xmag)
+
+    bpy.context.scene.camera = camera
+    refreshGrassCulling(camera)
+
+## Post-processing rules
+## Each phase registers what it matches on the objects (a custom property, a type), on the material slots of the meshes
+## (a table of material name prefixes) or on the materials. All the rules run in one traversal of the scene objects and
+## one of the materials, then the phases that need everything collected finish in their order
+objectRules = []
+slotRules = []
+materialRules = []
+
+def registerObjectRule(action, propertyName=None, objectType=None):
+    objectRules.append((propertyName, objectType, action))
+
+def registerSlotRule(action, prefixes):
+    ## Prefixes are looked up by length, one dict lookup per distinct length
+    prefixLengths = sorted({len(prefix) for prefix in prefixes}, reverse=True)
+    slotRules.append((prefixLengths, prefixes, action))
+
+def registerMaterialRule(action):
+    materialRules.append(action)
+
+def applySlotRules(obj):
+    if obj.type != 'MESH':
+        return
+
+    for (slotIndex, slot) in enumerate(obj.material_slots):
+        if slot.material is None:
+            continue
 
-camera = bpy.context.active_object
+        materialName = slot.material.name
 
-# creation de la caméra en fonction du type
-if cameraType == 'perspective':
-    aspectRatio = cameraValues[1]
-    fov = cameraValues[2]
-    znear = cameraValues[3]
-    zfar = cameraValues[4]
+        for (prefixLengths, prefixes, action) in slotRules:
+            for prefixLength in prefixLengths:
+                value = prefixes.get(materialName[:prefixLength])
 
-    camera.data.type = 'PERSP'
-    camera.data.lens_unit = 'FOV'
-    camera.data.sensor_fit = 'VERTICAL'
-    camera.data.angle = float(fov)
-    camera.data.clip_start = float(znear)
-    camera.data.clip_end = float(zfar)
+                if value is not None:
+                    action(obj, slotIndex, value)
+                    break
 
-else:
-    znear = cameraValues[1]
-    zfar = cameraValues[2]
-    xmag = cameraValues[3]
-    ymag = cameraValues[4]
+def runObjectRules():
+    for obj in bpy.context.scene.objects:
+        for (propertyName, objectType, action) in objectRules:
+            if (propertyName is None or propertyName in obj) and (objectType is None or obj.type == objectType):
+                action(obj)
+
+        applySlotRules(obj)
+
+def runMaterialRules():
+    for mat in bpy.data.materials:
+        for action in materialRules:
+            action(mat)
+
+registerSlotRule(replaceGlassMaterial, glassMaterialNames)
+registerObjectRule(collectGrassCutter, 'grassDestruction', 'MESH')
+registerObjectRule(collectGrassSurface, 'grassGeneration', 'MESH')
+registerObjectRule(collectSurfaceRotation, 'rotation')
+registerObjectRule(collectOpening, 'opening')
+registerMaterialRule(applySheen)
+
+def prepareScene():
+    ## Import the GLTF scene exported from mDC Designer
+    ## The copies run while the GLTF is imported
+    with timedStage('assetPrefetch'):
+        startAssetPrefetch()
+
+    with timedStage('gltfImport'):
+        importTaggedGltfScene()
+        gltfNodeObjects.update(mapGltfNodeObjects())
+
+    with timedStage('assetCulling'):
+        cullAssets()
+
+    importAssets()
+
+    ## Glass is replaced during the traversal, the other phases only collect their objects
+    with timedStage('objectRules'):
+        runObjectRules()
+
+    with timedStage('grass'):
+        generateGrass()
+
+    with timedStage('rotations'):
+        applySurfaceRotations()
+
+    with timedStage('lights'):
+        fixLights()
+        addOpeningLights()
+
+    with timedStage('sheen'):
+        runMaterialRules()
+
+    with timedStage('hdri'):
+        rotateHdri()
+
+## Prepared scenes cache
+## A prepared scene is stored under a hash of everything it is built from, so the same GLTF and assets
+## submitted under a new session reuse it. The session file is a hard link to that entry.
+
+cachePath = './cache'
+sessionScenePath = path.join(cachePath, f'scene-{sceneEnvironment}-{session}.blend')
+cacheMaxBytes = int(getArg('--cache-max-bytes', 50 * 1024 ** 3))
+
+## Scenes used recently are never evicted, a fast render of their session may be about to open them
+cacheMinAge = 600
+
+## Values other than the files the prepared scene depends on
+sceneCacheKeyOptions = [sceneEnvironment, assetMode, grassCutoutMode, grassCullingMode, grassCullMargin, grassFalloffDistance,
+                        grassMinDensity, assetCullingMode, openingLightsMode, openingMergeGap]
+
+def hashFile(filePath, digest):
+    with open(filePath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+# Bundles referenced by the GLTF, read from its JSON so that it doesn't need to be imported
+def collectGltfRenderAssetBundles(gltf):
+    bundles = set()
+
+    for item in gltf.get('nodes', []) + gltf.get('materials', []):
+        extras = item.get('extras')
+        if not isinstance(extras, dict):
+            continue
+
+        if 'assetBundleHash' in extras:
+            bundles.add(extras['assetBundleHash'])
+
+        if isinstance(extras.get('materialsMap'), dict):
+            for renderAssetRef in extras['materialsMap'].values():
+                if isinstance(renderAssetRef, dict) and 'assetBundleHash' in renderAssetRef:
+                    bundles.add(renderAssetRef['assetBundleHash'])
+
+    return bundles
+
+## Matrix converting the Y up GLTF space to the Z up Blender space, like the GLTF importer does
+gltfToBlenderMatrix = Matrix(((1, 0, 0, 0), (0, 0, -1, 0), (0, 1, 0, 0), (0, 0, 0, 1)))
+
+# World matrices of the GLTF nodes, in the Blender space
+def getGltfNodeWorldMatrices(gltf):
+    nodes = gltf.get('nodes', [])
+    scene = gltf.get('scenes', [{}])[gltf.get('scene', 0)]
+    worldMatrices = {}
+
+    pendingNodes = [(nodeIndex, Matrix.Identity(4)) for nodeIndex in scene.get('nodes', [])]
+
+    while pendingNodes:
+        (nodeIndex, parentMatrix) = pendingNodes.pop()
+        node = nodes[nodeIndex]
+
+        if 'matrix' in node:
+            ## Column major
+            localMatrix = Matrix([node['matrix'][row::4] for row in range(4)])
+        else:
+            (x, y, z, w) = node.get('rotation', (0, 0, 0, 1))
+            localMatrix = Matrix.LocRotScale(Vector(node.get('translation', (0, 0, 0))), Quaternion((w, x, y, z)),
+                                             Vector(node.get('scale', (1, 1, 1))))
+
+        worldMatrix = parentMatrix @ localMatrix
+        worldMatrices[nodeIndex] = gltfToBlenderMatrix @ worldMatrix @ gltfToBlenderMatrix.inverted()
+
+        pendingNodes += [(childIndex, worldMatrix) for childIndex in node.get('children', [])]
+
+    return worldMatrices
+
+# Object keys (bundle and level of detail) the assets of the GLTF will be imported with
+def collectGltfObjectKeys(gltf):
+    objectKeys = set()
+    nodes = gltf.get('nodes', [])
+
+    for (nodeIndex, worldMatrix) in getGltfNodeWorldMatrices(gltf).items():
+        extras = nodes[nodeIndex].get('extras')
+
+        if isinstance(extras, dict) and 'assetBundleHash' in extras:
+            objectKeys.add(getObjectKey(extras['assetBundleHash'], selectLodLevel(extras['assetBundleHash'], worldMatrix)))
+
+    return objectKeys
+
+# Indices of the GLTF nodes whose asset will be culled
+def collectGltfCulledNodes(gltf):
+    nodes = gltf.get('nodes', [])
+    culledNodes = []
+
+    for (nodeIndex, worldMatrix) in sorted(getGltfNodeWorldMatrices(gltf).items()):
+        extras = nodes[nodeIndex].get('extras')
+
+        if isinstance(extras, dict) and 'assetBundleHash' in extras and isAssetCulled(extras['assetBundleHash'], worldMatrix):
+            culledNodes.append(nodeIndex)
+
+    return culledNodes
+
+def getBundleSignature(renderAssetFileName):
+    importedFilePath = resolveObjectFilePath(renderAssetFileName)
+
+    if importedFilePath is None:
+        return f'{renderAssetFileName}:missing'
+
+    fileStat = os.stat(importedFilePath)
+    return f'{renderAssetFileName}:{path.basename(importedFilePath)}:{fileStat.st_size}:{fileStat.st_mtime_ns}'
+
+def computeSceneCacheKey():
+    digest = hashlib.sha256()
+
+    for option in sceneCacheKeyOptions:
+        digest.update(f'{option}\n'.encode())
+
+    ## The bundle directories are listed while the files are hashed
+    with open(sceneFilePath, encoding='utf-8') as sceneFile:
+        startBundleListing(json.load(sceneFile))
+
+    ## This script, the environment template, the GLTF and its buffers and images
+    hashFile(path.abspath(__file__), digest)
+    hashFile(bpy.data.filepath, digest)
+    hashFile(sceneFilePath, digest)
+
+    with open(sceneFilePath, encoding='utf-8') as sceneFile:
+        gltf = json.load(sceneFile)
+
+    for resource in gltf.get('buffers', []) + gltf.get('images', []):
+        uri = resource.get('uri')
+        if uri is not None and not uri.startswith('data:'):
+            hashFile(path.join(path.dirname(sceneFilePath), unquote(uri)), digest)
+
+    finishBundleListing()
+
+    ## The bundles are already named after their content hash, the file that would be imported
+    ## and its size and modification time are enough to notice a re-prepared bundle
+    ## The levels of detail picked for the camera of the job are part of the key, not the camera itself,
+    ## so that jobs with close cameras still share the prepared scene
+    for renderAssetFileName in sorted(collectGltfRenderAssetBundles(gltf) | collectGltfObjectKeys(gltf)):
+        digest.update(f'{getBundleSignature(renderAssetFileName)}\n'.encode())
+
+    ## Like the levels of detail, the culled assets rather than the camera
+    digest.update(f'culled:{collectGltfCulledNodes(gltf)}\n'.encode())
+
+    return digest.hexdigest()
+
+def getCacheEntryPath(sceneCacheKey):
+    return path.join(cachePath, f'prepared-{sceneCacheKey}.blend')
+
+def recordCacheStats(**increments):
+    statsPath = path.join(cachePath, 'stats.json')
+
+    ## Several workers share the cache directory, the counters are updated under a lock when the OS has one
+    with open(statsPath + '.lock', 'a') as lockFile:
+        if fcntl is not None:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+
+        try:
+            with open(statsPath) as statsFile:
+                stats = json.load(statsFile)
+        except (FileNotFoundError, ValueError):
+            stats = {}
+
+        for (statName, increment) in increments.items():
+            stats[statName] = stats.get(statName, 0) + increment
+
+        with open(f'{statsPath}.{os.getpid()}.tmp', 'w') as statsFile:
+            json.dump(stats, statsFile)
+        os.replace(f'{statsPath}.{os.getpid()}.tmp', statsPath)
+
+    print(f'Prepared scenes cache stats: {stats}')
 
-    camera.data.type = 'ORTHO'
-    camera.data.ortho_scale = float(xmag)
+# Points the session file to a cache entry, atomically so that a reader never sees a half-written file
+def linkSessionScene(entryPath):
+    tmpPath = f'{sessionScenePath}.{os.getpid()}.tmp'
 
-bpy.context.scene.camera = camera
+    if path.exists(tmpPath):
+        os.remove(tmpPath)
 
-bpy.ops.wm.save_as_mainfile(filepath=f"./cache/scene-{sceneEnvironment}-{session}.blend")
+    try:
+        os.link(entryPath, tmpPath)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        ## No hard links on this file system
+        shutil.copyfile(entryPath, tmpPath)
 
+    os.replace(tmpPath, sessionScenePath)
+
+def loadCachedScene(sceneCacheKey):
+    os.makedirs(cachePath, exist_ok=True)
+    entryPath = getCacheEntryPath(sceneCacheKey)
+
+    try:
+        linkSessionScene(entryPath)
+        ## The modification time is used as the last use time for the eviction
+        os.utime(entryPath)
+    except FileNotFoundError:
+        print(f'Prepared scene cache miss {sceneCacheKey}')
+        recordCacheStats(misses=1)
+        return False
+
+    print(f'Prepared scene cache hit {sceneCacheKey}')
+    recordCacheStats(hits=1)
+
+    bpy.ops.wm.open_mainfile(filepath=sessionScenePath)
+    return True
+
+# Removes the least recently used prepared scenes, with the session files linked to them, until the cache fits
+# in cacheMaxBytes
+def evictCachedScenes(keptEntryPath):
+    ## Session files are hard links to the entries, files are grouped by inode to count them once
+    fileGroups = {}
+
+    for entry in os.scandir(cachePath):
+        if not entry.is_file() or not entry.name.endswith('.blend') or '.tmp' in entry.name:
+            continue
+        if not entry.name.startswith('prepared-') and not entry.name.startswith('scene-'):
+            continue
+
+        try:
+            fileStat = entry.stat()
+        except FileNotFoundError:
+            continue
+
+        fileGroup = fileGroups.setdefault((fileStat.st_dev, fileStat.st_ino), {
+            'size': fileStat.st_size,
+            'lastUse': fileStat.st_mtime,
+            'links': fileStat.st_nlink,
+            'paths': [],
+        })
+        fileGroup['paths'].append(entry.path)
+
+    keptStat = os.stat(keptEntryPath)
+    keptInode = (keptStat.st_dev, keptStat.st_ino)
+
+    totalBytes = sum(fileGroup['size'] for fileGroup in fileGroups.values())
+    evictions = 0
+    evictedBytes = 0
+
+    for (inode, fileGroup) in sorted(fileGroups.items(), key=lambda item: item[1]['lastUse']):
+        if totalBytes <= cacheMaxBytes:
+            break
+        if inode == keptInode or time.time() - fileGroup['lastUse'] < cacheMinAge:
+            continue
+
+        ## The entry goes with its session files, their manifests and their profile reports
+        for filePath in fileGroup['paths']:
+            for removedPath in (filePath, getManifestPath(filePath), filePath.replace('.blend', '.profile.json')):
+                try:
+                    os.remove(removedPath)
+                except FileNotFoundError:
+                    pass
+
+        evictions += 1
+
+        ## The space is only freed with the last link to the file
+        if fileGroup['links'] <= len(fileGroup['paths']):
+            totalBytes -= fileGroup['size']
+            evictedBytes += fileGroup['size']
+
+    if evictions > 0:
+        print(f'Evicted {evictions} prepared scenes ({evictedBytes} bytes)')
+        recordCacheStats(evictions=evictions, evictedBytes=evictedBytes)
+
+def saveCachedScene(sceneCacheKey):
+    entryPath = getCacheEntryPath(sceneCacheKey)
+    tmpPath = path.join(cachePath, f'prepared-{sceneCacheKey}.{os.getpid()}.tmp.blend')
+
+    ## Saved next to the entry so that relative paths are remapped for the cache directory
+    bpy.ops.wm.save_as_mainfile(filepath=tmpPath)
+    os.replace(tmpPath, entryPath)
+    linkSessionScene(entryPath)
+
+    evictCachedScenes(entryPath)
+
+    ## Like a cache hit, the session file is the current file so that // paths (-o //Result####) resolve next to it
+    bpy.ops.wm.open_mainfile(filepath=sessionScenePath)
+
+## Incremental re-import
+## Each prepared scene has a manifest next to it with, for every GLTF node, the properties the import depends on and
+## the objects it gave. With --incremental on, a session whose GLTF changed only slightly reopens its previous prepared
+## scene and only patches the changed nodes: moved objects are moved, assets are placed again and the opening lights
+## are planned again. Grass changes, changes to the rest of the GLTF or more than --incremental-max-changes of the
+## nodes changed fall back to a full import
+incrementalMode = getArg('--incremental', 'off')
+incrementalMaxChanges = float(getArg('--incremental-max-changes', 0.2))
+
+## Node properties the import depends on
+incrementalProperties = ('assetBundleHash', 'weights', 'materialsMap', 'palettesMap', 'rotation', 'opening',
+                         'grassGeneration', 'grassDestruction')
+grassProperties = ('grassGeneration', 'grassDestruction')
+
+## Objects the GLTF nodes were imported as, by node index, tagged with it on the import. The assets placed for
+## a node are tagged with it too, so that the manifest finds them again in the prepared scene
+gltfNodeObjects = {}
+gltfNodeProperty = '__render_gltfNode'
+gltfNodeAssetProperty = '__render_gltfNodeAsset'
+
+def getManifestPath(scenePath):
+    return scenePath.replace('.blend', '.manifest.json')
+
+# Hash of what the prepared scene depends on, other than the nodes of the GLTF
+def computeSceneBaseKey(gltf):
+    digest = hashlib.sha256()
+
+    for option in sceneCacheKeyOptions:
+        digest.update(f'{option}\n'.encode())
+
+    hashFile(path.abspath(__file__), digest)
+    hashFile(templateFilePath, digest)
+    digest.update(json.dumps({key: value for (key, value) in gltf.items() if key != 'nodes'}, sort_keys=True).encode())
+
+    for resource in gltf.get('buffers', []) + gltf.get('images', []):
+        uri = resource.get('uri')
+        if uri is not None and not uri.startswith('data:'):
+            hashFile(path.join(path.dirname(sceneFilePath), unquote(uri)), digest)
+
+    return digest.hexdigest()
+
+def getGltfNodeStates(gltf):
+    nodes = gltf.get('nodes', [])
+    nodeStates = {}
+
+    for (nodeIndex, worldMatrix) in getGltfNodeWorldMatrices(gltf).items():
+        node = nodes[nodeIndex]
+        extras = node.get('extras') if isinstance(node.get('extras'), dict) else {}
+
+        ## The bundles the node is imported with, with the level of detail picked for the camera of the job
+        bundleNames = []
+        if 'assetBundleHash' in extras:
+            bundleNames.append(getObjectKey(extras['assetBundleHash'], selectLodLevel(extras['assetBundleHash'], worldMatrix)))
+        if isinstance(extras.get('materialsMap'), dict):
+            bundleNames += [renderAssetRef['assetBundleHash'] for renderAssetRef in extras['materialsMap'].values()
+                            if isinstance(renderAssetRef, dict) and 'assetBundleHash' in renderAssetRef]
+
+        nodeStates[str(nodeIndex)] = {
+            'name': node.get('name'),
+            'mesh': node.get('mesh'),
+            'children': node.get('children', []),
+            'matrix': [round(value, 5) for row in worldMatrix for value in row],
+            'extras': {propertyName: extras[propertyName] for propertyName in incrementalProperties if propertyName in extras},
+            'bundles': [getBundleSignature(bundleName) for bundleName in bundleNames],
+        }
+
+    return nodeStates
+
+# Imports the GLTF with the index of each node in the extras, which the importer turns into custom properties
+# of its object. The tagged copy stays next to the GLTF, its buffers and images are relative to it
+def importTaggedGltfScene():
+    with open(sceneFilePath, encoding='utf-8') as sceneFile:
+        gltf = json.load(sceneFile)
+
+    for (nodeIndex, node) in enumerate(gltf.get('nodes', [])):
+        extras = node.setdefault('extras', {})
+        if isinstance(extras, dict):
+            extras[gltfNodeProperty] = nodeIndex
+
+    taggedFilePath = sceneFilePath.replace('.gltf', f'.{os.getpid()}.tmp.gltf')
+
+    try:
+        with open(taggedFilePath, 'w', encoding='utf-8') as taggedFile:
+            json.dump(gltf, taggedFile)
+
+        bpy.ops.import_scene.gltf(filepath=taggedFilePath)
+    finally:
+        try:
+            os.remove(taggedFilePath)
+        except FileNotFoundError:
+            pass
+
+# Objects of the GLTF nodes and the assets placed for them, found by their node index tags
+def mapGltfNodeObjects():
+    return {int(obj[gltfNodeProperty]): obj for obj in bpy.context.scene.objects if gltfNodeProperty in obj}
+
+def mapNodeImportedObjects():
+    return {gltfNodeObjects[int(obj[gltfNodeAssetProperty])]: obj for obj in bpy.context.scene.objects
+            if gltfNodeAssetProperty in obj and int(obj[gltfNodeAssetProperty]) in gltfNodeObjects}
+
+def writeSceneManifest(sceneCacheKey):
+    with open(sceneFilePath, encoding='utf-8') as sceneFile:
+        gltf = json.load(sceneFile)
+
+    nodes = {}
+    for (nodeIndex, nodeState) in getGltfNodeStates(gltf).items():
+        obj = gltfNodeObjects.get(int(nodeIndex))
+        importedObject = nodeImportedObjects.get(obj) if obj is not None else None
+
+        nodes[nodeIndex] = {
+            'object': obj.name if obj is not None else None,
+            'importedObject': importedObject.name if importedObject is not None else None,
+            'state': nodeState,
+        }
+
+    manifest = {'baseKey': computeSceneBaseKey(gltf), 'nodes': nodes}
+    manifestPath = getManifestPath(getCacheEntryPath(sceneCacheKey))
+
+    with open(f'{manifestPath}.{os.getpid()}.tmp', 'w') as manifestFile:
+        json.dump(manifest, manifestFile)
+    os.replace(f'{manifestPath}.{os.getpid()}.tmp', manifestPath)
+
+    linkSessionManifest(sceneCacheKey)
+
+# Copies the manifest of the cache entry next to the session file
+def linkSessionManifest(sceneCacheKey):
+    entryManifestPath = getManifestPath(getCacheEntryPath(sceneCacheKey))
+    sessionManifestPath = getManifestPath(sessionScenePath)
+
+    if not path.exists(entryManifestPath):
+        if path.exists(sessionManifestPath):
+            os.remove(sessionManifestPath)
+        return
+
+    shutil.copyfile(entryManifestPath, f'{sessionManifestPath}.{os.getpid()}.tmp')
+    os.replace(f'{sessionManifestPath}.{os.getpid()}.tmp', sessionManifestPath)
+
+# Changed nodes between the previous manifest and the node states of the GLTF, None when the scene must be rebuilt
+def diffSceneManifest(previousManifest, baseKey, nodeStates):
+    previousNodes = previousManifest['nodes']
+
+    if previousManifest['baseKey'] != baseKey or previousNodes.keys() != nodeStates.keys():
+        return None
+
+    changedNodes = []
+
+    for (nodeIndex, nodeState) in nodeStates.items():
+        previousState = previousNodes[nodeIndex]['state']
+
+        if previousState == nodeState:
+            continue
+
+        ## Nodes can't be added, removed or reparented
+        if any(previousState[key] != nodeState[key] for key in ('name', 'mesh', 'children')):
+            return None
+
+        ## Grass surfaces and cutters depend on each other
+        if any(propertyName in states['extras'] for states in (previousState, nodeState) for propertyName in grassProperties):
+            return None
+
+        ## Materials swapped on the GLTF meshes themselves can't be swapped back
+        isAsset = 'assetBundleHash' in previousState['extras'] or 'assetBundleHash' in nodeState['extras']
+        changedExtras = {propertyName for propertyName in incrementalProperties
+                         if previousState['extras'].get(propertyName) != nodeState['extras'].get(propertyName)}
+
+        if not isAsset and changedExtras - {'opening'}:
+            return None
+
+        if previousNodes[nodeIndex]['object'] is None:
+            return None
+
+        changedNodes.append(int(nodeIndex))
+
+    return changedNodes
+
+def toMatrix(values):
+    return Matrix([values[row * 4:row * 4 + 4] for row in range(4)])
+
+def patchChangedNodes(gltf, previousNodes, nodeStates, changedNodes):
+    ## Parents before their children
+    nodeDepths = {}
+    pendingNodes = [(nodeIndex, 0) for nodeIndex in gltf.get('scenes', [{}])[gltf.get('scene', 0)].get('nodes', [])]
+
+    while pendingNodes:
+        (nodeIndex, depth) = pendingNodes.pop()
+        nodeDepths[nodeIndex] = depth
+        pendingNodes += [(childIndex, depth + 1) for childIndex in gltf['nodes'][nodeIndex].get('children', [])]
+
+    changedNodes = sorted(changedNodes, key=lambda nodeIndex: nodeDepths.get(nodeIndex, 0))
+
+    ## Moved nodes, from their world matrix before any of them moved
+    previousWorldMatrices = {nodeIndex: gltfNodeObjects[nodeIndex].matrix_world.copy() for nodeIndex in changedNodes}
+
+    for nodeIndex in changedNodes:
+        previousState = previousNodes[str(nodeIndex)]['state']
+        nodeState = nodeStates[str(nodeIndex)]
+
+        if previousState['matrix'] != nodeState['matrix']:
+            moveMatrix = toMatrix(nodeState['matrix']) @ toMatrix(previousState['matrix']).inverted()
+            gltfNodeObjects[nodeIndex].matrix_world = moveMatrix @ previousWorldMatrices[nodeIndex]
+
+    ## Assets are placed again, with their properties from the new GLTF
+    assetNodes = [nodeIndex for nodeIndex in changedNodes
+                  if 'assetBundleHash' in previousNodes[str(nodeIndex)]['state']['extras']
+                  or 'assetBundleHash' in nodeStates[str(nodeIndex)]['extras']]
+
+    ## Every changed node gets the properties of the new GLTF, the openings are planned again from them too
+    for nodeIndex in changedNodes:
+        obj = gltfNodeObjects[nodeIndex]
+        extras = gltf['nodes'][nodeIndex].get('extras', {})
+
+        for propertyName in incrementalProperties:
+            if propertyName in extras:
+                obj[propertyName] = extras[propertyName]
+            elif propertyName in obj:
+                del obj[propertyName]
+
+    for nodeIndex in assetNodes:
+        obj = gltfNodeObjects[nodeIndex]
+
+        importedObject = nodeImportedObjects.pop(obj, None)
+        if importedObject is not None:
+            bpy.data.objects.remove(importedObject, do_unlink=True)
+
+    buildMaterialSlotIndex()
+
+    for nodeIndex in assetNodes:
+        importNodeAssets(gltfNodeObjects[nodeIndex])
+        applyNodePalettes(gltfNodeObjects[nodeIndex])
+
+    for nodeIndex in assetNodes:
+        obj = gltfNodeObjects[nodeIndex]
+
+        if 'rotation' in obj:
+            collectSurfaceRotation(obj)
+
+        ## Same objects as the materials of the node
+        appliedObject = nodeImportedObjects.get(obj, obj)
+        for appliedChild in [appliedObject, *appliedObject.children_recursive]:
+            applySlotRules(appliedChild)
+
+    applySurfaceRotations()
+    fixLights()
+    runMaterialRules()
+
+    ## The opening lights are planned again when an opening changed
+    if any('opening' in states['extras'] for nodeIndex in changedNodes
+           for states in (previousNodes[str(nodeIndex)]['state'], nodeStates[str(nodeIndex)])):
+        for obj in list(bpy.context.scene.objects):
+            if '__render_openingLight' in obj:
+                bpy.data.objects.remove(obj, do_unlink=True)
+
+        for obj in bpy.context.scene.objects:
+            if 'opening' in obj:
+                collectOpening(obj)
+
+        addOpeningLights()
+
+    print(f'Patched {len(changedNodes)} nodes ({len(assetNodes)} assets placed again)')
+
+def patchPreviousScene():
+    previousManifestPath = getManifestPath(sessionScenePath)
+
+    if not path.exists(previousManifestPath) or not path.exists(sessionScenePath):
+        return False
+
+    ## The assets are culled once, with the camera of the full import
+    if assetCullingMode != 'off':
+        print('Incremental import is not available with asset culling, full import')
+        return False
+
+    with open(previousManifestPath) as manifestFile:
+        previousManifest = json.load(manifestFile)
+
+    with open(sceneFilePath, encoding='utf-8') as sceneFile:
+        gltf = json.load(sceneFile)
+
+    nodeStates = getGltfNodeStates(gltf)
+    changedNodes = diffSceneManifest(previousManifest, computeSceneBaseKey(gltf), nodeStates)
+
+    if changedNodes is None or len(changedNodes) > incrementalMaxChanges * len(nodeStates):
+        print(f'Incremental import not possible ({"structural change" if changedNodes is None else f"{len(changedNodes)} changed nodes"}), full import')
+        return False
+
+    previousNodes = previousManifest['nodes']
+    bpy.ops.wm.open_mainfile(filepath=sessionScenePath)
+
+    gltfNodeObjects.update(mapGltfNodeObjects())
+    nodeImportedObjects.update(mapNodeImportedObjects())
+
+    ## Objects removed from the prepared scene since, go back to the template
+    if any(nodeIndex not in gltfNodeObjects for nodeIndex in changedNodes):
+        print('Objects of the changed nodes not found in the previous scene, full import')
+        gltfNodeObjects.clear()
+        nodeImportedObjects.clear()
+        bpy.ops.wm.open_mainfile(filepath=templateFilePath)
+        return False
+
+    patchChangedNodes(gltf, previousNodes, nodeStates, changedNodes)
+    return True
+
+## Texture tiers
+## Downscaled copies of the image files (512 to 4096 pixels on their larger side) are built once in cache/textures,
+## named after the hash of the source file. Each image is remapped to the smallest tier covering the largest size on
+## screen of the objects using it, with the job camera, then to smaller ones while the total is over --texture-budget-mb.
+## Images whose use can't be measured (world, geometry nodes) keep their full resolution unless the budget needs it.
+## This runs after the prepared scene is saved since it depends on the camera, only the scene in memory is remapped and
+## the source path is kept on the image to redo it. Fast renders open the saved scene at full resolution
+textureTiersMode = getArg('--texture-tiers', 'off')
+textureTierSizes = (512, 1024, 2048, 4096)
+textureTexelRatio = float(getArg('--texture-texel-ratio', 1))
+textureBudgetBytes = float(getArg('--texture-budget-mb', 0)) * 1024 ** 2
+texturesCachePath = path.join(cachePath, 'textures')
+texturesIndexPath = path.join(texturesCachePath, 'index.json')
+
+def collectNodeTreeImages(nodeTree, images, visitedTrees):
+    if nodeTree is None or nodeTree in visitedTrees:
+        return
+
+    visitedTrees.add(nodeTree)
+
+    for node in nodeTree.nodes:
+        if node.type == 'TEX_IMAGE' and node.image is not None:
+            images.add(node.image)
+        elif node.type == 'GROUP':
+            collectNodeTreeImages(node.node_tree, images, visitedTrees)
+
+# Largest size on screen, in pixels, of the objects using each image
+def collectImageScreenSizes():
+    materialImages = {}
+    imageScreenSizes = {}
+    cameraPosition = getJobCameraPosition()
+
+    for obj in bpy.context.scene.objects:
+        if obj.type != 'MESH':
+            continue
+
+        corners = [obj.matrix_world @ Vector(corner) for corner in obj.bound_box]
+        center = sum(corners, Vector()) / len(corners)
+        radius = max((corner - center).length for corner in corners)
+        screenSize = 2 * radius * getPixelsPerMeter((center - cameraPosition).length - radius)
+
+        for slot in obj.material_slots:
+            material = slot.material
+            if material is None or not material.use_nodes:
+                continue
+
+            if material not in materialImages:
+                materialImages[material] = set()
+                collectNodeTreeImages(material.node_tree, materialImages[material], set())
+
+            for image in materialImages[material]:
+                imageScreenSizes[image] = max(imageScreenSizes.get(image, 0), screenSize)
+
+    return imageScreenSizes
+
+def loadTexturesIndex():
+    try:
+        with open(texturesIndexPath) as indexFile:
+            return json.load(indexFile)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def saveTexturesIndex(texturesIndex):
+    ## Merged with the entries added meanwhile by the other workers
+    with open(texturesIndexPath + '.lock', 'a') as lockFile:
+        if fcntl is not None:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+
+        mergedIndex = loadTexturesIndex()
+        mergedIndex.update(texturesIndex)
+
+        with open(f'{texturesIndexPath}.{os.getpid()}.tmp', 'w') as indexFile:
+            json.dump(mergedIndex, indexFile)
+        os.replace(f'{texturesIndexPath}.{os.getpid()}.tmp', texturesIndexPath)
+
+# Width and height of a PNG or JPEG file from its header, None for the other formats
+def readImageFileSize(header):
+    if header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR':
+        return struct.unpack('>II', header[16:24])
+
+    if header[:2] == b'\xff\xd8':
+        offset = 2
+
+        while offset + 9 <= len(header) and header[offset] == 0xFF:
+            marker = header[offset + 1]
+
+            ## Start of frame markers, other than DHT, JPG and DAC
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                (height, width) = struct.unpack('>HH', header[offset + 5:offset + 9])
+                return (width, height)
+
+            offset += 2 + struct.unpack('>H', header[offset + 2:offset + 4])[0]
+
+    return None
+
+# Content hash and size of a source image, hashed once per file version. The size is read from the header of the
+# file when possible, since asking the image for it loads its pixels
+def getTextureInfo(image, sourcePath, texturesIndex):
+    fileStat = os.stat(sourcePath)
+    indexKey = f'{sourcePath}:{fileStat.st_size}:{fileStat.st_mtime_ns}'
+
+    if indexKey not in texturesIndex:
+        digest = hashlib.sha256()
+        hashFile(sourcePath, digest)
+
+        with open(sourcePath, 'rb') as sourceFile:
+            (width, height) = readImageFileSize(sourceFile.read(256 * 1024)) or tuple(image.size)
+
+        texturesIndex[indexKey] = {'hash': digest.hexdigest(), 'width': width, 'height': height}
+
+    return texturesIndex[indexKey]
+
+# Bytes per pixel of an image in memory, without loading it: 4 bytes for the 8 bit images, 4 floats for the others
+def getImageBytesPerPixel(filePath):
+    return 16 if path.splitext(filePath)[1].lower() in ('.exr', '.hdr') else 4
+
+def getTexturePath(textureInfo, tierSize, extension):
+    return path.join(texturesCachePath, f'{textureInfo["hash"]}-{tierSize}{extension}')
+
+def buildTextureTier(image, sourcePath, textureInfo, tierSize, tierPath):
+    scale = tierSize / max(textureInfo['width'], textureInfo['height'])
+    tmpPath = f'{path.splitext(tierPath)[0]}.{os.getpid()}.tmp{path.splitext(tierPath)[1]}'
+
+    tierImage = bpy.data.images.load(sourcePath, check_existing=False)
+
+    try:
+        tierImage.scale(max(round(textureInfo['width'] * scale), 1), max(round(textureInfo['height'] * scale), 1))
+        tierImage.filepath_raw = tmpPath
+        tierImage.file_format = image.file_format
+        tierImage.save()
+    finally:
+        bpy.data.images.remove(tierImage)
+
+    os.replace(tmpPath, tierPath)
+
+def getTextureBytes(image, textureInfo, tierSize):
+    scale = min(tierSize / max(textureInfo['width'], textureInfo['height']), 1)
+    bytesPerPixel = getImageBytesPerPixel(image.get('__render_sourceFilepath', image.filepath))
+
+    return round(textureInfo['width'] * scale) * round(textureInfo['height'] * scale) * bytesPerPixel
+
+def remapTextureTiers():
+    if textureTiersMode == 'off':
+        ## Images remapped before, in a scene prepared by an older version, go back to their source
+        for image in bpy.data.images:
+            if '__render_sourceFilepath' in image and image.filepath != image['__render_sourceFilepath']:
+                image.filepath = image['__render_sourceFilepath']
+        return
+
+    os.makedirs(texturesCachePath, exist_ok=True)
+    texturesIndex = loadTexturesIndex()
+    imageScreenSizes = collectImageScreenSizes()
+
+    ## Images and the tiers they can use, the last one being the full resolution
+    imageTiers = {}
+
+    for image in bpy.data.images:
+        ## Linked images can't be remapped
+        if image.source != 'FILE' or image.packed_file is not None or image.library is not None:
+            continue
+
+        sourceFilePath = image.get('__render_sourceFilepath', image.filepath)
+        sourcePath = path.abspath(bpy.path.abspath(sourceFilePath, library=image.library))
+
+        if not path.exists(sourcePath):
+            continue
+
+        textureInfo = getTextureInfo(image, sourcePath, texturesIndex)
+        fullSize = max(textureInfo['width'], textureInfo['height'])
+        tierSizes = [tierSize for tierSize in textureTierSizes if tierSize < fullSize] + [fullSize]
+
+        screenSize = imageScreenSizes.get(image)
+        tierIndex = len(tierSizes) - 1
+
+        if screenSize is not None:
+            tierIndex = next(index for (index, tierSize) in enumerate(tierSizes)
+                             if tierSize >= screenSize * textureTexelRatio or index == len(tierSizes) - 1)
+
+        imageTiers[image] = {'sourceFilePath': sourceFilePath, 'sourcePath': sourcePath, 'info': textureInfo,
+                             'sizes': tierSizes, 'index': tierIndex}
+
+    fullBytes = sum(getTextureBytes(image, tiers['info'], tiers['sizes'][-1]) for (image, tiers) in imageTiers.items())
+    usedBytes = sum(getTextureBytes(image, tiers['info'], tiers['sizes'][tiers['index']]) for (image, tiers) in imageTiers.items())
+
+    ## Over the budget, the images taking the most memory go down one tier at a time
+    while textureBudgetBytes > 0 and usedBytes > textureBudgetBytes:
+        reducibleImages = [image for (image, tiers) in imageTiers.items() if tiers['index'] > 0]
+
+        if not reducibleImages:
+            break
+
+        image = max(reducibleImages, key=lambda image: getTextureBytes(image, imageTiers[image]['info'],
+                                                                     imageTiers[image]['sizes'][imageTiers[image]['index']]))
+        tiers = imageTiers[image]
+        usedBytes -= getTextureBytes(image, tiers['info'], tiers['sizes'][tiers['index']])
+        tiers['index'] -= 1
+        usedBytes += getTextureBytes(image, tiers['info'], tiers['sizes'][tiers['index']])
+
+    remappedCount = 0
+
+    for (image, tiers) in imageTiers.items():
+        tierSize = tiers['sizes'][tiers['index']]
+
+        if tiers['index'] == len(tiers['sizes']) - 1:
+            filePath = tiers['sourceFilePath']
+        else:
+            filePath = getTexturePath(tiers['info'], tierSize, path.splitext(tiers['sourcePath'])[1])
+
+            if not path.exists(filePath):
+                log.debug('Build %s texture tier of %s', tierSize, tiers['sourcePath'])
+                buildTextureTier(image, tiers['sourcePath'], tiers['info'], tierSize, filePath)
+
+            filePath = path.abspath(filePath)
+            remappedCount += 1
+
+        image['__render_sourceFilepath'] = tiers['sourceFilePath']
+
+        if image.filepath != filePath:
+            image.filepath = filePath
+
+    saveTexturesIndex(texturesIndex)
+
+    print(f'Texture memory: {fullBytes / 1024 ** 2:.1f} MB at full resolution, {usedBytes / 1024 ** 2:.1f} MB '
+          f'with {remappedCount} of {len(imageTiers)} images remapped to smaller tiers')
+
+## Consolidation
+## Bundles often bring their own copy of the same image file (a wood or a fabric shared by catalog items). Before saving
+## the prepared scene, images with the same content and the same color settings are remapped to one of them, then the
+## datablocks left without users (replaced meshes and materials, templates of the assets...) are purged recursively
+consolidationCounts = {'images': 0, 'imageBytes': 0, 'fileBytes': 0, 'purged': 0}
+
+# Content of an image, the size of its file and the size of its pixels in memory
+def getImageContentKey(image, texturesIndex):
+    sourceFilePath = image.get('__render_sourceFilepath', image.filepath)
+
+    if image.packed_file is not None:
+        contentHash = hashlib.sha256(image.packed_file.data).hexdigest()
+        fileSize = image.packed_file.size
+        imageSize = readImageFileSize(image.packed_file.data[:256 * 1024])
+    else:
+        sourcePath = path.abspath(bpy.path.abspath(sourceFilePath, library=image.library))
+
+        if not path.exists(sourcePath):
+            return None
+
+        textureInfo = getTextureInfo(image, sourcePath, texturesIndex)
+        contentHash = textureInfo['hash']
+        fileSize = os.path.getsize(sourcePath)
+        imageSize = (textureInfo['width'], textureInfo['height'])
+
+    imageBytes = imageSize[0] * imageSize[1] * getImageBytesPerPixel(sourceFilePath) if imageSize is not None else 0
+
+    return ((contentHash, image.colorspace_settings.name, image.alpha_mode, image.use_half_precision), fileSize, imageBytes)
+
+def consolidateScene():
+    os.makedirs(texturesCachePath, exist_ok=True)
+    texturesIndex = loadTexturesIndex()
+
+    ## First image of each content, the others are remapped to it
+    keptImages = {}
+
+    for image in list(bpy.data.images):
+        if image.source != 'FILE' or image.library is not None:
+            continue
+
+        imageKey = getImageContentKey(image, texturesIndex)
+        if imageKey is None:
+            continue
+
+        (contentKey, fileSize, imageBytes) = imageKey
+
+        if contentKey not in keptImages:
+            keptImages[contentKey] = image
+            continue
+
+        log.debug('Remap image %s to %s', image.name, keptImages[contentKey].name)
+
+        consolidationCounts['images'] += 1
+        consolidationCounts['imageBytes'] += imageBytes
+        consolidationCounts['fileBytes'] += fileSize
+
+        image.user_remap(keptImages[contentKey])
+        bpy.data.images.remove(image)
+
+    saveTexturesIndex(texturesIndex)
+
+    ## Only what the import brought is purged, the datablocks of the template (ScatterGrassAndFlowers, the glass
+    ## materials...) stay for the fast renders and the incremental import, even when the scene doesn't use them
+    for (datablockType, datablockNames) in templateDatablocks.items():
+        datablocks = getattr(bpy.data, datablockType)
+
+        for datablockName in datablockNames:
+            if datablockName in datablocks and datablocks[datablockName].library is None:
+                datablocks[datablockName].use_fake_user = True
+
+    datablockCounts = (len(bpy.data.meshes), len(bpy.data.materials), len(bpy.data.images))
+    consolidationCounts['purged'] = bpy.data.orphans_purge(do_local_ids=True, do_linked_ids=True, do_recursive=True)
+
+    print(f'Consolidation: {consolidationCounts["images"]} duplicate images remapped '
+          f'({consolidationCounts["fileBytes"] / 1024 ** 2:.1f} MB of files, {consolidationCounts["imageBytes"] / 1024 ** 2:.1f} MB of pixels), '
+          f'{consolidationCounts["purged"]} orphan datablocks purged ({datablockCounts[0] - len(bpy.data.meshes)} meshes, '
+          f'{datablockCounts[1] - len(bpy.data.materials)} materials, {datablockCounts[2] - len(bpy.data.images)} images)')
+
+## Profile report
+## Written next to the session scene in cache/scene-{env}-{session}.profile.json
+
+def writeProfileReport():
+    report = {
+        'session': session,
+        'sceneEnvironment': sceneEnvironment,
+        'sceneCacheKey': sceneCacheKey,
+        'cacheHit': cacheHit,
+        'incremental': sceneWasPatched,
+        'executionTime': time.time() - startTime,
+        'peakRss': getPeakRss(),
+        'stages': {stageName: {'time': stageTime, 'rss': stageRss.get(stageName), 'rssDelta': stageRssDeltas.get(stageName)}
+                   for (stageName, stageTime) in stageTimings.items()},
+        'counters': {
+            'importedObjectsCount': importedObjectsCount,
+            'importedMaterialsCount': importedMaterialsCount,
+            'importedColorsCount': importedColorsCount,
+            'rotatedLoopsCount': rotatedLoopsCount,
+            'lodLevelCounts': lodLevelCounts,
+            'culledAssetsCount': culledAssetsCount,
+            'openingLightsCounts': openingLightsCounts,
+            'consolidationCounts': consolidationCounts,
+        },
+        'scene': {
+            'meshes': len(bpy.data.meshes),
+            'polygons': sum(len(mesh.polygons) for mesh in bpy.data.meshes),
+            'materials': len(bpy.data.materials),
+            'images': len(bpy.data.images),
+            'lights': len(bpy.data.lights),
+        },
+        'assets': assetProfiles,
+    }
+
+    reportPath = sessionScenePath.replace('.blend', '.profile.json')
+
+    with open(f'{reportPath}.{os.getpid()}.tmp', 'w') as reportFile:
+        json.dump(report, reportFile, indent=2)
+    os.replace(f'{reportPath}.{os.getpid()}.tmp', reportPath)
+
+## Look for an already prepared scene with the same content, or prepare it
+with timedStage('cacheLookup'):
+    sceneCacheKey = computeSceneCacheKey()
+    cacheHit = loadCachedScene(sceneCacheKey)
+
+sceneWasPatched = False
+
+if not cacheHit and incrementalMode == 'on':
+    with timedStage('incremental'):
+        sceneWasPatched = patchPreviousScene()
+
+if not cacheHit and not sceneWasPatched:
+    prepareScene()
+
+with timedStage('camera'):
+    setActiveCamera()
+
+## Before the texture tiers, so that the images kept cover the screen size of all the objects using them
+if not cacheHit:
+    with timedStage('consolidate'):
+        consolidateScene()
+
+if not cacheHit:
+    with timedStage('save'):
+        ## The manifest reads the objects of the scene, before the session file is reopened
+        writeSceneManifest(sceneCacheKey)
+        saveCachedScene(sceneCacheKey)
+else:
+    linkSessionManifest(sceneCacheKey)
+
+## After the save, the cache entries keep the full resolution images and only the scene rendered now is remapped
+with timedStage('textureTiers'):
+    remapTextureTiers()
 
 print(f'--- render-scene-import.py execution time: {time.time() - startTime} seconds ---')
 print(f'importedObjectsCount: {importedObjectsCount}')
 print(f'importedMaterialsCount: {importedMaterialsCount}')
 print(f'importedColorsCount: {importedColorsCount}')
+print(f'rotatedLoopsCount: {rotatedLoopsCount}')
+print(f'lodLevelCounts: {lodLevelCounts}')
+print(f'culledAssetsCount: {culledAssetsCount}')
+print(f'openingLightsCounts: {openingLightsCounts}')
+print(f'consolidationCounts: {consolidationCounts}')
+
+for (stageName, stageTime) in stageTimings.items():
+    print(f'{stageName} time: {stageTime} seconds')
+
+writeProfileReport()
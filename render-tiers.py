@@ -0,0 +1,79 @@
+# Paliers de rendu, partagés par render-scene-fast.py et render-worker.py
+#
+# Un palier (preview|standard|final) règle l'échantillonnage, la résolution et le débruitage au lieu de garder ceux
+# du template, et un budget en secondes arrête le rendu au bout de ce temps. Les scripts le chargent avec
+# runpy.run_path, comme render-grass-culling.py.
+
+import bpy
+import time
+
+## Sample caps are reached only when the adaptive sampling doesn't stop before, the time limit of a tier is
+## the one of Cycles (in seconds, 0 for none)
+renderTiers = {
+    'preview': {'samples': 64, 'adaptiveThreshold': 0.1, 'adaptiveMinSamples': 8, 'timeLimit': 10,
+                'resolutionPercentage': 50, 'denoise': True, 'denoisePrefilter': 'FAST'},
+    'standard': {'samples': 512, 'adaptiveThreshold': 0.03, 'adaptiveMinSamples': 32, 'timeLimit': 60,
+                 'resolutionPercentage': 100, 'denoise': True, 'denoisePrefilter': 'ACCURATE'},
+    'final': {'samples': 4096, 'adaptiveThreshold': 0.01, 'adaptiveMinSamples': 64, 'timeLimit': 0,
+              'resolutionPercentage': 100, 'denoise': True, 'denoisePrefilter': 'ACCURATE'},
+}
+
+## Settings a tier or a budget can change, as (owner of the setting on the scene, name of the setting)
+renderTierSettings = (
+    ('cycles', 'use_adaptive_sampling'),
+    ('cycles', 'adaptive_threshold'),
+    ('cycles', 'adaptive_min_samples'),
+    ('cycles', 'samples'),
+    ('cycles', 'time_limit'),
+    ('render', 'resolution_percentage'),
+    ('cycles', 'use_denoising'),
+    ('cycles', 'denoiser'),
+    ('cycles', 'denoising_input_passes'),
+    ('cycles', 'denoising_prefilter'),
+)
+
+# Puts back the settings of the template, kept on the scene the first time a tier is applied, so that a view or
+# a job without a tier doesn't inherit the one of the previous view or job
+def restoreTemplateRenderSettings(scene):
+    if '__render_templateRenderSettings' not in scene:
+        scene['__render_templateRenderSettings'] = {f'{ownerName}.{settingName}': getattr(getattr(scene, ownerName), settingName)
+                                                    for (ownerName, settingName) in renderTierSettings}
+        return
+
+    templateSettings = scene['__render_templateRenderSettings']
+
+    for (ownerName, settingName) in renderTierSettings:
+        setattr(getattr(scene, ownerName), settingName, templateSettings[f'{ownerName}.{settingName}'])
+
+# Applique un palier de rendu, et le temps restant sur le budget de la vue
+def applyRenderTier(renderTierName, renderTimeBudget, budgetStartTime, cyclesDevice):
+    scene = bpy.context.scene
+    restoreTemplateRenderSettings(scene)
+
+    if renderTierName is not None:
+        if renderTierName not in renderTiers:
+            raise ValueError(f'Unknown render tier {renderTierName}, expected one of {", ".join(renderTiers)}')
+
+        renderTier = renderTiers[renderTierName]
+
+        scene.cycles.use_adaptive_sampling = True
+        scene.cycles.adaptive_threshold = renderTier['adaptiveThreshold']
+        scene.cycles.adaptive_min_samples = renderTier['adaptiveMinSamples']
+        scene.cycles.samples = renderTier['samples']
+        scene.cycles.time_limit = renderTier['timeLimit']
+        scene.render.resolution_percentage = renderTier['resolutionPercentage']
+
+        scene.cycles.use_denoising = renderTier['denoise']
+        ## The OptiX denoiser needs an NVIDIA GPU, CPU-only nodes use OpenImageDenoise
+        scene.cycles.denoiser = 'OPTIX' if cyclesDevice == 'OPTIX' else 'OPENIMAGEDENOISE'
+        scene.cycles.denoising_input_passes = 'RGB_ALBEDO_NORMAL'
+
+        if scene.cycles.denoiser == 'OPENIMAGEDENOISE':
+            scene.cycles.denoising_prefilter = renderTier['denoisePrefilter']
+
+    if renderTimeBudget is not None:
+        ## Cycles only counts the sampling time, what was already spent on the job is taken out of the budget
+        remainingTime = float(renderTimeBudget) - (time.time() - budgetStartTime)
+        scene.cycles.time_limit = max(remainingTime, 1)
+
+        print(f'Render time limit: {scene.cycles.time_limit} seconds')
@@ -0,0 +1,244 @@
+"""Long-lived render worker
+
+Keeps Blender resident and runs import / fast / render jobs received as JSON lines, either on a local
+Unix socket or on stdin, so that jobs don't pay for Blender startup and template loading every time.
+
+    blender -b --python render-worker.py -- --cycles-device OPTIX --socket /tmp/mdc-render.sock
+    blender -b --python render-worker.py -- --cycles-device OPTIX --stdin
+
+A job has the same fields as the command line of the scripts it runs:
+
+    {"id": "42", "type": "fast", "sceneEnvironment": "interior", "session": "...", "position": "x,y,z",
+     "orientation": "x,y,z", "camera": "perspective,...", "sunOrientation": "x,y,z", "renderTier": "preview"}
+
+- import: prepares cache/scene-{env}-{session}.blend from the environment template (render-scene-import.py)
+- render: same as import, then renders the frame (what scripts.sh render-{env} does), with the render tier
+  and the time budget of the job like a fast job
+- fast: moves the camera and sun of the prepared scene and renders it (render-scene-fast.py), or renders
+  every view of the "views" job file
+- quit: stops the worker
+
+Each job gets a JSON line back with its status, its output image path and its duration. In stdin mode, the
+responses are the only thing written to stdout: everything the scripts and Blender print goes to stderr.
+"""
+
+import bpy
+import json
+import os
+import runpy
+import socket
+import sys
+import time
+import traceback
+from os import path
+
+rootPath = path.dirname(path.abspath(__file__))
+
+argv = sys.argv
+workerArgv = list(argv)
+
+## The scripts resolve ./cache relative to the working directory, like when they are launched from scripts.sh
+os.chdir(rootPath)
+
+## File currently opened in Blender and its modification time when it was opened, so that consecutive jobs
+## on the same scene don't reload it (and keep the Cycles persistent data)
+loadedScene = None
+
+def openScene(filePath):
+    global loadedScene
+
+    filePath = path.abspath(filePath)
+    sceneKey = (filePath, os.stat(filePath).st_mtime_ns)
+
+    if loadedScene == sceneKey:
+        print(f'Reuse loaded scene {filePath}')
+        return
+
+    bpy.ops.wm.open_mainfile(filepath=filePath, load_ui=False)
+    loadedScene = sceneKey
+
+def runScript(scriptName, scriptArgs):
+    sys.argv = [workerArgv[0], '--', *scriptArgs]
+
+    try:
+        return runpy.run_path(path.join(rootPath, scriptName), run_name='__main__')
+    finally:
+        sys.argv = workerArgv
+
+## Job fields and the command line arguments of the scripts they stand for
+jobArguments = {
+    'sceneEnvironment': '--scene-environment',
+    'session': '--session',
+    'position': '--position',
+    'orientation': '--orientation',
+    'camera': '--camera',
+    'sunOrientation': '--sun-orientation',
+    'views': '--views',
+    'renderTier': '--render-tier',
+    'renderTimeBudget': '--render-time-budget',
+}
+
+## The device of the worker, the render tiers pick their denoiser from it
+cyclesDevice = workerArgv[workerArgv.index('--cycles-device') + 1] if '--cycles-device' in workerArgv else None
+
+## Render jobs apply the render tiers like the fast jobs (see render-tiers.py)
+applyRenderTier = runpy.run_path(path.join(rootPath, 'render-tiers.py'))['applyRenderTier']
+
+def buildScriptArgs(job):
+    scriptArgs = ['--cycles-device', cyclesDevice] if cyclesDevice is not None else []
+
+    for (fieldName, argumentName) in jobArguments.items():
+        if fieldName in job:
+            scriptArgs += [argumentName, str(job[fieldName])]
+
+    return scriptArgs
+
+def renderResult():
+    scene = bpy.context.scene
+
+    ## Same as -o //Result#### -x 1 -f 1
+    scene.render.filepath = '//Result####'
+    scene.render.use_file_extension = True
+    scene.render.use_persistent_data = True
+    scene.frame_set(1)
+
+    bpy.ops.render.render(write_still=True)
+
+    return bpy.path.abspath(scene.render.frame_path(frame=1))
+
+def rememberSavedScene(sessionScenePath):
+    global loadedScene
+
+    ## The import script saves or opens the prepared scene of the session, which stays loaded for its next fast jobs
+    if path.exists(sessionScenePath):
+        loadedScene = (path.abspath(sessionScenePath), os.stat(sessionScenePath).st_mtime_ns)
+    else:
+        loadedScene = None
+
+def runJob(job):
+    global loadedScene
+
+    jobStartTime = time.time()
+    jobType = job['type']
+    sceneEnvironment = job['sceneEnvironment']
+    output = None
+
+    if jobType in ('import', 'render'):
+        ## The template is modified by the import, it is always reopened (it stays in the OS file cache)
+        loadedScene = None
+        openScene(path.join(rootPath, f'render-scene-{sceneEnvironment}.blend'))
+        scriptGlobals = runScript('render-scene-import.py', buildScriptArgs(job))
+        rememberSavedScene(scriptGlobals['sessionScenePath'])
+
+        if jobType == 'render':
+            applyRenderTier(job.get('renderTier'), job.get('renderTimeBudget'), jobStartTime, cyclesDevice or 'CPU')
+            output = renderResult()
+
+    elif jobType == 'fast':
+        openScene(path.join('cache', f'scene-{sceneEnvironment}-{job["session"]}.blend'))
+        scriptGlobals = runScript('render-scene-fast.py', buildScriptArgs(job))
+
+        ## With a views file, render-scene-fast.py renders every view itself
+        if 'views' in job:
+            output = scriptGlobals['renderedOutputs']
+        else:
+            output = renderResult()
+
+    else:
+        raise ValueError(f'Unknown job type {jobType}')
+
+    return output
+
+def handleLine(line):
+    global loadedScene
+
+    jobStartTime = time.time()
+    job = {}
+
+    try:
+        parsedJob = json.loads(line)
+
+        if not isinstance(parsedJob, dict):
+            raise ValueError('A job must be a JSON object')
+
+        job = parsedJob
+
+        if job.get('type') == 'quit':
+            return None
+
+        output = runJob(job)
+        response = {'id': job.get('id'), 'status': 'ok', 'output': output}
+
+    except Exception as error:
+        traceback.print_exc()
+        response = {'id': job.get('id'), 'status': 'error', 'error': str(error)}
+
+        ## The scene may be half modified, reload it on the next job
+        loadedScene = None
+
+    response['time'] = time.time() - jobStartTime
+    print(f'--- render-worker.py job {job.get("id")} ({job.get("type")}) time: {response["time"]} seconds ---')
+
+    return response
+
+def serveStdin():
+    ## The responses keep the original stdout, the prints of the scripts and of Blender go to stderr
+    responseStream = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+
+        response = handleLine(line)
+        if response is None:
+            return
+
+        responseStream.write(json.dumps(response) + '\n')
+        responseStream.flush()
+
+# Serves the jobs of one client, returns False on a quit job
+def serveConnection(connection):
+    with connection, connection.makefile('rw', encoding='utf-8') as stream:
+        for line in stream:
+            if not line.strip():
+                continue
+
+            response = handleLine(line)
+            if response is None:
+                return False
+
+            stream.write(json.dumps(response) + '\n')
+            stream.flush()
+
+    return True
+
+def serveSocket(socketPath):
+    if path.exists(socketPath):
+        os.remove(socketPath)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketPath)
+    server.listen()
+    print(f'render-worker.py listening on {socketPath}')
+
+    try:
+        ## Blender can only run one job at a time, connections are served one after the other
+        while True:
+            (connection, _) = server.accept()
+
+            ## A client that goes away doesn't stop the worker
+            try:
+                if not serveConnection(connection):
+                    return
+            except (OSError, UnicodeDecodeError) as error:
+                print(f'Connection closed: {error}', file=sys.stderr)
+    finally:
+        server.close()
+        os.remove(socketPath)
+
+if '--socket' in argv:
+    serveSocket(argv[argv.index('--socket') + 1])
+else:
+    serveStdin()
@@ -18,6 +18,15 @@ if %1 == render-fast-exterior (
 if %1 == render-fast-nightly (
     blender -b cache\scene-nightly-%2.blend --python render-scene-fast.py -o //Result#### -x 1 -f 1 -- --cycles-device OPTIX --scene-environment nightly --session %2 --position %3 --orientation %4 --camera %5 --sun-orientation %6
 )
+if %1 == render-fast-batch (
+    blender -b cache\scene-%2-%3.blend --python render-scene-fast.py -- --cycles-device OPTIX --scene-environment %2 --session %3 --views %4
+)
+if %1 == render-distributed (
+    python render-distributed.py %2 %3 %4 %5 %6 %7 %8 %9
+)
+if %1 == render-worker (
+    blender -b --python render-worker.py -- --cycles-device OPTIX --stdin
+)
 if %1 == prepare-material-hq-file (
     blender -b %2 --python prepare-material-hq-file.py
 )
@@ -29,4 +38,16 @@ if %1 == prepare-object-hq-file (
 )
 if %1 == prepare-object-lq-file (
     blender -b empty.blend --python prepare-object-lq-file.py -- %2
+)
+if %1 == prepare-object-lods-file (
+    blender -b %2 --python prepare-object-lods-file.py
+)
+if %1 == prepare-batch (
+    python prepare-batch.py %2 %3 %4 %5 %6 %7 %8 %9
+)
+if %1 == benchmark-generate (
+    python benchmark-generate-scene.py %2 %3 %4 %5 %6 %7 %8 %9
+)
+if %1 == benchmark-run (
+    python benchmark-run.py %2 %3 %4 %5 %6 %7 %8 %9
 )
\ No newline at end of file
@@ -17,6 +17,15 @@ case $1 in
     "render-fast-nightly")
         blender -b cache/scene-nightly-$2.blend --python render-scene-fast.py -o //Result#### -x 1 -f 1 -- --cycles-device OPTIX --scene-environment nightly --session $2 --position $3 --orientation $4 --camera $5 --sun-orientation $6
         ;;
+    "render-fast-batch")
+        blender -b cache/scene-$2-$3.blend --python render-scene-fast.py -- --cycles-device OPTIX --scene-environment $2 --session $3 --views $4
+        ;;
+    "render-distributed")
+        python3 render-distributed.py "${@:2}"
+        ;;
+    "render-worker")
+        blender -b --python render-worker.py -- --cycles-device OPTIX --socket $2
+        ;;
     "prepare-material-hq-file")
         blender -b $2 --python prepare-material-hq-file.py
         ;;
@@ -29,4 +38,16 @@ case $1 in
     "prepare-object-lq-file")
         blender -b empty.blend --python prepare-object-lq-file.py -- $2
         ;;
+    "prepare-object-lods-file")
+        blender -b $2 --python prepare-object-lods-file.py
+        ;;
+    "prepare-batch")
+        python3 prepare-batch.py "${@:2}"
+        ;;
+    "benchmark-generate")
+        python3 benchmark-generate-scene.py "${@:2}"
+        ;;
+    "benchmark-run")
+        python3 benchmark-run.py "${@:2}"
+        ;;
 esac
\ No newline at end of file